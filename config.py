@@ -11,8 +11,113 @@ SSH_USER = os.environ.get('SSH_USER')
 SSH_PASSWD = os.environ.get('SSH_PASSWD')
 MY_TELEGRAM = os.environ.get('MY_TELEGRAM')
 PROXY_CONFIG = os.environ.get('PROXY_CONFIG')
+# address of a Bot API server other than api.telegram.org, for example a
+# local one or tools/fake_telegram.py, like "http://127.0.0.1:8081"
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
 SERVER_ADDRESS = os.environ.get('SERVER_ADDRESS')
 DB_USER = os.environ.get('DB_USER')
 DB_NAME = os.environ.get('DB_NAME')
 PROD_HOST_NAME = os.environ.get('PROD_HOST_NAME')
 CACHE_TIME = int(os.environ.get('CACHE_TIME'))
+COUNTRY_BORDERS_FILE = os.environ.get('COUNTRY_BORDERS_FILE',
+                                      'photogpsbot/country_borders.geojson')
+# aliases of brands of cameras and lenses that names are normalized with
+NAME_RULES_FILE = os.environ.get('NAME_RULES_FILE',
+                                 'photogpsbot/name_rules.json')
+# how many normalized names of cameras and lenses are remembered
+NAME_CACHE_SIZE = int(os.environ.get('NAME_CACHE_SIZE', 10000))
+GEOCODER_PROVIDER = os.environ.get('GEOCODER_PROVIDER', 'nominatim')
+NOMINATIM_URL = os.environ.get('NOMINATIM_URL',
+                               'https://nominatim.openstreetmap.org')
+GEOCODER_TIMEOUT = float(os.environ.get('GEOCODER_TIMEOUT', 5))
+# seconds between requests, public Nominatim allows one request per second
+GEOCODER_INTERVAL = float(os.environ.get('GEOCODER_INTERVAL', 1))
+# read replicas of the database separated by commas like "host:port,host"
+DB_REPLICAS = os.environ.get('DB_REPLICAS')
+# seconds during which a chat that wrote something reads from the primary
+READ_YOUR_WRITES_WINDOW = float(os.environ.get('READ_YOUR_WRITES_WINDOW', 5))
+# replicas that are behind more than this number of seconds are not used
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 30))
+# seconds between checks of lag of replicas by the health checker thread
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 10))
+# idle connection to the database is pinged every this number of seconds
+DB_PING_INTERVAL = float(os.environ.get('DB_PING_INTERVAL', 60))
+# how long a query can be retried if connection to the database is lost
+DB_RETRY_DEADLINE = float(os.environ.get('DB_RETRY_DEADLINE', 15))
+DB_RETRY_BASE_DELAY = float(os.environ.get('DB_RETRY_BASE_DELAY', 0.2))
+DB_RETRY_MAX_DELAY = float(os.environ.get('DB_RETRY_MAX_DELAY', 5))
+# "exact" charts are made by the database, "approximate" ones by in-memory
+# sketches that are much faster on large tables
+CHARTS_MODE = os.environ.get('CHARTS_MODE', 'exact')
+# how many items every approximate chart keeps
+CHART_SKETCH_CAPACITY = int(os.environ.get('CHART_SKETCH_CAPACITY', 1000))
+CHART_SNAPSHOT_FILE = os.environ.get('CHART_SNAPSHOT_FILE', 'charts.json')
+# seconds between snapshots of approximate charts
+CHART_SNAPSHOT_INTERVAL = float(os.environ.get('CHART_SNAPSHOT_INTERVAL',
+                                               300))
+# seconds between reading rows added by other processes into charts
+CHARTS_REFRESH_INTERVAL = float(os.environ.get('CHARTS_REFRESH_INTERVAL', 60))
+# number of processes that handle updates, 1 means that the bot works in one
+# process without a dispatcher
+WORKERS = int(os.environ.get('WORKERS', 1))
+# updates that can wait in the queue of one worker
+WORKER_QUEUE_SIZE = int(os.environ.get('WORKER_QUEUE_SIZE', 100))
+# seconds that workers have to handle updates left in queues on shutdown
+WORKER_SHUTDOWN_TIMEOUT = float(os.environ.get('WORKER_SHUTDOWN_TIMEOUT', 30))
+# long polling timeout of the dispatcher, it is also the longest time it
+# takes to notice that the bot has to be turned off
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', 20))
+# load all users to memory on start instead of only the last active ones
+PRELOAD_USERS = os.environ.get('PRELOAD_USERS', '').lower() in ('1', 'true',
+                                                                'yes')
+# seconds to wait for the next file of an album (media group) before the
+# bot handles all its files together
+ALBUM_WINDOW = float(os.environ.get('ALBUM_WINDOW', 1))
+# the longest time an album waits for its files since the first one came
+ALBUM_MAX_WAIT = float(os.environ.get('ALBUM_MAX_WAIT', 5))
+# number of files of one album that are downloaded and read at the same time
+ALBUM_THREADS = int(os.environ.get('ALBUM_THREADS', 4))
+# messages per second that the bot can send to Telegram, to one private
+# chat and to one group (Telegram allows 20 messages per minute there)
+SENDER_GLOBAL_RATE = float(os.environ.get('SENDER_GLOBAL_RATE', 30))
+SENDER_CHAT_RATE = float(os.environ.get('SENDER_CHAT_RATE', 1))
+SENDER_GROUP_RATE = float(os.environ.get('SENDER_GROUP_RATE', 20 / 60))
+# messages that can be sent to one chat at once before its rate applies
+SENDER_CHAT_BURST = int(os.environ.get('SENDER_CHAT_BURST', 3))
+SENDER_THREADS = int(os.environ.get('SENDER_THREADS', 4))
+# how many times a message is sent again after Telegram asked to wait
+SENDER_MAX_RETRIES = int(os.environ.get('SENDER_MAX_RETRIES', 5))
+# "your photo is being processed" is sent only if the answer isn't ready in
+# this number of seconds, 0 sends it at once
+PROCESSING_MESSAGE_DELAY = float(os.environ.get('PROCESSING_MESSAGE_DELAY',
+                                                1))
+# connections kept open for downloading files, one for every thread that
+# downloads them: handler threads of TeleBot and threads of albums
+DOWNLOAD_POOL_SIZE = int(os.environ.get('DOWNLOAD_POOL_SIZE',
+                                        ALBUM_THREADS + 2))
+DOWNLOAD_CONNECT_TIMEOUT = float(os.environ.get('DOWNLOAD_CONNECT_TIMEOUT',
+                                                5))
+DOWNLOAD_READ_TIMEOUT = float(os.environ.get('DOWNLOAD_READ_TIMEOUT', 30))
+# how many times a download is tried again after a failure
+DOWNLOAD_RETRIES = int(os.environ.get('DOWNLOAD_RETRIES', 3))
+# how long the profiler from the admin menu works and how often the
+# sampling one looks at stacks of threads, in seconds
+PROFILE_SECONDS = float(os.environ.get('PROFILE_SECONDS', 30))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+# seconds between writes of changed users to the database, changes of one
+# user in this time are written as one row
+USER_FLUSH_INTERVAL = float(os.environ.get('USER_FLUSH_INTERVAL', 5))
+# seconds between messages to the admin about new users
+NEW_USERS_DIGEST_INTERVAL = float(os.environ.get('NEW_USERS_DIGEST_INTERVAL',
+                                                 600))
+# processes that read EXIF of photos, 0 reads it in handler threads without
+# limits
+EXIF_WORKERS = int(os.environ.get('EXIF_WORKERS', 2))
+# seconds to wait for EXIF of one file, including the time in the queue
+EXIF_TIMEOUT = float(os.environ.get('EXIF_TIMEOUT', 10))
+# bytes that a process can allocate and CPU seconds that it can spend on one
+# file, 0 means no limit
+EXIF_MEMORY_LIMIT = int(os.environ.get('EXIF_MEMORY_LIMIT', 256 * 2 ** 20))
+EXIF_CPU_LIMIT = int(os.environ.get('EXIF_CPU_LIMIT', 5))
+# files after which a process is replaced by a new one
+EXIF_TASKS_PER_WORKER = int(os.environ.get('EXIF_TASKS_PER_WORKER', 500))
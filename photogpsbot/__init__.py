@@ -18,6 +18,9 @@ with open('photogpsbot/language_pack.json', 'r', encoding='utf8') as json_file:
 from photogpsbot.custom_logging import log, LogFiles, TelegramHandler
 log_files = LogFiles()
 
+from photogpsbot.memory import MemoryRegistry
+memory = MemoryRegistry()
+
 from photogpsbot.bot import TelegramBot
 bot = TelegramBot(config.TELEGRAM_TOKEN)
 
@@ -27,15 +30,86 @@ telegram_handler = TelegramHandler(bot)
 telegram_handler.setLevel(logging.ERROR)
 log.addHandler(telegram_handler)
 
+from photogpsbot.profiler import Profiler
+profiler = Profiler()
+
+from photogpsbot.sender import Sender
+sender = Sender(bot)
+# all requests to the Bot API go through one pooled session
+apihelper._get_req_session = sender.get_session
+
 from photogpsbot.db_connector import Database
 db = Database()
 
+# goes before users, they put their changes into it
+from photogpsbot.user_writes import UserWrites
+user_writes = UserWrites()
+
 from photogpsbot.users import User, Users
 users = Users()
 
+from photogpsbot.dimensions import Dimension
+cameras = Dimension('cameras')
+lenses = Dimension('lenses')
+
+from photogpsbot.country_resolver import CountryResolver
+country_resolver = CountryResolver(config.COUNTRY_BORDERS_FILE,
+                                   'photogpsbot/countries.json')
+
+from photogpsbot.geocoder import Geocoder
+geocoder = Geocoder()
+
+from photogpsbot.normalizer import NameNormalizer
+name_normalizer = NameNormalizer.from_file(config.NAME_RULES_FILE,
+                                           config.NAME_CACHE_SIZE)
+
+from photogpsbot.exif_pool import ExifPool
+exif_pool = ExifPool()
+
+from photogpsbot.charts import ChartSketches, RollingCharts
+chart_sketches = ChartSketches(config.CHART_SNAPSHOT_FILE,
+                               config.CHART_SKETCH_CAPACITY)
+rolling_charts = RollingCharts()
+
+if config.TELEGRAM_API_URL:
+    log.info('Working with Bot API at %s', config.TELEGRAM_API_URL)
+    apihelper.API_URL = config.TELEGRAM_API_URL + '/bot{0}/{1}'
+    apihelper.FILE_URL = config.TELEGRAM_API_URL + '/file/bot{0}/{1}'
+    # _make_request takes API_URL as a default value of its base_url
+    # argument, so the default has to be replaced as well
+    defaults = list(apihelper._make_request.__defaults__)
+    defaults[-1] = apihelper.API_URL
+    apihelper._make_request.__defaults__ = tuple(defaults)
+
 if socket.gethostname() == config.PROD_HOST_NAME:
     machine = 'prod'
 else:
-    log.info('Working through proxy.')
-    apihelper.proxy = {'https': config.PROXY_CONFIG}
     machine = 'develop'
+    # a Bot API server of our own doesn't need a proxy
+    if not config.TELEGRAM_API_URL:
+        log.info('Working through proxy.')
+        apihelper.proxy = {'https': config.PROXY_CONFIG}
+
+# goes after the proxy, so that the proxy is set once for all downloads
+from photogpsbot.downloader import Downloader
+downloader = Downloader(proxies=apihelper.proxy)
+
+# caches of the objects above, the admin can see their sizes
+memory.register('Users', lambda: (users.users,))
+memory.register('Cameras', lambda: (cameras.ids, cameras.names))
+memory.register('Lenses', lambda: (lenses.ids, lenses.names))
+memory.register('Normalized names', lambda: (),
+                lambda: name_normalizer.normalize.cache_info().currsize,
+                name_normalizer.approximate_size)
+memory.register('Country grid', lambda: (country_resolver.whole_cells,
+                                         country_resolver.border_cells))
+memory.register('Chart sketches', lambda: [
+    sketch.counters for sketch in chart_sketches.sketches.values()])
+memory.register('Rolling charts', lambda: (rolling_charts.buckets,
+                                           rolling_charts.totals))
+memory.register('Chats with recent writes', lambda: (db.last_writes,))
+memory.register('Users waiting for a flush',
+                lambda: (user_writes.rows, user_writes.new_users))
+memory.register('Sender queue', lambda: (sender._chats, sender._delayed))
+memory.register('Sender rate limits', lambda: (sender._buckets,))
+memory.register('Photos in flight', lambda: (downloader.buffers,))
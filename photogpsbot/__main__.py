@@ -9,19 +9,32 @@ interactive menus, to handle user language, to process user images
 """
 
 
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from datetime import datetime, timedelta
 from dataclasses import dataclass
-from typing import List, Tuple, Callable, Any
+from typing import List, Tuple, Callable, Any, Dict, Optional
 
 # telebot goes as pyTelegramBotAPI in requirements
-from telebot import types  # type: ignore
+from telebot import types, apihelper  # type: ignore
 from telebot.types import Message, CallbackQuery  # type: ignore
-import requests
 
-from photogpsbot import bot, log, log_files, db, User, users, messages, machine
-from photogpsbot.process_image import ImageHandler, ImageData, NoData, NoEXIF
+from photogpsbot import (bot, log, log_files, db, User, users, messages,
+                         geocoder, chart_sketches, rolling_charts,
+                         country_resolver, cameras, lenses, sender,
+                         downloader, profiler, memory, user_writes,
+                         exif_pool)
+from photogpsbot.process_image import (ImageHandler, ImageData, NoData,
+                                       NoEXIF, AddressCache)
+from photogpsbot import photo_queries
+from photogpsbot.albums import AlbumCollector
 from photogpsbot.db_connector import DatabaseConnectionError
+from photogpsbot.downloader import DownloadError
+from photogpsbot.workers import Dispatcher
+from photogpsbot.request_context import (RequestContext, with_context,
+                                         handler_timings)
 import config
 
 CACHE_TIME = config.CACHE_TIME
@@ -52,16 +65,20 @@ class PhotoMessage:
         coordinates: Tuple = ()
         answer: str = ''
 
-    def __init__(self, message: Message, user: User) -> None:
+    def __init__(self, message: Message, user: User,
+                 address_cache: Optional[AddressCache] = None) -> None:
         """
         Init variables
 
         :param message: Message object from Telebot
         :param user: User object that represents one particular user
+        :param address_cache: addresses found for other files of the same
+        album
         """
         self.message = message
         self.user = user
         self.image_handler = ImageHandler
+        self.address_cache = address_cache
 
     @staticmethod
     def open_photo(message: Message) -> BytesIO:
@@ -80,18 +97,10 @@ class PhotoMessage:
         file_path = bot.get_file(message.document.file_id).file_path
 
         # Download photo that got the bot from a user
-        link = ("https://api.telegram.org/file/"
-                f"bot{config.TELEGRAM_TOKEN}/{file_path}")
-
-        if machine == 'prod':
-            r = requests.get(link)
-        else:
-            # use proxy if the bot is running not on production server
-            proxies = {'https': config.PROXY_CONFIG}
-            r = requests.get(link, proxies=proxies)
+        link = apihelper.FILE_URL.format(config.TELEGRAM_TOKEN, file_path)
 
         # Get and return file-like object of user's photo
-        return BytesIO(r.content)
+        return downloader.open(link)
 
     def get_info(self) -> ImageData:
         """
@@ -104,7 +113,7 @@ class PhotoMessage:
         an image like user, date, camera name etc
         """
         user_photo = self.open_photo(self.message)
-        image = self.image_handler(self.user, user_photo)
+        image = self.image_handler(self.user, user_photo, self.address_cache)
         return image.get_image_info()
 
     def save_info_to_db(self, image_data: ImageData) -> None:
@@ -123,26 +132,7 @@ class PhotoMessage:
         the image
         :return: None
         """
-        camera_name, lens_name = image_data.camera, image_data.lens
-
-        if not image_data.country:
-            country_en = country_ru = None
-        else:
-            country_en = image_data.country["en-US"]
-            country_ru = image_data.country["ru-RU"]
-
-        log.info('Adding user query to photo_queries_table...')
-
-        query = ('INSERT INTO photo_queries_table2 '
-                 '(chat_id, camera_name, lens_name, country_en, country_ru) '
-                 'VALUES (%s, %s, %s, %s, %s)')
-
-        parameters = (self.user.chat_id, camera_name, lens_name, country_en,
-                      country_ru)
-
-        db.execute_query(query, parameters)
-        db.conn.commit()
-        log.info('User query was successfully added to the database.')
+        photo_queries.save(image_data)
 
     @staticmethod
     def find_num_users_with_same_feature(image_data: ImageData) -> List[int]:
@@ -157,24 +147,18 @@ class PhotoMessage:
         same lens, the third - number of users who took a photo from the same
         country
         """
-        same_feature = []
-        country = image_data.country
-        country = country.get('en-US', None) if country else None
-
-        feature_types = ('camera_name', 'lens_name', 'country_en')
-        features = (image_data.camera, image_data.lens, country)
+        feature_types = ('camera_id', 'lens_id', 'country_code')
+        features = (cameras.get_id(image_data.camera),
+                    lenses.get_id(image_data.lens), image_data.country)
 
         # take a column name and a value to be sought in this column
         # to find number of distinct users with this value
-        for feature_type, feature in zip(feature_types, features):
-            if not feature:
-                same_feature.append(0)
-                continue
-            answer = get_number_users_by_feature(feature=feature,
-                                                 feature_type=feature_type)
-            same_feature.append(answer)
-
-        return same_feature
+        known = [(feature_type, feature) for feature_type, feature
+                 in zip(feature_types, features) if feature]
+        numbers = dict(zip(known, get_numbers_of_users_by_features(
+            known, image_data.user.chat_id)))
+        return [numbers.get((feature_type, feature), 0)
+                for feature_type, feature in zip(feature_types, features)]
 
     def prepare_answer(self) -> Answer:
         """
@@ -194,6 +178,9 @@ class PhotoMessage:
         except (NoData, NoEXIF):
             answer.answer = messages[self.user.language]['no_exif']
             return answer
+        except DownloadError:
+            answer.answer = messages[self.user.language]['download_error']
+            return answer
 
         # Save some general info about the user's query to the database
         self.save_info_to_db(image_data)
@@ -203,24 +190,156 @@ class PhotoMessage:
         else:
             answer.answer += messages[self.user.language]["no_gps"] + '\n'
 
-        answ_template = messages[self.user.language]["camera_info"]
+        answer.answer += self.describe(image_data, self.user.language)
+
+        lang = self.user.language
+        lang_templates = messages[lang]["users with the same feature"].values()
+        ppl_wth_same_featrs = self.find_num_users_with_same_feature(image_data)
+        for template, feature in zip(lang_templates, ppl_wth_same_featrs):
+            if feature:
+                answer.answer += f'{template} {feature}\n'
+
+        return answer
+
+    @staticmethod
+    def describe(image_data: ImageData, language: str) -> str:
+        """
+        Makes lines with date, camera, lens and address of a photo
+
+        :param image_data: info about a photo
+        :param language: language of the user
+        :return: string with a line for every known thing
+        """
+        answ_template = messages[language]["camera_info"]
         basic_data = (image_data.date_time, image_data.camera, image_data.lens,
                       image_data.address)
 
         # Concatenate templates in language that user prefer with information
         # from the photo, for example: f'{"Camera brand"}:{"Canon 60D"}'
+        description = ''
         for arg in zip(answ_template, basic_data):
             if arg[1]:
-                answer.answer += f'*{arg[0]}*: {arg[1]}\n'
+                description += f'*{arg[0]}*: {arg[1]}\n'
+        return description
+
+
+class AlbumMessage:
+    """
+    Class that prepares one response for all the files of an album.
+
+    Files are downloaded and read at the same time, the geocoder is asked
+    once for photos taken close to each other, all the photos are saved to
+    the database in one go and number of users with the same camera, lens
+    or country is found once for every distinct camera, lens or country.
+    """
+
+    def __init__(self, album: List[Message], user: User) -> None:
+        """
+        Init variables
+
+        :param album: messages with files of one album
+        :param user: user who sent the album
+        """
+        self.album = album
+        self.user = user
+        self.address_cache = AddressCache()
+
+    def get_info(self, message: Message) -> Optional[ImageData]:
+        """
+        Gets info about the photo from one message of the album
 
+        :param message: message with a file
+        :return: info about the photo or None if there is nothing to take
+        from it
+        """
+        try:
+            return PhotoMessage(message, self.user,
+                                self.address_cache).get_info()
+        except (NoData, NoEXIF, DownloadError):
+            return None
+        except Exception as e:
+            log.error('Cannot get info about a file of an album: %s', e)
+            return None
+
+    def find_num_users_with_same_features(self, images: List[ImageData]) \
+            -> str:
+        """
+        Finds how many users have the same cameras and lenses or took photos
+        in the same countries as photos of the album
+
+        :param images: info about photos of the album
+        :return: lines with a number of users for every camera, lens and
+        country
+        """
         lang = self.user.language
         lang_templates = messages[lang]["users with the same feature"].values()
-        ppl_wth_same_featrs = self.find_num_users_with_same_feature(image_data)
-        for template, feature in zip(lang_templates, ppl_wth_same_featrs):
-            if feature:
-                answer.answer += f'{template} {feature}\n'
+        feature_types = ('camera_id', 'lens_id', 'country_code')
+        values: Tuple[Dict[Any, str], ...] = ({}, {}, {})
+        for image_data in images:
+            features = ((cameras.get_id(image_data.camera), image_data.camera),
+                        (lenses.get_id(image_data.lens), image_data.lens),
+                        (image_data.country, image_data.country))
+            # dictionaries keep the order the features have come in
+            for feature_values, (feature, name) in zip(values, features):
+                if feature:
+                    feature_values[feature] = name
+
+        # all the numbers are counted at once
+        known = [(feature_type, feature) for feature_type, feature_values
+                 in zip(feature_types, values) for feature in feature_values]
+        numbers = dict(zip(known, get_numbers_of_users_by_features(
+            known, self.user.chat_id)))
+
+        lines = ''
+        for template, feature_type, feature_values in zip(
+                lang_templates, feature_types, values):
+            for feature, name in feature_values.items():
+                number = numbers[feature_type, feature]
+                if number and feature_type == 'country_code':
+                    name = country_resolver.get_name(feature, lang)
+                if number:
+                    lines += f'{template} {number} ({name})\n'
+        return lines
+
+    def prepare_answer(self) -> Tuple[List[Tuple[float, float]], str]:
+        """
+        Gets info from all the files of the album, saves it to the database
+        and makes one answer
 
-        return answer
+        :return: coordinates of distinct places where photos were taken and
+        a message to the user
+        """
+        lang = self.user.language
+        threads = max(1, min(config.ALBUM_THREADS, len(self.album)))
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            all_info = list(executor.map(self.get_info, self.album))
+
+        images = [image_data for image_data in all_info if image_data]
+        if images:
+            photo_queries.save_many(images, chat_id=self.user.chat_id)
+
+        places: Dict[Tuple[float, float], None] = {}
+        answer = messages[lang]['album_header'].format(len(self.album)) + '\n'
+        for number, image_data in enumerate(all_info, 1):
+            answer += f'\n*{messages[lang]["album_file"]} {number}*\n'
+            if not image_data:
+                answer += messages[lang]['no_exif'] + '\n'
+                continue
+            if image_data.latitude and image_data.longitude:
+                places[round(image_data.latitude, 4),
+                       round(image_data.longitude, 4)] = None
+            else:
+                answer += messages[lang]["no_gps"] + '\n'
+            answer += PhotoMessage.describe(image_data, lang)
+
+        features = self.find_num_users_with_same_features(images)
+        if features:
+            answer += '\n' + features
+
+        log.info('%d of %d files of the album had info, %d addresses were '
+                 'taken from nearby photos', len(images), len(self.album),
+                 self.address_cache.hits)
+        return list(places), answer
 
 
 def get_admin_stat(command: str) -> str:
@@ -261,53 +380,37 @@ def get_admin_stat(command: str) -> str:
 
     elif command == 'total number photos sent':
         log.info('Evaluating total number of photo queries in database...')
-        query = ('SELECT COUNT(chat_id) '
-                 'FROM photo_queries_table2')
+        queries = [('SELECT COUNT(chat_id) '
+                    'FROM photo_queries_table2', None),
+                   ('SELECT COUNT(chat_id) '
+                    'FROM photo_queries_table2 '
+                    'WHERE chat_id !=%s', (config.MY_TELEGRAM,))]
         try:
-            cursor = db.execute_query(query)
+            total, except_admin = db.execute_batch(queries)
         except DatabaseConnectionError:
             return error_answer
-        answer += f'{cursor.fetchone()[0]} times users sent photos.'
-        query = ('SELECT COUNT(chat_id) '
-                 'FROM photo_queries_table2 '
-                 'WHERE chat_id !=%s')
-        parameters = config.MY_TELEGRAM,
-        try:
-            cursor = db.execute_query(query, parameters)
-        except DatabaseConnectionError:
-            answer += ("\nCannot calculate number of photos that were send "
-                       "excluding your photos. Check logs")
-            return answer
-
-        answer += f'\nExcept you: {cursor.fetchone()[0]} times.'
+        answer += f'{total[0][0]} times users sent photos.'
+        answer += f'\nExcept you: {except_admin[0][0]} times.'
         log.info('Done.')
         return answer
 
     elif command == 'photos today':
         # Show how many photos have been sent since 00:00:00 of today
         log.info('Evaluating number of photos which were sent today.')
-        query = ("SELECT COUNT(chat_id) "
-                 "FROM photo_queries_table2 "
-                 "WHERE time > %s")
-
-        parameters = today,
-        try:
-            cursor = db.execute_query(query, parameters)
-        except DatabaseConnectionError:
-            return error_answer
-        answer += f'{cursor.fetchone()[0]} times users sent photos today.'
-        query = ("SELECT COUNT(chat_id) "
-                 "FROM photo_queries_table2 "
-                 "WHERE time > %s "
-                 "AND chat_id !=%s")
-
-        parameters = today, config.MY_TELEGRAM
+        queries = [("SELECT COUNT(chat_id) "
+                    "FROM photo_queries_table2 "
+                    "WHERE time > %s", (today,)),
+                   ("SELECT COUNT(chat_id) "
+                    "FROM photo_queries_table2 "
+                    "WHERE time > %s "
+                    "AND chat_id !=%s", (today, config.MY_TELEGRAM))]
         try:
-            cursor = db.execute_query(query, parameters)
+            total, except_admin = db.execute_batch(queries)
         except DatabaseConnectionError:
             return error_answer
 
-        answer += '\nExcept you: {} times.'.format(cursor.fetchone()[0])
+        answer += f'{total[0][0]} times users sent photos today.'
+        answer += '\nExcept you: {} times.'.format(except_admin[0][0])
         log.info('Done.')
         return answer
 
@@ -316,51 +419,35 @@ def get_admin_stat(command: str) -> str:
         # once or more (first for the whole time, then today)
         log.info('Evaluating number of users that use bot '
                  'since the first day and today...')
+        queries = [("SELECT COUNT(*) FROM users", None),
+                   ("SELECT COUNT(DISTINCT chat_id) "
+                    "FROM photo_queries_table2 "
+                    "WHERE time > %s", (today,))]
         try:
-            num_of_users = users.get_total_number()
+            total, today_users = db.execute_batch(queries)
         except DatabaseConnectionError:
             return error_answer
 
-        answer += f'There are totally {num_of_users} users.'
-
-        query = ("SELECT COUNT(DISTINCT chat_id) "
-                 "FROM photo_queries_table2 "
-                 "WHERE time > %s")
-        parameters = today,
-        try:
-            cursor = db.execute_query(query, parameters)
-        except DatabaseConnectionError:
-            answer += ("\nCannot calculate how many user have sent their "
-                       "photos today")
-            return answer
-
-        answer += f'\n{cursor.fetchone()[0]} users have sent photos today.'
+        answer += f'There are totally {total[0][0]} users.'
+        answer += f'\n{today_users[0][0]} users have sent photos today.'
         log.info('Done.')
         return answer
 
     elif command == 'number of gadgets':
         # To show you number smartphones + cameras in database
         log.info('Evaluating number of cameras and smartphones in database...')
-        query = ('SELECT COUNT(DISTINCT camera_name) '
-                 'FROM photo_queries_table2')
+        queries = [('SELECT COUNT(DISTINCT camera_id) '
+                    'FROM photo_queries_table2', None),
+                   ("SELECT COUNT(DISTINCT camera_id) "
+                    "FROM photo_queries_table2 "
+                    "WHERE time > %s", (today,))]
         try:
-            cursor = db.execute_query(query)
+            total, today_cameras = db.execute_batch(queries)
         except DatabaseConnectionError:
             return error_answer
-        answer += (f'There are totally {cursor.fetchone()[0]} '
+        answer += (f'There are totally {total[0][0]} '
                    f'cameras/smartphones.')
-        query = ("SELECT COUNT(DISTINCT camera_name) "
-                 "FROM photo_queries_table2 "
-                 "WHERE time > %s")
-        parameters = today,
-        try:
-            cursor = db.execute_query(query, parameters)
-        except DatabaseConnectionError:
-            answer += ("Cannot calculate the number of gadgets that have been "
-                       "used today so far")
-            return answer
-
-        answer += (f'\n{cursor.fetchone()[0]} cameras/smartphones '
+        answer += (f'\n{today_cameras[0][0]} cameras/smartphones '
                    'were used today.')
         log.info('Done.')
         return answer
@@ -376,62 +463,103 @@ def get_admin_stat(command: str) -> str:
                             60, td.seconds % 60)
         log.info(uptime)
         return uptime
+
+    elif command == 'handler timings':
+        return str(handler_timings)
+
+    elif command == 'geocoder':
+        return str(geocoder)
+
+    elif command == 'database':
+        return str(db)
+
+    elif command == 'charts':
+        return f'{chart_sketches}\n{rolling_charts}'
+
+    elif command == 'sender':
+        return str(sender)
+
+    elif command == 'downloader':
+        return str(downloader)
+
+    elif command == 'user writes':
+        return str(user_writes)
+
+    elif command == 'exif pool':
+        return str(exif_pool)
+
+    elif command == 'memory':
+        return memory.report()
+
+    elif command == 'memory diff':
+        return memory.trace()
+
+    elif command == 'stop memory tracing':
+        return memory.stop_tracing()
     else:
         return 'There is no such a command'
 
 
 @bot.message_handler(commands=['start'])
-def create_main_keyboard(message: Message) -> None:
+@with_context()
+def create_main_keyboard(message: Message, context: RequestContext) -> None:
     """
     Creates and renders the main keyboard
 
     :param message: message from a user
+    :param context: info about the update such as the user who sent it
     :return: None
     """
 
-    user = users.find_one(message)
-    current_user_lang = user.language
+    user = context.user
+    current_user_lang = context.language
     markup = types.ReplyKeyboardMarkup(one_time_keyboard=True,
                                        resize_keyboard=True)
     markup.row('Русский/English')
     markup.row(messages[current_user_lang]['top_cams'])
     markup.row(messages[current_user_lang]['top_lens'])
     markup.row(messages[current_user_lang]['top_countries'])
-    bot.send_message(user.chat_id, messages[current_user_lang]['menu_header'],
-                     reply_markup=markup)
+    markup.row(messages[current_user_lang]['top_24h'])
+    markup.row(messages[current_user_lang]['top_7d'])
+    markup.row(messages[current_user_lang]['top_30d'])
+    sender.send_message(user.chat_id,
+                        messages[current_user_lang]['menu_header'],
+                        reply_markup=markup)
 
 
 # Decorator to handle text messages
 @bot.message_handler(content_types=['text'])
-def handle_menu_response(message: Message) -> None:
+@with_context()
+def handle_menu_response(message: Message, context: RequestContext) -> None:
     """
     Function that handles user's respond to the main keyboard
 
     :param message: user's message
+    :param context: info about the update such as the user who sent it
     :return: None
     """
 
     # keyboard_hider = telebot.types.ReplyKeyboardRemove()
-    current_user_lang = users.find_one(message).language
-    user = users.find_one(message)
+    user = context.user
+    current_user_lang = context.language
 
     if message.text == 'Русский/English':
 
-        new_lang = users.find_one(message).switch_language()
+        new_lang = user.switch_language()
         if current_user_lang != new_lang:
-            bot.send_message(user.chat_id, messages[new_lang]
-                             ['switch_lang_success'])
-            create_main_keyboard(message)
+            sender.send_message(user.chat_id, messages[new_lang]
+                                ['switch_lang_success'])
+            create_main_keyboard(message, context)
         else:
-            bot.send_message(user.chat_id, messages[new_lang]
-                             ['switch_lang_failure'])
-            create_main_keyboard(message)
+            sender.send_message(user.chat_id, messages[new_lang]
+                                ['switch_lang_failure'])
+            create_main_keyboard(message, context)
 
     elif message.text == messages[current_user_lang]['top_cams']:
         log.info('User %s asked for top cams', user)
-        bot.send_message(user.chat_id,
-                         text=get_most_popular_items(item_type='camera_name',
-                                                     message=message))
+        sender.send_message(user.chat_id,
+                            text=get_most_popular_items(item_type='camera_id',
+                                                        user=user))
         log.info('List of most popular cameras '
                  'has been returned to %s', user)
 
@@ -443,21 +571,33 @@ def handle_menu_response(message: Message) -> None:
 
     elif message.text == messages[current_user_lang]['top_lens']:
         log.info('User %s asked for top lens', user)
-        bot.send_message(user.chat_id,
-                         text=get_most_popular_items(item_type='lens_name',
-                                                     message=message))
+        sender.send_message(user.chat_id,
+                            text=get_most_popular_items(item_type='lens_id',
+                                                        user=user))
         log.info('List of most popular lens has been returned to %s', user)
 
     elif message.text == messages[current_user_lang]['top_countries']:
         log.info('User %s asked for top countries', user)
-        lang_table_name = ('country_ru'
-                           if current_user_lang == 'ru-RU' else 'country_en')
-        bot.send_message(user.chat_id,
-                         text=get_most_popular_items(item_type=lang_table_name,
-                                                     message=message))
+        sender.send_message(
+            user.chat_id, text=get_most_popular_items(item_type='country_code',
+                                                      user=user))
         log.info('List of most popular countries has '
                  'been returned to %s', user)
 
+    elif message.text in (messages[current_user_lang]['top_24h'],
+                          messages[current_user_lang]['top_7d'],
+                          messages[current_user_lang]['top_30d']):
+        hours = {messages[current_user_lang]['top_24h']: 24,
+                 messages[current_user_lang]['top_7d']: 7 * 24,
+                 messages[current_user_lang]['top_30d']: 30 * 24}
+        window = hours[message.text]
+        log.info('User %s asked for charts of the last %d hours', user,
+                 window)
+        sender.send_message(user.chat_id,
+                            text=get_recent_charts(window, user))
+        log.info('Charts of the last %d hours have been returned to %s',
+                 window, user)
+
     elif (message.text.lower() == 'admin' and
           user.chat_id == int(config.MY_TELEGRAM)):
         # Creates inline keyboard with options for admin Function that handle
@@ -478,6 +618,24 @@ def handle_menu_response(message: Message) -> None:
         keyboard.add(button(text='Number of gadgets',
                             callback_data='number of gadgets'))
         keyboard.add(button(text='Uptime', callback_data='uptime'))
+        keyboard.add(button(text='Handler timings',
+                            callback_data='handler timings'))
+        keyboard.add(button(text='Geocoder', callback_data='geocoder'))
+        keyboard.add(button(text='Database', callback_data='database'))
+        keyboard.add(button(text='Charts', callback_data='charts'))
+        keyboard.add(button(text='Sender', callback_data='sender'))
+        keyboard.add(button(text='Downloader', callback_data='downloader'))
+        keyboard.add(button(text='User writes', callback_data='user writes'))
+        keyboard.add(button(text='EXIF pool', callback_data='exif pool'))
+        keyboard.add(button(text='Profile (sampling)',
+                            callback_data='profile sampling'))
+        keyboard.add(button(text='Profile (cProfile)',
+                            callback_data='profile cprofile'))
+        keyboard.add(button(text='Memory', callback_data='memory'))
+        keyboard.add(button(text='Memory diff (tracemalloc)',
+                            callback_data='memory diff'))
+        keyboard.add(button(text='Stop tracemalloc',
+                            callback_data='stop memory tracing'))
         bot.send_message(config.MY_TELEGRAM,
                          'Admin commands', reply_markup=keyboard)
 
@@ -485,18 +643,33 @@ def handle_menu_response(message: Message) -> None:
         log.info('%s sent text message.', user)
 
         # Answer to user that bot can't make a conversation with him
-        bot.send_message(user.chat_id,
-                         messages[current_user_lang]['dont_speak'])
+        sender.send_message(user.chat_id,
+                            messages[current_user_lang]['dont_speak'])
+
+
+def send_profile(summary: str, profile_file: BytesIO) -> None:
+    """
+    Sends a profile made on the command from the admin menu to the admin
+
+    :param summary: text with functions that take the most time
+    :param profile_file: file with the whole profile
+    :return: None
+    """
+    bot.send_message(config.MY_TELEGRAM, summary)
+    if profile_file.getbuffer().nbytes:
+        bot.send_document(config.MY_TELEGRAM, profile_file)
 
 
 @bot.callback_query_handler(func=lambda call: True)
-def admin_menu(call: CallbackQuery) -> None:
+@with_context(resolve_user=False)
+def admin_menu(call: CallbackQuery, context: RequestContext) -> None:
     """
     Respond to commands from the admin menu
 
     :param call: object that contains info about user's reaction to an
     interactive keyboard
-
+    :param context: info about the update, there is no user in it as only
+    the admin can use this menu
     :return: None
     """
 
@@ -504,12 +677,8 @@ def admin_menu(call: CallbackQuery) -> None:
     bot.answer_callback_query(callback_query_id=call.id, show_alert=False)
 
     if call.data == 'off':
-        if db.disconnect():
-            bot.turn_off()
-        else:
-            log.error('Cannot stop bot.')
-            bot.send_message(chat_id=config.MY_TELEGRAM,
-                             text='Cannot stop bot.')
+        # stop_services() is called once polling or the worker stops
+        bot.turn_off()
     elif call.data == 'last active':
         bot.send_message(config.MY_TELEGRAM,
                          text=get_admin_stat('last active users'))
@@ -528,37 +697,75 @@ def admin_menu(call: CallbackQuery) -> None:
     elif call.data == 'uptime':
         bot.send_message(config.MY_TELEGRAM,
                          text=get_admin_stat('uptime'))
+    elif call.data == 'handler timings':
+        bot.send_message(config.MY_TELEGRAM,
+                         text=get_admin_stat('handler timings'))
+    elif call.data == 'geocoder':
+        bot.send_message(config.MY_TELEGRAM,
+                         text=get_admin_stat('geocoder'))
+    elif call.data == 'database':
+        bot.send_message(config.MY_TELEGRAM,
+                         text=get_admin_stat('database'))
+    elif call.data == 'charts':
+        bot.send_message(config.MY_TELEGRAM,
+                         text=get_admin_stat('charts'))
+    elif call.data == 'sender':
+        bot.send_message(config.MY_TELEGRAM,
+                         text=get_admin_stat('sender'))
+    elif call.data == 'downloader':
+        bot.send_message(config.MY_TELEGRAM,
+                         text=get_admin_stat('downloader'))
+    elif call.data == 'user writes':
+        bot.send_message(config.MY_TELEGRAM,
+                         text=get_admin_stat('user writes'))
+    elif call.data == 'exif pool':
+        bot.send_message(config.MY_TELEGRAM,
+                         text=get_admin_stat('exif pool'))
+    elif call.data in ('memory', 'memory diff', 'stop memory tracing'):
+        bot.send_message(config.MY_TELEGRAM,
+                         text=get_admin_stat(call.data))
+    elif call.data in ('profile sampling', 'profile cprofile'):
+        mode = call.data.split()[1]
+        if profiler.start(mode, config.PROFILE_SECONDS, send_profile):
+            text = (f'Profiling for {config.PROFILE_SECONDS:.0f} seconds, '
+                    f'the profile will come here.')
+        else:
+            text = 'The profiler is already working.'
+        bot.send_message(config.MY_TELEGRAM, text=text)
 
 
 @bot.message_handler(content_types=['photo'])
-def answer_photo_message(message: Message) -> None:
+@with_context()
+def answer_photo_message(message: Message, context: RequestContext) -> None:
     """
     Handles situations when user sends a photo as a photo not as a file,
     namely answers to him that he need to send his photo as a file
 
     :param message: Message objects from Telebot that contains all the data
     about user's message
+    :param context: info about the update such as the user who sent it
     :return: none
     """
-    user = users.find_one(message)
-    bot.send_message(user.chat_id, messages[user.language]['as_file'])
+    user = context.user
+    sender.send_message(user.chat_id, messages[user.language]['as_file'])
     log.info('%s sent photo as a photo.', user)
 
 
 def cache_function_result(func: Callable) -> Callable:
     when_was_called = None
     cache = {}
+    memory.register(f'Results of {func.__name__}', lambda: (cache,))
 
     def func_launcher(*args, **kwargs) -> Any:
         nonlocal when_was_called
         item_type = kwargs.get('item_type', None)
-        feature = kwargs.get('feature', None)
-        message = kwargs.get('message', None)
+        user = kwargs.get('user', None)
 
-        if item_type == 'country_ru' or item_type == 'country_en':
-            result_id = users.find_one(message).language + item_type
-        elif item_type or feature:
-            result_id = item_type or feature
+        # names of countries are in the language of the user
+        if item_type == 'country_code':
+            result_id = user.language + item_type
+        elif item_type:
+            result_id = item_type
         else:
             raise ValueError("Cannot find a key to cache your function")
 
@@ -581,22 +788,39 @@ def cache_function_result(func: Callable) -> Callable:
     return func_launcher
 
 
+def get_item_names(column: str, items: List[Any], language: str) -> List[str]:
+    """
+    Turns items of a chart into names to be shown to a user
+
+    :param column: column of photo_queries_table2 the items are from
+    :param items: ids of cameras or lenses or codes of countries
+    :param language: language of the user
+    :return: names of the items in the same order
+    """
+    if column == 'country_code':
+        return [country_resolver.get_name(item, language) for item in items]
+
+    dimension = {'camera_id': cameras, 'lens_id': lenses}.get(column)
+    if not dimension:
+        return [str(item) for item in items]
+    names = dimension.get_names(items)
+    return [names.get(item, str(item)) for item in items]
+
+
 @cache_function_result
-def get_most_popular_items(item_type: str, message: Message) -> str:
+def get_most_popular_items(item_type: str, user: User) -> str:
     """
     Get the most common cameras/lenses/countries from database and
     make list of them
 
     :param item_type: string with column name to choose between cameras,
     lenses and countries
-    :param message: telebot object with info about user and his message
+    :param user: user who asked for the list
     :return: string which is either list of most common
     cameras/lenses/countries or message which states that list is
     empty
     """
 
-    user = users.find_one(message)
-
     def tuple_to_ordered_str_list(list_of_gadgets: Tuple[Tuple[str]]) -> str:
         """
         Converts Python list to ordered list as a string
@@ -610,15 +834,20 @@ def get_most_popular_items(item_type: str, message: Message) -> str:
         :return: ordered list as a string
         """
 
+        items = [item[0] for item in list_of_gadgets if item[0]]
+        names = get_item_names(item_type, items, user.language)
         string_roaster = ''
-        index = 1
-        for item in list_of_gadgets:
-            if not item[0]:
-                continue
-            string_roaster += '{}. {}\n'.format(index, item[0])
-            index += 1
+        for index, name in enumerate(names, 1):
+            string_roaster += '{}. {}\n'.format(index, name)
         return string_roaster
 
+    if config.CHARTS_MODE == 'approximate' and chart_sketches.ready:
+        log.debug('Taking most popular things from the sketch...')
+        popular_items = chart_sketches.top(item_type, 30)
+        if not popular_items:
+            return messages[user.language]['no_top']
+        return tuple_to_ordered_str_list(popular_items)
+
     log.debug('Evaluating most popular things...')
 
     # This query returns item types in order where the first one item
@@ -648,75 +877,208 @@ def get_most_popular_items(item_type: str, message: Message) -> str:
     return tuple_to_ordered_str_list(popular_items[:30])
 
 
-@cache_function_result
-def get_number_users_by_feature(feature: str, feature_type: str) -> int:
+def get_recent_charts(window: int, user: User) -> str:
+    """
+    Makes charts of the most popular cameras, lenses and countries of the
+    last hours
+
+    :param window: number of hours, one of RollingCharts.WINDOWS
+    :param user: user who asked for the charts
+    :return: string with the charts or a message which states that they are
+    empty
     """
-    Get number of users that have same smartphone, camera, lens or that
-    have been to the same country
-    :param feature: string which is name of a particular feature e.g.
-    camera name or country name
-    :param feature_type: string which is name of the column in database
-    :return: string which is a message to user
+    if not rolling_charts.ready:
+        return messages[user.language]['doesnt work']
+
+    columns = ('camera_id', 'lens_id', 'country_code')
+    headers = messages[user.language]['recent_headers']
+
+    charts = []
+    for header, column in zip(headers, columns):
+        items = [item for item, count
+                 in rolling_charts.top(window, column, 10)]
+        if items:
+            names = get_item_names(column, items, user.language)
+            lines = '\n'.join(f'{index}. {name}'
+                              for index, name in enumerate(names, 1))
+            charts.append(f'{header}:\n{lines}')
+
+    if not charts:
+        return messages[user.language]['no_top']
+    return '\n\n'.join(charts)
+
+
+# number of users by "column=value" -> when it was counted, the number
+users_by_feature: Dict[str, Tuple[float, int]] = {}
+memory.register('Numbers of users by features', lambda: (users_by_feature,))
+
+
+def get_numbers_of_users_by_features(features: List[Tuple[str, Any]],
+                                     chat_id: int) -> List[int]:
+    """
+    Get numbers of other users that have same smartphones, cameras, lenses
+    or that have been to the same countries
+
+    Numbers are cached for CACHE_TIME minutes, the ones that are not in the
+    cache are counted by the database in one round-trip
+    :param features: names of columns in the database with particular
+    features in them e.g. ('camera_id', 12) or ('country_code', 'RU')
+    :param chat_id: id of the chat that has just saved its photos, the
+    numbers are read from the primary server, so that they count the photos
+    :return: numbers of users in the same order as features
     """
-    log.debug('Check how many users also have this feature: %s...',
-              feature)
+    now = time.monotonic()
+    numbers: Dict[str, int] = {}
+    missing: Dict[str, Tuple[str, Any]] = {}
+    for feature_type, feature in features:
+        key = f'{feature_type}={feature}'
+        cached = users_by_feature.get(key, None)
+        if cached and now - cached[0] < CACHE_TIME * 60:
+            numbers[key] = cached[1]
+        else:
+            missing[key] = feature_type, feature
+
+    if missing:
+        log.debug('Check how many users also have these features: %s...',
+                  list(missing))
+        queries = [("SELECT COUNT(DISTINCT chat_id) "
+                    "FROM photo_queries_table2 "
+                    f"WHERE {feature_type}=%s", (feature,))
+                   for feature_type, feature in missing.values()]
+        try:
+            results = db.execute_batch(queries, chat_id=chat_id)
+        except DatabaseConnectionError:
+            log.error("Cannot check how many users also have these "
+                      "features: %s...", list(missing))
+            raise
 
-    query = ("SELECT DISTINCT chat_id "
-             "FROM photo_queries_table2 "
-             f"WHERE {feature_type}=%s")
+        for key, rows in zip(missing, results):
+            # the user who has sent the photo is one of them
+            numbers[key] = max(rows[0][0] - 1, 0)
+            users_by_feature[key] = now, numbers[key]
 
-    parameters = feature,
+    return [numbers[f'{feature_type}={feature}']
+            for feature_type, feature in features]
 
-    try:
-        cursor = db.execute_query(query, parameters)
-    except DatabaseConnectionError:
-        log.error("Cannot check how many users also have this feature: %s...",
-                  feature)
-        raise
 
-    if not cursor.rowcount:
-        log.debug('There were no users with %s...', feature)
-        return 0
+@with_context()
+def handle_album(album: List[Message], context: RequestContext) -> None:
+    """
+    Answers to all the files of an album with one message
 
-    log.debug('There is %d users with %s', cursor.rowcount, feature)
-    return cursor.rowcount - 1
+    :param album: messages with files of one album
+    :param context: info about the user who sent the album
+    :return: None
+    """
+    user = context.user
+    processing = sender.reply_later(config.PROCESSING_MESSAGE_DELAY, album[0],
+                                    messages[user.language]['photo_prcs'])
+    log.info('%s sent an album of %d files.', user, len(album))
 
+    places, answer = AlbumMessage(album, user).prepare_answer()
+    sender.cancel(processing)
+    for latitude, longitude in places:
+        sender.send_location(user.chat_id, latitude, longitude,
+                             live_period=None)
+    sender.reply_to(album[0], answer, parse_mode='Markdown')
 
-@bot.message_handler(content_types=['document'])  # receive file
-def handle_message_with_image(message: Message) -> None:
 
-    user = users.find_one(message)
-    # Sending a message to a user that his photo is being processed
-    bot.reply_to(message, messages[user.language]['photo_prcs'])
+album_collector = AlbumCollector(handle_album)
+memory.register('Albums being collected', lambda: (album_collector.albums,))
+
+
+@bot.message_handler(content_types=['document'])  # receive file
+@with_context()
+def handle_message_with_image(message: Message,
+                              context: RequestContext) -> None:
+
+    # files of an album are answered together when all of them come
+    if message.media_group_id:
+        album_collector.add(message)
+        return
+
+    user = context.user
+    # Sending a message to a user that his photo is being processed, unless
+    # the answer is ready before he notices the wait
+    processing = sender.reply_later(config.PROCESSING_MESSAGE_DELAY, message,
+                                    messages[user.language]['photo_prcs'])
     log.info('%s sent photo as a file.', user)
 
     photo_message = PhotoMessage(message, user)
     answer = photo_message.prepare_answer()
+    sender.cancel(processing)
 
     # if longitude is in the answer
     if answer.coordinates:
         # extract longitude and latitude
-        bot.send_location(user.chat_id,
-                          answer.coordinates[0],
-                          answer.coordinates[1],
-                          live_period=None)
-        bot.reply_to(message, answer.answer, parse_mode='Markdown')
+        sender.send_location(user.chat_id,
+                             answer.coordinates[0],
+                             answer.coordinates[1],
+                             live_period=None)
+        sender.reply_to(message, answer.answer, parse_mode='Markdown')
     else:
-        bot.reply_to(message, answer.answer, parse_mode='Markdown')
+        sender.reply_to(message, answer.answer, parse_mode='Markdown')
+
+
+def start_services() -> None:
+    """
+    Caches users models, connects to the databases and starts background
+    threads. In the multi-process mode it is done in every worker
+
+    :return: None
+    """
+    # goes first, so that processes are forked before other threads start
+    exif_pool.start()
+    if config.PRELOAD_USERS:
+        users.preload()
+    else:
+        users.cache(100)
+    db.connect()
+    db.start_health_checker()
+    if config.CHARTS_MODE == 'approximate':
+        chart_sketches.start()
+    rolling_charts.start()
+    sender.start()
+    user_writes.start()
+
+
+def stop_services() -> None:
+    """
+    Stops background threads and closes connections of a worker
+
+    :return: None
+    """
+    album_collector.flush_all()
+    exif_pool.stop()
+    user_writes.stop()
+    sender.stop()
+    chart_sketches.stop()
+    rolling_charts.stop()
+    db.disconnect()
 
 
 def main() -> None:
     """
     The entry point of this bot.
 
-    Cleans log if needed, caches users models, connects to the databases,
-    starts the bot.
+    Cleans log if needed, starts the bot either in this process or with
+    config.WORKERS worker processes.
     :return: None
     """
     log_files.clean_log_folder(1)
-    users.cache(100)
-    db.connect()
-    bot.start_bot()
+    if config.WORKERS > 1:
+        Dispatcher(config.WORKERS, start_services, stop_services).run()
+        return
+
+    # SIGTERM stops polling the same way as Ctrl-C does, then services
+    # write and send what they keep in memory
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    start_services()
+    try:
+        bot.start_bot()
+    finally:
+        stop_services()
+        log.info('Auf Wiedersehen! Bot is turned off.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,122 @@
+"""
+Module that collects files of one album before they are handled.
+
+When a user sends several files at once (an album), Telegram sends every
+file as a separate message with the same media_group_id and there is no
+message that says that the album is over. So messages of an album are kept
+until there are no new ones for config.ALBUM_WINDOW seconds (but not longer
+than config.ALBUM_MAX_WAIT seconds since the first one) and then all of
+them are handled together.
+"""
+
+import time
+from threading import Lock, Timer
+from typing import Callable, Dict, List, Optional, Tuple
+
+# telebot goes as pyTelegramBotAPI in requirements
+from telebot.types import Message  # type: ignore
+
+from photogpsbot import log
+import config
+
+# Handles all messages of one album in the order they were sent
+AlbumHandler = Callable[[List[Message]], None]
+
+
+class Album:
+    """
+    Messages of one album that have come so far
+    """
+
+    def __init__(self) -> None:
+        self.messages: List[Message] = []
+        self.started = time.monotonic()
+        self.timer: Optional[Timer] = None
+
+
+class AlbumCollector:
+    """
+    Keeps messages of albums until all the files of an album come
+    """
+
+    def __init__(self, handle: AlbumHandler,
+                 window: float = config.ALBUM_WINDOW,
+                 max_wait: float = config.ALBUM_MAX_WAIT) -> None:
+        """
+        Init variables
+
+        :param handle: function that handles messages of an album
+        :param window: seconds to wait for the next message of an album
+        :param max_wait: the longest time to wait since the first message
+        """
+        self.handle = handle
+        self.window = window
+        self.max_wait = max_wait
+        self.albums: Dict[Tuple[int, str], Album] = {}
+        self.handled = 0
+        self._lock = Lock()
+
+    def _make_timer(self, key: Tuple[int, str], delay: float) -> Timer:
+        timer = Timer(delay, self._flush, args=(key,))
+        timer.daemon = True
+        return timer
+
+    def add(self, message: Message) -> None:
+        """
+        Adds a message to its album and postpones handling of the album
+
+        :param message: message with a file and media_group_id
+        :return: None
+        """
+        key = message.chat.id, message.media_group_id
+        with self._lock:
+            album = self.albums.get(key)
+            if album:
+                album.timer.cancel()
+                waited = time.monotonic() - album.started
+                delay = max(0.0, min(self.window, self.max_wait - waited))
+            else:
+                album = self.albums[key] = Album()
+                delay = self.window
+            album.messages.append(message)
+            album.timer = self._make_timer(key, delay)
+            album.timer.start()
+
+    def _flush(self, key: Tuple[int, str]) -> None:
+        """
+        Handles an album if it is still waiting
+
+        :param key: chat id and media group id of the album
+        :return: None
+        """
+        with self._lock:
+            album = self.albums.pop(key, None)
+        if not album:
+            return
+
+        log.info('Album %s from chat %d has %d files', key[1], key[0],
+                 len(album.messages))
+        self.handled += 1
+        messages = sorted(album.messages, key=lambda x: x.message_id)
+        try:
+            self.handle(messages)
+        except Exception as e:
+            log.error('Cannot handle album %s: %s', key[1], e)
+
+    def flush_all(self) -> None:
+        """
+        Handles all the albums that are waiting right now, for example when
+        the bot is turned off
+
+        :return: None
+        """
+        with self._lock:
+            keys = list(self.albums)
+            for key in keys:
+                self.albums[key].timer.cancel()
+        for key in keys:
+            self._flush(key)
+
+    def __str__(self) -> str:
+        return (f'{len(self.albums)} albums are waiting for files, '
+                f'{self.handled} have been handled')
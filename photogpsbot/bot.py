@@ -6,7 +6,7 @@ Use this module to get the bot to work and communicate with Telegram servers
 import requests
 import time
 from datetime import datetime
-import sys
+from multiprocessing.synchronize import Event
 from typing import Optional
 
 # goes as pyTelegramBotAPI in requirements
@@ -29,6 +29,9 @@ class TelegramBot(telebot.TeleBot):
 
         super().__init__(token, threaded, skip_pending, num_threads)
         self.start_time: Optional[datetime] = None
+        # is set when the bot runs in a worker process, so that turning the
+        # bot off stops the dispatcher and other workers too
+        self.shutdown_event: Optional[Event] = None
 
     def _run(self) -> None:
         """
@@ -66,14 +69,19 @@ class TelegramBot(telebot.TeleBot):
         """
         Safely turn the bot off and message to its admin
 
+        It only asks the bot to stop: polling ends (or the dispatcher stops
+        in the multi-process mode, workers handle updates that are in their
+        queues), then services are stopped by the code that has started
+        them. The handler that calls it returns as usual
+
         :return: None
         """
 
         self.send_message(chat_id=config.MY_TELEGRAM, text='bye')
         log.info('Please wait for a sec, bot is turning off...')
+        if self.shutdown_event:
+            self.shutdown_event.set()
         self.stop_polling()
-        log.info('Auf Wiedersehen! Bot is turned off.')
-        sys.exit()
 
     def __str__(self) -> str:
         return ('Instance of a Telegram bot. '
@@ -0,0 +1,266 @@
+"""
+Command line tool that runs a lot of photos through the same pipeline as the
+bot does and stores info about them in photo_queries_table2.
+
+It is useful to seed statistics, to reprocess history after the collation
+of camera names was changed or to load test the bot. Photos are taken from a
+folder or from a tarball and processed by a pool of processes, rows are added
+to the database in large batches. Names of processed files are written to a
+progress file, so an interrupted import can be resumed.
+
+Usage:
+python -m photogpsbot.bulk_import path/to/photos [--workers 4] [--dry-run]
+"""
+
+import argparse
+import os
+import tarfile
+import time
+from io import BytesIO
+from itertools import islice
+from multiprocessing import Pool
+from typing import Iterator, List, Optional, Set, Tuple, Union
+
+from photogpsbot import log, db, User, geocoder
+from photogpsbot.geocoder import StubProvider
+from photogpsbot.process_image import ImageHandler, ImageData, NoData, NoEXIF
+from photogpsbot import photo_queries
+import config
+
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.tif', '.tiff', '.dng', '.nef', '.cr2',
+                    '.arw', '.orf', '.rw2', '.pef', '.heic')
+
+# name of a photo and either a path to it or its content
+Item = Tuple[str, Union[str, bytes]]
+# name of a photo, its size in bytes and info from it if there is any
+Result = Tuple[str, int, Optional[ImageData]]
+
+# User on behalf of whom photos are processed in worker processes
+_user: Optional[User] = None
+
+
+def _init_worker(chat_id: int, language: str, geocode: bool,
+                 workers: int) -> None:
+    """
+    Prepares a worker process
+
+    :param chat_id: Telegram id of a user on behalf of whom photos are added
+    :param language: language of the user
+    :param geocode: whether to use the online geocoder. Only the country is
+    stored and it is mostly found out offline, so by default the online
+    geocoder is not used in order not to flood it from many processes
+    :param workers: number of worker processes
+    :return: None
+    """
+    global _user
+    _user = User(chat_id, None, None, None, language)
+    # Every process needs its own connection to the database
+    db.conn = None
+    if not geocode:
+        geocoder.provider = StubProvider()
+    else:
+        # every process has its own rate limiter, together they must not
+        # ask the geocoder more often than the bot alone does
+        geocoder.rate_limiter.interval = config.GEOCODER_INTERVAL * workers
+
+
+def _process(item: Item) -> Result:
+    """
+    Gets info out of one photo
+
+    :param item: name of a photo and either path to it or its content
+    :return: name of the photo, its size and info from it
+    """
+    name, source = item
+    if isinstance(source, bytes):
+        content = source
+    else:
+        with open(source, 'rb') as file:
+            content = file.read()
+
+    try:
+        image_data = ImageHandler(_user, BytesIO(content)).get_image_info()
+    except (NoData, NoEXIF):
+        image_data = None
+    except Exception as e:
+        log.error('Cannot process %s: %s', name, e)
+        image_data = None
+
+    return name, len(content), image_data
+
+
+def _is_photo(name: str) -> bool:
+    """
+    Checks by the extension whether a file is a photo
+
+    :param name: name of the file
+    :return: True if it is a photo
+    """
+    return name.lower().endswith(PHOTO_EXTENSIONS)
+
+
+def find_photos(source: str, done: Set[str]) -> Iterator[Item]:
+    """
+    Finds photos in a folder or in a tarball
+
+    :param source: path to a folder or to a tarball with photos
+    :param done: names of photos that have been already imported
+    :return: iterator over names of photos with either paths to them or
+    their content
+    """
+    if os.path.isdir(source):
+        for root, folders, files in os.walk(source):
+            folders.sort()
+            for file in sorted(files):
+                path = os.path.join(root, file)
+                if _is_photo(file) and path not in done:
+                    yield path, path
+        return
+
+    with tarfile.open(source, 'r:*') as tarball:
+        for member in tarball:
+            if (member.isfile() and _is_photo(member.name) and
+                    member.name not in done):
+                yield member.name, tarball.extractfile(member).read()
+
+
+def read_progress(progress_file: str) -> Set[str]:
+    """
+    Reads names of photos that have been already imported
+
+    :param progress_file: path to the progress file
+    :return: set with names of the photos
+    """
+    if not os.path.exists(progress_file):
+        return set()
+
+    with open(progress_file, 'r', encoding='utf8') as file:
+        return {line.rstrip('\n') for line in file if line.strip()}
+
+
+class Throughput:
+    """
+    Counts how many files and megabytes are processed per second
+    """
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.files = 0
+        self.size = 0  # in bytes
+        self.with_data = 0
+
+    def add(self, results: List[Result]) -> None:
+        """
+        Counts one more batch of processed photos
+
+        :param results: results of processing of the photos
+        :return: None
+        """
+        self.files += len(results)
+        self.size += sum(size for name, size, image_data in results)
+        self.with_data += sum(1 for result in results if result[2])
+
+    def __str__(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        megabytes = self.size / 1024**2
+        return (f'{self.files} files ({self.with_data} with data), '
+                f'{megabytes:.1f} MB in {elapsed:.1f} s: '
+                f'{self.files / elapsed:.1f} files/s, '
+                f'{megabytes / elapsed:.2f} MB/s')
+
+
+def run(source: str, workers: int, batch_size: int, progress_file: str,
+        dry_run: bool, chat_id: int, language: str, geocode: bool) -> None:
+    """
+    Imports photos into photo_queries_table2
+
+    :param source: path to a folder or to a tarball with photos
+    :param workers: number of processes that parse photos
+    :param batch_size: number of rows to add to the database in one go
+    :param progress_file: path to a file with names of imported photos
+    :param dry_run: if True, photos are processed, but nothing is written
+    :param chat_id: Telegram id of a user on behalf of whom photos are added
+    :param language: language of the user
+    :param geocode: whether to use the online geocoder
+    :return: None
+    """
+    done = read_progress(progress_file)
+    if done:
+        log.info('Skipping %d photos that have been already imported',
+                 len(done))
+
+    throughput = Throughput()
+    photos = find_photos(source, done)
+
+    # The pool is created before the main process connects to the database,
+    # so that worker processes don't inherit its connection
+    with Pool(workers, initializer=_init_worker,
+              initargs=(chat_id, language, geocode, workers)) as pool, \
+            open(progress_file, 'a', encoding='utf8') as progress:
+        while True:
+            # Photos are taken by batches in order not to read the whole
+            # tarball into memory
+            batch = list(islice(photos, batch_size))
+            if not batch:
+                break
+
+            results = list(pool.imap_unordered(_process, batch, chunksize=4))
+            images = [image_data for name, size, image_data in results
+                      if image_data]
+
+            if not dry_run:
+                if images:
+                    photo_queries.save_many(images)
+                progress.writelines(f'{name}\n' for name, size, image_data
+                                    in results)
+                progress.flush()
+
+            throughput.add(results)
+            log.info('Imported so far: %s', throughput)
+
+    log.info('Import has been finished%s. %s',
+             ' (dry run)' if dry_run else '', throughput)
+    print(throughput)
+
+
+def main() -> None:
+    """
+    Parses command line arguments and starts the import
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(
+        description='Add info about photos from a folder or a tarball to '
+                    'the statistics of the bot')
+    parser.add_argument('source', help='folder or tarball with photos')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes that parse photos')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='number of rows to add to the database at once')
+    parser.add_argument('--progress', default='bulk_import.progress',
+                        help='file to keep track of imported photos in')
+    parser.add_argument('--dry-run', action='store_true',
+                        help="process photos, but don't write anything")
+    parser.add_argument('--chat-id', type=int,
+                        help='Telegram id of a user to add photos on behalf '
+                             'of, the admin by default')
+    parser.add_argument('--language', default='en-US',
+                        help='language of the user')
+    parser.add_argument('--geocode', action='store_true',
+                        help='use the online geocoder for countries that '
+                             "can't be found out offline")
+    args = parser.parse_args()
+
+    chat_id = args.chat_id
+    if chat_id is None:
+        if not config.MY_TELEGRAM:
+            parser.error('--chat-id is required when MY_TELEGRAM is not set')
+        chat_id = int(config.MY_TELEGRAM)
+
+    run(args.source, args.workers, args.batch_size, args.progress,
+        args.dry_run, chat_id, args.language, args.geocode)
+    db.disconnect()
+
+
+if __name__ == '__main__':
+    main()
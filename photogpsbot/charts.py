@@ -0,0 +1,583 @@
+"""
+Module that keeps charts of the most popular cameras, lenses and countries in
+memory, so they can be shown without grouping the whole
+photo_queries_table2.
+
+Every chart is a Space-Saving sketch: it counts not more than a given number
+of items, and when a new item comes and there is no room for it, it takes
+the place of the least counted one and inherits its count. Counts of items
+can be overestimated but not more than by the count of the least counted
+item, which is not more than the number of all photos divided by the
+capacity, while the head of a chart stays accurate, and that is the only
+part that is shown to users.
+
+Charts of the last days are counted exactly by hours in memory.
+
+Both kinds of charts get a row as soon as the process adds it and also read
+rows that have been added by other processes (other workers of the bot or
+bulk_import) from the table by their ids, so every row is counted once.
+Rows are read from the primary server, replicas can be behind. Ids are
+given out when rows are inserted, but a transaction with a smaller id can
+be committed after a bigger id has been read, so ids that are missing below
+the last read one are kept for GAP_TIMEOUT seconds and looked up again. A
+row committed even later than that is not counted.
+Sketches are saved to a snapshot file from time to time, so after a restart
+only rows added since the last snapshot are read from the database.
+"""
+
+import heapq
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from photogpsbot import log, db
+import config
+
+# columns of photo_queries_table2 that charts are made for
+CHART_COLUMNS = ('camera_id', 'lens_id', 'country_code')
+
+# id of a camera or a lens or a code of a country
+Item = Union[int, str]
+
+# an item, its count and how much the count can be overestimated
+ChartItem = Tuple[Item, int, int]
+
+# seconds during which a missing id is looked up again. Ids can be missing
+# for good too: inserts that have been rolled back, deleted rows
+GAP_TIMEOUT = 600
+# missing ids that are kept at most, the smallest ones are given up first
+MAX_GAPS = 1000
+
+ROWS_QUERY = ('SELECT id, UNIX_TIMESTAMP(time), '
+              f'{", ".join(CHART_COLUMNS)} '
+              'FROM photo_queries_table2 ')
+
+
+class SpaceSaving:
+    """
+    Approximate counter of the most frequent items in a stream that keeps
+    not more than capacity items
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        # item -> [count, error]
+        self.counters: Dict[Item, List[int]] = {}
+        self.total = 0
+
+    def add(self, item: Item, count: int = 1) -> None:
+        """
+        Counts an item
+
+        :param item: id or code of the item
+        :param count: how many times it occurred
+        :return: None
+        """
+        self.total += count
+        counter = self.counters.get(item)
+        if counter:
+            counter[0] += count
+            return
+
+        if len(self.counters) < self.capacity:
+            self.counters[item] = [count, 0]
+            return
+
+        # The least counted item gives its place to the new one. It takes
+        # O(capacity), but only for items that are not in the sketch yet
+        least = min(self.counters, key=lambda key: self.counters[key][0])
+        least_count = self.counters.pop(least)[0]
+        self.counters[item] = [least_count + count, least_count]
+
+    def top(self, number: int) -> List[ChartItem]:
+        """
+        Gives the most frequent items
+
+        :param number: how many items to give
+        :return: list of items with their counts and errors ordered from the
+        most frequent one
+        """
+        items = heapq.nlargest(number, self.counters.items(),
+                               key=lambda pair: pair[1][0])
+        return [(item, count, error) for item, (count, error) in items]
+
+    @property
+    def error_bound(self) -> int:
+        """
+        Maximum overestimation of a count of any item in the sketch
+
+        :return: the bound, 0 means that counts are exact
+        """
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(count for count, error in self.counters.values())
+
+    def to_dict(self) -> dict:
+        # keys of JSON objects are always strings, so counters are saved as
+        # a list to keep integer ids integer
+        return {'capacity': self.capacity,
+                'total': self.total,
+                'counters': [[item, count, error] for item, (count, error)
+                             in self.counters.items()]}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'SpaceSaving':
+        sketch = cls(data['capacity'])
+        sketch.total = data['total']
+        sketch.counters = {item: [count, error]
+                           for item, count, error in data['counters']}
+        return sketch
+
+
+class TableCounter(ABC):
+    """
+    Base class for charts that count every row of photo_queries_table2
+    exactly once
+
+    Rows that this process adds are counted at once, the rest are read from
+    the table by their ids from time to time
+    """
+    name = 'charts'
+
+    def __init__(self, refresh_interval: float) -> None:
+        """
+        Init variables
+
+        :param refresh_interval: seconds between reading new rows from the
+        table
+        """
+        self.refresh_interval = refresh_interval
+        # all rows with ids up to this one have been counted
+        self.last_id = 0
+        # ids of rows after last_id that have been counted as soon as they
+        # were added
+        self.counted_ahead: Set[int] = set()
+        # ids below last_id that were missing when the table was read and
+        # time.monotonic() when they were noticed
+        self.gaps: Dict[int, float] = {}
+        # whether charts have caught up with the table after a start
+        self.ready = False
+        self.running = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    @abstractmethod
+    def _count(self, timestamp: float,
+               items: Tuple[Optional[Item], ...]) -> None:
+        """
+        Adds values of one row to the charts
+
+        :param timestamp: when the row has been added, seconds since the
+        epoch
+        :param items: values of the row for every column in CHART_COLUMNS
+        :return: None
+        """
+
+    def add(self, row_id: Optional[int],
+            items: Tuple[Optional[Item], ...]) -> None:
+        """
+        Counts a row that has just been added to photo_queries_table2
+
+        :param row_id: id of the row
+        :param items: values of the row for every column in CHART_COLUMNS
+        :return: None
+        """
+        if not self.running or not row_id:
+            return
+
+        with self._lock:
+            if row_id in self.gaps:
+                del self.gaps[row_id]
+            elif row_id <= self.last_id or row_id in self.counted_ahead:
+                return
+            else:
+                self.counted_ahead.add(row_id)
+            self._count(time.time(), items)
+
+    def _note_gaps(self, previous_id: int, row_id: int,
+                   timestamp: float) -> None:
+        """
+        Remembers ids that are missing between two rows that have been read
+
+        :param previous_id: id of the previous row or last_id
+        :param row_id: id of the row that has been read
+        :param timestamp: when the row has been added, seconds since the
+        epoch. Rows with smaller ids are added at about the same time, so
+        there is no need to wait for them before old rows
+        :return: None
+        """
+        if row_id - previous_id <= 1 or timestamp < time.time() - GAP_TIMEOUT:
+            return
+        now = time.monotonic()
+        for gap in range(max(previous_id + 1, row_id - MAX_GAPS), row_id):
+            self.gaps[gap] = now
+
+    def _recheck_gaps(self) -> int:
+        """
+        Counts rows with ids that were missing when the table was read and
+        have been committed since then
+
+        :return: number of rows that have been counted
+        """
+        with self._lock:
+            oldest = time.monotonic() - GAP_TIMEOUT
+            gaps = sorted(gap for gap, noticed in self.gaps.items()
+                          if noticed > oldest)[-MAX_GAPS:]
+            self.gaps = {gap: self.gaps[gap] for gap in gaps}
+        if not gaps:
+            return 0
+
+        placeholders = ', '.join(['%s'] * len(gaps))
+        cursor = db.execute_query(ROWS_QUERY + f'WHERE id IN ({placeholders})',
+                                  tuple(gaps), primary=True)
+        counted = 0
+        with self._lock:
+            for row_id, timestamp, *items in cursor.fetchall():
+                # add() could have counted it in the meantime
+                if self.gaps.pop(row_id, None) is not None:
+                    self._count(float(timestamp), items)
+                    counted += 1
+        return counted
+
+    def catch_up(self, batch_size: int = 10000) -> int:
+        """
+        Counts rows that have not been counted yet, they are read from the
+        database by their ids
+
+        :param batch_size: how many rows to read in one query
+        :return: number of rows that have been counted
+        """
+        query = ROWS_QUERY + 'WHERE id > %s ORDER BY id LIMIT %s'
+        counted = self._recheck_gaps()
+        while True:
+            cursor = db.execute_query(query, (self.last_id, batch_size),
+                                      primary=True)
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            with self._lock:
+                previous_id = self.last_id
+                for row_id, timestamp, *items in rows:
+                    self._note_gaps(previous_id, row_id, float(timestamp))
+                    previous_id = row_id
+                    if row_id in self.counted_ahead:
+                        self.counted_ahead.discard(row_id)
+                    else:
+                        self._count(float(timestamp), items)
+                        counted += 1
+                self.last_id = rows[-1][0]
+                # every row up to last_id has been read from the table
+                self.counted_ahead = {row_id for row_id in self.counted_ahead
+                                      if row_id > self.last_id}
+
+            if len(rows) < batch_size:
+                break
+
+        return counted
+
+    def _prepare(self) -> None:
+        """
+        Is called once in the thread of the charts before they start reading
+        the table
+
+        :return: None
+        """
+
+    def _after_refresh(self) -> None:
+        """
+        Is called every time after new rows have been read
+
+        :return: None
+        """
+
+    def start(self) -> None:
+        """
+        Starts a thread that loads the charts and keeps them up to date with
+        the table
+
+        :return: None
+        """
+        self.running = True
+        self._stop.clear()
+        thread = threading.Thread(target=self._run, name=self.name,
+                                  daemon=True)
+        thread.start()
+
+    def _run(self) -> None:
+        """
+        Body of the thread of the charts
+
+        :return: None
+        """
+        try:
+            self._prepare()
+        except Exception as e:
+            log.error('Cannot prepare %s: %s', self.name, e)
+
+        while True:
+            try:
+                counted = self.catch_up()
+                if counted or not self.ready:
+                    log.info('%s: counted %d rows from the database',
+                             self.name, counted)
+                    self.ready = True
+                self._after_refresh()
+            except Exception as e:
+                log.error('Cannot update %s: %s', self.name, e)
+
+            if self._stop.wait(self.refresh_interval):
+                break
+
+    def stop(self) -> None:
+        """
+        Stops the thread
+
+        :return: None
+        """
+        self.running = False
+        self._stop.set()
+
+
+class ChartSketches(TableCounter):
+    """
+    Sketches for every chart of all time
+    """
+    name = 'approximate charts'
+
+    def __init__(self, snapshot_file: str, capacity: int) -> None:
+        """
+        Init variables
+
+        :param snapshot_file: path to the file where sketches are saved
+        :param capacity: how many items every sketch can hold
+        """
+        super().__init__(config.CHART_SNAPSHOT_INTERVAL)
+        self.snapshot_file = snapshot_file
+        self.capacity = capacity
+        self.sketches = {column: SpaceSaving(capacity)
+                         for column in CHART_COLUMNS}
+
+    def _count(self, timestamp: float,
+               items: Tuple[Optional[Item], ...]) -> None:
+        for column, item in zip(CHART_COLUMNS, items):
+            if item:
+                self.sketches[column].add(item)
+
+    def load_snapshot(self) -> bool:
+        """
+        Loads sketches from the snapshot file
+
+        :return: True if they have been loaded
+        """
+        if not os.path.exists(self.snapshot_file):
+            return False
+
+        try:
+            with open(self.snapshot_file, 'r', encoding='utf8') as file:
+                snapshot = json.load(file)
+            sketches = {column: SpaceSaving.from_dict(snapshot['sketches']
+                                                      [column])
+                        for column in CHART_COLUMNS}
+        except (ValueError, KeyError, OSError) as e:
+            log.warning('Cannot load snapshot of charts: %s', e)
+            return False
+
+        if any(sketch.capacity != self.capacity
+               for sketch in sketches.values()):
+            log.info('Capacity of charts has been changed, the snapshot is '
+                     'not used')
+            return False
+
+        with self._lock:
+            self.sketches = sketches
+            self.last_id = snapshot['last_id']
+            self.counted_ahead = set(snapshot['counted_ahead'])
+            now = time.monotonic()
+            self.gaps = {gap: now for gap in snapshot.get('gaps', [])}
+        log.info('Charts have been loaded from the snapshot up to row %d',
+                 self.last_id)
+        return True
+
+    def save_snapshot(self) -> None:
+        """
+        Saves sketches to the snapshot file
+
+        :return: None
+        """
+        with self._lock:
+            snapshot = {'last_id': self.last_id,
+                        'counted_ahead': sorted(self.counted_ahead),
+                        'gaps': sorted(self.gaps),
+                        'sketches': {column: sketch.to_dict()
+                                     for column, sketch
+                                     in self.sketches.items()}}
+
+        # write to another file first in order not to leave a broken
+        # snapshot if the bot stops in the middle. Several workers of the
+        # bot can save snapshots at the same time, so every process has its
+        # own temporary file
+        temp_file = f'{self.snapshot_file}.{os.getpid()}.tmp'
+        with open(temp_file, 'w', encoding='utf8') as file:
+            json.dump(snapshot, file, ensure_ascii=False)
+        os.replace(temp_file, self.snapshot_file)
+        log.debug('Snapshot of charts has been saved')
+
+    def _prepare(self) -> None:
+        self.load_snapshot()
+
+    def _after_refresh(self) -> None:
+        self.save_snapshot()
+
+    def stop(self) -> None:
+        """
+        Stops the thread and saves the last snapshot
+
+        :return: None
+        """
+        if not self.running:
+            return
+        super().stop()
+        if self.ready:
+            self.save_snapshot()
+
+    def top(self, column: str, number: int) -> List[ChartItem]:
+        """
+        Gives the head of a chart
+
+        :param column: column of photo_queries_table2 the chart is made for
+        :param number: how many items to give
+        :return: list of items with their counts and errors
+        """
+        with self._lock:
+            return self.sketches[column].top(number)
+
+    def __str__(self) -> str:
+        if not self.running:
+            return 'Charts are counted exactly by the database.'
+
+        state = 'ready' if self.ready else 'warming up'
+        charts = '\n'.join(f'{column}: {len(sketch.counters)} items, '
+                           f'{sketch.total} photos, error not more than '
+                           f'{sketch.error_bound}'
+                           for column, sketch in self.sketches.items())
+        return (f'Approximate charts are {state}, counted rows up to id '
+                f'{self.last_id}.\n{charts}')
+
+
+class RollingCharts(TableCounter):
+    """
+    Charts of the last 24 hours, 7 days and 30 days
+
+    Rows are counted in buckets by hour. Every window keeps totals of its
+    buckets, when an hour goes out of a window, counts of its bucket are
+    subtracted from the totals of the window, so answering never needs to
+    look at all buckets or at the table
+    """
+    name = 'charts of recent days'
+    # length of windows in hours
+    WINDOWS = (24, 7 * 24, 30 * 24)
+
+    def __init__(self) -> None:
+        super().__init__(config.CHARTS_REFRESH_INTERVAL)
+        # hour since the epoch -> column -> item -> count
+        self.buckets: Dict[int, Dict[str, Counter]] = {}
+        # window -> column -> item -> count
+        self.totals = {window: {column: Counter() for column in CHART_COLUMNS}
+                       for window in self.WINDOWS}
+        # the latest hour that windows end with
+        self.current_hour = int(time.time() // 3600)
+
+    def _advance(self, hour: int) -> None:
+        """
+        Moves windows to end with a given hour and subtracts buckets that
+        have gone out of them
+
+        :param hour: hour since the epoch
+        :return: None
+        """
+        if hour <= self.current_hour:
+            return
+
+        for window, columns in self.totals.items():
+            if hour - window >= self.current_hour:
+                # the whole window has gone
+                for total in columns.values():
+                    total.clear()
+                continue
+
+            for gone_hour in range(self.current_hour - window + 1,
+                                   hour - window + 1):
+                bucket = self.buckets.get(gone_hour)
+                if not bucket:
+                    continue
+                for column, counts in bucket.items():
+                    total = columns[column]
+                    total.subtract(counts)
+                    for item in counts:
+                        if total[item] <= 0:
+                            del total[item]
+
+        oldest = hour - max(self.WINDOWS)
+        for old_hour in [old_hour for old_hour in self.buckets
+                         if old_hour <= oldest]:
+            del self.buckets[old_hour]
+        self.current_hour = hour
+
+    def _count(self, timestamp: float,
+               items: Tuple[Optional[Item], ...]) -> None:
+        hour = int(timestamp // 3600)
+        self._advance(hour)
+        age = self.current_hour - hour
+        if age >= max(self.WINDOWS):
+            return
+
+        bucket = self.buckets.setdefault(
+            hour, {column: Counter() for column in CHART_COLUMNS})
+        for column, item in zip(CHART_COLUMNS, items):
+            if not item:
+                continue
+            bucket[column][item] += 1
+            for window in self.WINDOWS:
+                if age < window:
+                    self.totals[window][column][item] += 1
+
+    def _prepare(self) -> None:
+        """
+        Skips rows that are older than the longest window, so that only the
+        last days are read from the table when the bot starts
+
+        :return: None
+        """
+        since = time.time() - max(self.WINDOWS) * 3600
+        cursor = db.execute_query('SELECT MAX(id) FROM photo_queries_table2 '
+                                  'WHERE time <= FROM_UNIXTIME(%s)', (since,))
+        last_old_id = cursor.fetchone()[0] or 0
+        with self._lock:
+            self.last_id = max(self.last_id, last_old_id)
+
+    def top(self, window: int, column: str,
+            number: int) -> List[Tuple[Item, int]]:
+        """
+        Gives the head of a chart of a window
+
+        :param window: length of the window in hours, one of WINDOWS
+        :param column: column of photo_queries_table2 the chart is made for
+        :param number: how many items to give
+        :return: list of items with their counts
+        """
+        with self._lock:
+            self._advance(int(time.time() // 3600))
+            return self.totals[window][column].most_common(number)
+
+    def __str__(self) -> str:
+        state = 'ready' if self.ready else 'warming up'
+        windows = ', '.join(
+            f'{window} h: {sum(self.totals[window]["camera_id"].values())}'
+            f' cameras' for window in self.WINDOWS)
+        return (f'Charts of recent days are {state}, {len(self.buckets)} '
+                f'hourly buckets. {windows}')
@@ -0,0 +1,294 @@
+"""
+Module that finds out in which country a point is located without any
+requests to online services.
+
+It uses country borders that come with the bot (Natural Earth 1:110m admin-0
+countries, public domain) and a table of localized names of countries by
+their ISO 3166-1 alpha-2 codes. Borders are put into a grid of one degree
+cells, so for the most of points the country is known right from the cell;
+only points in cells that are crossed by a border are tested against
+polygons of the countries around.
+"""
+
+import json
+import math
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from photogpsbot import log
+
+Segment = Tuple[float, float, float, float]
+Cell = Tuple[int, int]
+
+
+def _to_cell(longitude: float, latitude: float) -> Cell:
+    """
+    Returns the grid cell a point belongs to
+
+    :param longitude: longitude of the point in decimal degrees
+    :param latitude: latitude of the point in decimal degrees
+    :return: tuple with indexes of the cell
+    """
+    return (min(int(math.floor(longitude)) + 180, 359),
+            min(int(math.floor(latitude)) + 90, 179))
+
+
+def _crossings(segments: List[Segment], latitude: float) -> List[float]:
+    """
+    Finds where a horizontal line crosses borders of a polygon
+
+    :param segments: segments of the border and holes of a polygon
+    :param latitude: latitude of the horizontal line
+    :return: sorted list of longitudes of the crossings
+    """
+    crossings = []
+    for x1, y1, x2, y2 in segments:
+        if (y1 > latitude) != (y2 > latitude):
+            crossings.append(x1 + (latitude - y1) * (x2 - x1) / (y2 - y1))
+    crossings.sort()
+    return crossings
+
+
+@dataclass
+class CountryPart:
+    """
+    One polygon of a country (a country can consist of many of them,
+    islands for example) with its bounding box
+
+    Segments of its border are grouped by rows of the grid, so a point is
+    tested only against the segments at the same latitude
+    """
+    code: str
+    min_lon: float
+    min_lat: float
+    max_lon: float
+    max_lat: float
+    rows: Dict[int, List[Segment]] = field(default_factory=dict)
+
+    def contains(self, longitude: float, latitude: float) -> bool:
+        """
+        Checks whether the point is inside of the polygon
+
+        :param longitude: longitude of the point in decimal degrees
+        :param latitude: latitude of the point in decimal degrees
+        :return: True if the point is inside of the polygon
+        """
+        if not (self.min_lon <= longitude <= self.max_lon and
+                self.min_lat <= latitude <= self.max_lat):
+            return False
+
+        row = _to_cell(longitude, latitude)[1]
+        crossings = _crossings(self.rows.get(row, []), latitude)
+        return bisect_right(crossings, longitude) % 2 == 1
+
+    def distance(self, longitude: float, latitude: float) -> float:
+        """
+        Approximate distance from the point to the border of the polygon
+
+        Only segments in the row of the point and rows next to it are taken
+        into account as the bot does not need anything farther than that
+
+        :param longitude: longitude of the point in decimal degrees
+        :param latitude: latitude of the point in decimal degrees
+        :return: distance in degrees of latitude
+        """
+        scale = math.cos(math.radians(latitude))
+        x = longitude * scale
+        row = _to_cell(longitude, latitude)[1]
+        shortest = math.inf
+        for near_row in (row - 1, row, row + 1):
+            for x1, y1, x2, y2 in self.rows.get(near_row, ()):
+                x1, x2 = x1 * scale, x2 * scale
+                dx, dy = x2 - x1, y2 - y1
+                length = dx * dx + dy * dy
+                t = 0.0
+                if length:
+                    t = max(0.0, min(1.0, ((x - x1) * dx +
+                                           (latitude - y1) * dy) / length))
+                shortest = min(shortest, math.hypot(x1 + t * dx - x,
+                                                    y1 + t * dy - latitude))
+        return shortest
+
+
+class CountryResolver:
+    """
+    Finds a country by coordinates and gives its name in different languages
+
+    Borders are read and indexed on the first lookup so that the bot does not
+    spend time on it if there are no photos with coordinates
+    """
+
+    # how far from the closest border a point can be to still count as being
+    # in that country. Borders are simplified, so points on the coast can
+    # turn out to be slightly in the sea
+    tolerance = 0.25  # in degrees
+
+    def __init__(self, borders_file: str, names_file: str) -> None:
+        self.borders_file = borders_file
+        with open(names_file, 'r', encoding='utf8') as json_file:
+            self.names: Dict[str, Dict[str, str]] = json.load(json_file)
+
+        self.parts: List[CountryPart] = []
+        # cells that are entirely inside of one country
+        self.whole_cells: Dict[Cell, str] = {}
+        # cells crossed by borders with indexes of parts that cross them
+        self.border_cells: Dict[Cell, List[int]] = {}
+        self.loaded = False
+        self.available = True
+        self._lock = Lock()
+
+    def _load(self) -> None:
+        """
+        Reads borders of countries from a GeoJSON file and builds the grid
+
+        :return: None
+        """
+        log.debug('Loading borders of countries from %s...',
+                  self.borders_file)
+        try:
+            with open(self.borders_file, 'r', encoding='utf8') as file:
+                features = json.load(file)['features']
+        except (OSError, ValueError, KeyError) as e:
+            log.error(e)
+            log.error('Cannot load borders of countries. Countries will be '
+                      'found out by the online geocoder.')
+            self.available = False
+            return
+
+        inside_cells: Dict[Cell, List[int]] = {}
+        for feature in features:
+            code = feature['properties']['iso_a2']
+            geometry = feature['geometry']
+            polygons = (geometry['coordinates']
+                        if geometry['type'] == 'MultiPolygon'
+                        else [geometry['coordinates']])
+            for polygon in polygons:
+                # the first ring is the border, the others are holes
+                longitudes = [point[0] for point in polygon[0]]
+                latitudes = [point[1] for point in polygon[0]]
+                part = CountryPart(code, min(longitudes), min(latitudes),
+                                   max(longitudes), max(latitudes))
+                self.parts.append(part)
+                self._index_part(len(self.parts) - 1, part, polygon,
+                                 inside_cells)
+
+        # A cell can be inside of one country and still be crossed by borders
+        # of another one that has no hole for it in the first one, then
+        # points in this cell have to be tested against both of them
+        for cell, indexes in inside_cells.items():
+            if cell in self.border_cells:
+                self.border_cells[cell].extend(indexes)
+            else:
+                self.whole_cells[cell] = self.parts[indexes[0]].code
+
+        log.info('Borders of %d countries have been loaded, %d cells of '
+                 'the grid are within one country.', len(features),
+                 len(self.whole_cells))
+
+    def _index_part(self, index: int, part: CountryPart,
+                    rings: List[List[List[float]]],
+                    inside_cells: Dict[Cell, List[int]]) -> None:
+        """
+        Puts one polygon into the grid
+
+        Cells that are touched by borders of the polygon get the index of the
+        polygon, cells that are not touched and whose centers are inside of
+        the polygon are entirely inside it
+
+        :param index: index of the polygon in self.parts
+        :param part: the polygon
+        :param rings: coordinates of the border and holes of the polygon
+        :param inside_cells: dictionary to add cells that are entirely
+        inside of the polygon to
+        :return: None
+        """
+        touched = set()
+        for ring in rings:
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+                left, bottom = _to_cell(min(x1, x2), min(y1, y2))
+                right, top = _to_cell(max(x1, x2), max(y1, y2))
+                for y in range(bottom, top + 1):
+                    part.rows.setdefault(y, []).append((x1, y1, x2, y2))
+                    for x in range(left, right + 1):
+                        touched.add((x, y))
+
+        for cell in touched:
+            self.border_cells.setdefault(cell, []).append(index)
+
+        left, bottom = _to_cell(part.min_lon, part.min_lat)
+        right, top = _to_cell(part.max_lon, part.max_lat)
+        for y in range(bottom, top + 1):
+            crossings = _crossings(part.rows.get(y, []), y - 90 + 0.5)
+            for x in range(left, right + 1):
+                if (x, y) in touched:
+                    continue
+                if bisect_right(crossings, x - 180 + 0.5) % 2 == 1:
+                    inside_cells.setdefault((x, y), []).append(index)
+
+    def find_code(self, latitude: float, longitude: float) -> Optional[str]:
+        """
+        Finds out in which country the point is located
+
+        :param latitude: latitude of the point in decimal degrees
+        :param longitude: longitude of the point in decimal degrees
+        :return: ISO 3166-1 alpha-2 code of the country or None if the point
+        is not in any country, for example in the middle of an ocean
+        """
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self._load()
+                    self.loaded = True
+        if not self.available:
+            return None
+
+        cell = _to_cell(longitude, latitude)
+        code = self.whole_cells.get(cell, None)
+        if code:
+            return code
+
+        for index in self.border_cells.get(cell, ()):
+            if self.parts[index].contains(longitude, latitude):
+                return self.parts[index].code
+
+        # The point may be on the coast that is lost by simplified borders,
+        # so look for the closest country around
+        x, y = cell
+        closest, shortest = None, self.tolerance
+        for neighbour in ((x + dx, y + dy) for dx in (-1, 0, 1)
+                          for dy in (-1, 0, 1)):
+            for index in self.border_cells.get(neighbour, ()):
+                part = self.parts[index]
+                distance = part.distance(longitude, latitude)
+                if distance < shortest:
+                    closest, shortest = part.code, distance
+
+        return closest
+
+    def get_names(self, code: str) -> Optional[Dict[str, str]]:
+        """
+        Returns names of a country in all languages of the bot
+
+        :param code: ISO 3166-1 alpha-2 code of the country
+        :return: dictionary where keys are language tags like "en-US" and
+        values are names of the country or None if the code is unknown
+        """
+        return self.names.get(code.upper(), None)
+
+    def get_name(self, code: str, language: str) -> str:
+        """
+        Returns name of a country in one language
+
+        :param code: ISO 3166-1 alpha-2 code of the country
+        :param language: language tag like "en-US"
+        :return: name of the country or the code itself if it is unknown
+        """
+        names = self.get_names(code) or {}
+        return names.get(language, None) or names.get('en-US', code)
+
+    def __str__(self) -> str:
+        return (f'{self.__class__.__name__} instance with names of '
+                f'{len(self.names)} countries. Borders are '
+                f'{"loaded" if self.loaded else "not loaded yet"}.')
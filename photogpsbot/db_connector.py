@@ -1,24 +1,47 @@
 """
 Module that provides a way to connect to the MySQL and reconnect each time
 connection is lost. It also can automatically set up SSH tunnel thanks to
-sshtunnel module
+sshtunnel module, the tunnel is rebuilt if it dies
+
+If there are read replicas of the database, read-only queries go to them
+and everything else goes to the primary server. A chat that has just written
+something reads from the primary for a while, so it sees its own writes even
+if replicas are behind. Replicas that fall behind too much are taken out of
+rotation until they catch up, their lag is checked by the thread of the
+health checker, not by threads that handle messages.
 
 The original way to do it was described at
 https://help.pythonanywhere.com/pages/ManagingDatabaseConnections/
 """
 
+import random
 import socket
-from typing import Optional
+import threading
+import time
+from dataclasses import dataclass
+from itertools import cycle
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Tuple, TypeVar)
 
 # goes as mysqlclient in requirements
 import MySQLdb  # type: ignore
 from MySQLdb.connections import Connection  # type: ignore
-import sshtunnel  # type: ignore
-from sshtunnel import SSHTunnelForwarder  # type: ignore
+from MySQLdb.constants import CLIENT  # type: ignore
+from MySQLdb.cursors import SSCursor  # type: ignore
 
 from photogpsbot import log
+from photogpsbot.ssh_tunnel import TunnelSupervisor
 import config
 
+# Query with its parameters
+Query = Tuple[str, Optional[tuple]]
+T = TypeVar('T')
+
+# (2003, Can't connect to MySQL server)
+# (2006, Server has gone away)
+# (2013, Lost connection to MySQL server during query)
+CONNECTION_ERRORS = (2003, 2006, 2013)
+
 
 class DatabaseError(Exception):
     pass
@@ -28,6 +51,121 @@ class DatabaseConnectionError(Exception):
     pass
 
 
+def connect_to_mysql(host: str, port: int) -> Connection:
+    """
+    Opens a new connection to a MySQL server of the bot
+
+    :param host: address of the server
+    :param port: port of the server
+    :return: connection object
+    """
+    return MySQLdb.connect(host=host,
+                           user=config.DB_USER,
+                           password=config.DB_PASSWD,
+                           port=port,
+                           database=config.DB_NAME,
+                           charset='utf8',
+                           # for several queries in one round-trip, see
+                           # Database.execute_batch
+                           client_flag=CLIENT.MULTI_STATEMENTS)
+
+
+def is_read_query(query: str) -> bool:
+    """
+    Checks whether a query only reads data, so it can go to a replica
+
+    :param query: query to check
+    :return: True if the query doesn't change anything
+    """
+    first_word = query.lstrip().split(None, 1)[0].upper() if query else ''
+    return (first_word in ('SELECT', 'SHOW', 'EXPLAIN') and
+            'FOR UPDATE' not in query.upper())
+
+
+class Replica:
+    """
+    Read-only copy of the database
+    """
+
+    def __init__(self, host: str, port: int,
+                 connector: Callable[[str, int], Connection]) -> None:
+        self.host = host
+        self.port = port
+        self.connector = connector
+        self.conn: Optional[Connection] = None
+        self._lock = threading.Lock()
+        self.in_rotation = True
+        # how many seconds the replica is behind the primary server
+        self.lag: Optional[float] = None
+
+    def run(self, function: Callable[[Any], T]) -> T:
+        """
+        Runs a function with a cursor of the replica, no other thread uses
+        the connection until the function returns
+
+        :param function: function that takes a cursor
+        :return: what the function returns
+        """
+        with self._lock:
+            if not self.conn or not self.conn.open:
+                self.conn = self.connector(self.host, self.port)
+            return function(self.conn.cursor())
+
+    def execute(self, query: str, parameters: tuple = None):
+        """
+        Executes a read-only query on the replica
+
+        :param query: query to execute
+        :param parameters: parameters for query
+        :return: cursor object
+        """
+        def execute(cursor):
+            cursor.execute(query, parameters)
+            return cursor
+
+        return self.run(execute)
+
+    def check_lag(self) -> Optional[float]:
+        """
+        Finds out how many seconds the replica is behind the primary server
+
+        :return: the lag in seconds or None if replication doesn't work
+        """
+        cursor = self.execute('SHOW SLAVE STATUS')
+        row = cursor.fetchone()
+        if not row:
+            # It is not a replica actually, so it can't be behind
+            return 0
+        columns = [description[0] for description in cursor.description]
+        return dict(zip(columns, row)).get('Seconds_Behind_Master', None)
+
+    def close(self) -> None:
+        """
+        Closes the connection to the replica
+
+        :return: None
+        """
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def __str__(self) -> str:
+        state = 'in rotation' if self.in_rotation else 'out of rotation'
+        return f'replica {self.host}:{self.port} ({state}, lag {self.lag})'
+
+
+@dataclass
+class ReconnectStats:
+    """
+    How many times and how long the bot has been reconnecting to the
+    database
+    """
+    background: int = 0  # by the health checker
+    inline: int = 0  # while a query of a user was waiting
+    total_time: float = 0  # in seconds
+    max_time: float = 0  # in seconds
+
+
 class Database:
     """
     Class that connects the bot to a database
@@ -36,30 +174,53 @@ class Database:
     a MySQL database directly and via ssh if necessary
     """
     conn: Optional[Connection] = None
-    tunnel: Optional[SSHTunnelForwarder] = None
-    tunnel_opened: bool = False
 
-    def _open_ssh_tunnel(self) -> None:
+    def __init__(self, replicas: Optional[List[str]] = None,
+                 connector: Callable[[str, int], Connection] =
+                 connect_to_mysql,
+                 tunnel: Optional[TunnelSupervisor] = None) -> None:
+        """
+        Init variables
+
+        :param replicas: addresses of read replicas like "host:port", they
+        are taken from config.DB_REPLICAS by default
+        :param connector: function that opens a connection by host and port.
+        It can be replaced to run the class against local stand-ins
+        :param tunnel: supervisor of the SSH tunnel to the database, it is
+        used when the bot runs not on the server with the database
+        """
+        if replicas is None:
+            replicas = [address.strip() for address in
+                        (config.DB_REPLICAS or '').split(',')
+                        if address.strip()]
+        self.connector = connector
+        self.tunnel = tunnel or TunnelSupervisor()
+        self.replicas = [Replica(*self._parse_address(address), connector)
+                         for address in replicas]
+        self._next_replica = cycle(self.replicas)
+        self.replicas_checked = 0.0
+        # when chats wrote something to the database the last time, only
+        # chats that wrote during READ_YOUR_WRITES_WINDOW are kept
+        self.last_writes: Dict[int, float] = {}
+        self._writes_lock = threading.Lock()
+
+        # the connection to the primary server is shared by threads, so
+        # only one of them can use it at a time
+        self._lock = threading.RLock()
+        self.last_used = 0.0
+        self.reconnect_stats = ReconnectStats()
+        self._stop_checker = threading.Event()
+
+    @staticmethod
+    def _parse_address(address: str) -> tuple:
         """
-        Method that opens a new ssh tunnel to the server where the database of
-        photogpsbot is located
+        Splits an address of a server into host and port
 
-        :return: None
+        :param address: string like "host:port" or just "host"
+        :return: tuple with host and port
         """
-        log.debug('Establishing SSH tunnel to the server where the database '
-                  'is located...')
-        sshtunnel.SSH_TIMEOUT = 5.0
-        sshtunnel.TUNNEL_TIMEOUT = 5.0
-        self.tunnel = sshtunnel.SSHTunnelForwarder(
-            ssh_address_or_host=config.SERVER_ADDRESS,
-            ssh_username=config.SSH_USER,
-            ssh_password=config.SSH_PASSWD,
-            ssh_port=22,
-            remote_bind_address=('127.0.0.1', 3306))
-
-        self.tunnel.start()
-        self.tunnel_opened = True
-        log.debug('SSH tunnel has been established.')
+        host, _, port = address.partition(':')
+        return host, int(port or 3306)
 
     def connect(self) -> None:
         """
@@ -70,87 +231,450 @@ class Database:
 
         :return: None
         """
+        self.conn = self.connector('127.0.0.1', self._get_port())
+        log.info('Connected to the database.')
+
+    def _get_port(self) -> int:
+        """
+        Finds out a local port of the primary server, it is a port of the
+        SSH tunnel if the bot runs not on the server with the database
+
+        :return: the port
+        """
         if socket.gethostname() == config.PROD_HOST_NAME:
             log.info('Connecting to the local database...')
-            port = 3306
+            return 3306
+
+        log.info('Connecting to the database via SSH...')
+        return self.tunnel.get_port()
+
+    def stream(self, query: str, parameters: tuple = None,
+               batch_size: int = 10000) -> Iterator[tuple]:
+        """
+        Reads a large result of a query row by row without loading all of
+        it into memory
+
+        Rows are read with a server-side cursor through a separate
+        connection, so other queries don't wait while the result is being
+        read. It goes to a replica if there is one in rotation
+
+        :param query: query to execute
+        :param parameters: parameters for query
+        :param batch_size: how many rows to take from the server at once
+        :return: iterator over rows
+        """
+        replica = self._choose_replica(query, None)
+        if replica:
+            conn = self.connector(replica.host, replica.port)
         else:
-            log.info('Connecting to the database via SSH...')
-            if not self.tunnel_opened:
-                self._open_ssh_tunnel()
-
-            port = self.tunnel.local_bind_port
-
-        self.conn = MySQLdb.connect(host='127.0.0.1',
-                                    user=config.DB_USER,
-                                    password=config.DB_PASSWD,
-                                    port=port,
-                                    database=config.DB_NAME,
-                                    charset='utf8')
-        log.info('Connected to the database.')
+            conn = self.connector('127.0.0.1', self._get_port())
+
+        try:
+            cursor = conn.cursor(SSCursor)
+            cursor.execute(query, parameters)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def check_replicas(self) -> None:
+        """
+        Takes replicas that fall behind out of rotation and returns those
+        that have caught up
+
+        :return: None
+        """
+        self.replicas_checked = time.monotonic()
+        for replica in self.replicas:
+            try:
+                replica.lag = replica.check_lag()
+            # it runs in the thread of the health checker, which must not
+            # die because of one replica
+            except Exception as e:
+                log.warning('Cannot check %s: %s', replica, e)
+                replica.close()
+                replica.lag = None
+
+            healthy = (replica.lag is not None and
+                       replica.lag <= config.REPLICA_MAX_LAG)
+            if healthy != replica.in_rotation:
+                replica.in_rotation = healthy
+                log.warning('Rotation of replicas has changed: %s', replica)
+
+    def _choose_replica(self, query: str,
+                        chat_id: Optional[int]) -> Optional[Replica]:
+        """
+        Chooses a replica to execute a query on
+
+        :param query: query to execute
+        :param chat_id: id of a chat on behalf of which the query is executed
+        :return: a replica or None if the query has to go to the primary
+        server
+        """
+        if not self.replicas or not is_read_query(query):
+            return None
+
+        last_write = self.last_writes.get(chat_id, None)
+        if (last_write and time.monotonic() - last_write <
+                config.READ_YOUR_WRITES_WINDOW):
+            return None
+
+        # round-robin over replicas that are in rotation
+        for _ in range(len(self.replicas)):
+            replica = next(self._next_replica)
+            if replica.in_rotation:
+                return replica
+        return None
 
     def execute_query(self, query: str, parameters: tuple = None,
-                      trials: int = 0):
+                      many: bool = False, chat_id: Optional[int] = None,
+                      primary: bool = False):
         """
         Executes a given query
 
+        If the connection is lost, the query is tried again with growing
+        delays until it succeeds or config.DB_RETRY_DEADLINE runs out
+
         :param query: query to execute
         :param parameters: parameters for query
-        :param trials: integer that denotes number of trials to execute
-        a query in case of known errors
+        :param many: whether parameters is a list of tuples to execute the
+        query with each of them in one go
+        :param chat_id: id of a chat on behalf of which the query is
+        executed. If the chat has written something recently, the query goes
+        to the primary server so that the chat reads its own writes
+        :param primary: whether the query has to go to the primary server
+        even if it only reads data
         :return: cursor object
         """
-        if not self.conn or not self.conn.open:
-            self.connect()
-
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute(query, parameters)
+        def execute(cursor):
+            if many:
+                cursor.executemany(query, parameters)
+            else:
+                cursor.execute(query, parameters)
+            return cursor
 
-        # try to reconnect if MySQL server has gone away
-        except MySQLdb.OperationalError as e:
+        replica = (None if many or primary
+                   else self._choose_replica(query, chat_id))
+        return self._run(execute, replica)
 
-            # (2013, Lost connection to MySQL server during query)
-            # (2006, Server has gone away)
-            if e.args[0] in [2006, 2013]:
-                log.info(e)
+    def execute_batch(self, queries: List[Query],
+                      chat_id: Optional[int] = None,
+                      primary: bool = False) -> List[List[tuple]]:
+        """
+        Executes several independent read queries in one round-trip to the
+        server instead of one round-trip for every query
+
+        The queries are sent as one multi-statement query and their results
+        are read one after another. As parameters of all the queries are put
+        into one string, a percent sign in a query has to be written as %%
+        if any query of the batch has parameters
+
+        :param queries: queries with their parameters (or None)
+        :param chat_id: id of a chat on behalf of which the queries are
+        executed, see execute_query
+        :param primary: whether the queries have to go to the primary server
+        :return: list of rows of every query in the same order as queries
+        """
+        if not queries:
+            return []
+
+        batch = ';\n'.join(query for query, _ in queries)
+        parameters = tuple(parameter for _, query_parameters in queries
+                           for parameter in query_parameters or ())
+
+        def execute(cursor):
+            cursor.execute(batch, parameters or None)
+            # results are read while the connection is still locked,
+            # otherwise another thread could send a query in between
+            results = [list(cursor.fetchall())]
+            while cursor.nextset():
+                results.append(list(cursor.fetchall()))
+            return results
+
+        replica = None
+        if not primary and all(is_read_query(query) for query, _ in queries):
+            replica = self._choose_replica(queries[0][0], chat_id)
+        return self._run(execute, replica)
+
+    def _run(self, function: Callable[[Any], T],
+             replica: Optional[Replica] = None) -> T:
+        """
+        Runs a function with a cursor either on a replica or on the primary
+        server, reconnecting to the primary server if needed
 
-                self.connect()
-                if trials <= 3:
-                    # trying to execute query one more time
-                    trials += 1
-                    log.warning(e)
-                    log.info("Trying execute the query again...")
-                    return self.execute_query(query, parameters, trials)
+        :param function: function that takes a cursor and executes queries
+        :param replica: replica to run the function on, the primary server
+        is used if the replica fails
+        :return: what the function returns
+        """
+        if replica:
+            try:
+                return replica.run(function)
+            except MySQLdb.OperationalError as e:
+                # an error in the query itself would fail on every server
+                if e.args[0] not in CONNECTION_ERRORS:
+                    log.error(e)
+                    raise
+                log.warning('Query has failed on %s: %s', replica, e)
+                log.warning('Taking it out of rotation, the query goes to '
+                            'the primary server')
+                replica.in_rotation = False
+                replica.close()
+
+        deadline = time.monotonic() + config.DB_RETRY_DEADLINE
+        attempt = 0
+        while True:
+            try:
+                with self._lock:
+                    if not self.conn or not self.conn.open:
+                        self._reconnect(background=False)
+                    result = function(self.conn.cursor())
+                    self.last_used = time.monotonic()
+                return result
+
+            # try to reconnect if MySQL server has gone away
+            except MySQLdb.OperationalError as e:
+                if e.args[0] not in CONNECTION_ERRORS:
+                    log.error(e)
+                    raise
 
-                if trials > 3:
+                log.warning(e)
+                with self._lock:
+                    self._close_primary()
+                delay = self._get_backoff(attempt)
+                if time.monotonic() + delay > deadline:
                     log.error(e)
-                    log.warning("Ran out of limit of trials...")
+                    log.warning("Ran out of time to execute the query...")
                     raise DatabaseConnectionError("Cannot connect to the "
                                                   "database")
-            else:
+                attempt += 1
+                log.info("Trying execute the query again in %.2f "
+                         "seconds...", delay)
+                time.sleep(delay)
+
+            except Exception as e:
                 log.error(e)
                 raise
-        except Exception as e:
-            log.error(e)
-            raise
+
+    @staticmethod
+    def _get_backoff(attempt: int) -> float:
+        """
+        Calculates how long to wait before the next attempt to execute a
+        query
+
+        The delay grows exponentially with every attempt and is randomized
+        so that threads that lost connection at the same time don't
+        reconnect all at once
+
+        :param attempt: how many attempts have been made already
+        :return: delay in seconds
+        """
+        delay = min(config.DB_RETRY_MAX_DELAY,
+                    config.DB_RETRY_BASE_DELAY * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def _reconnect(self, background: bool) -> None:
+        """
+        Opens a new connection to the primary server instead of a lost one
+        and keeps track of how often it happens and how long it takes
+
+        :param background: True if it is done by the health checker and not
+        while a user waits for his query
+        :return: None
+        """
+        self._close_primary()
+        start = time.perf_counter()
+        self.connect()
+        duration = time.perf_counter() - start
+        self.last_used = time.monotonic()
+
+        stats = self.reconnect_stats
+        if background:
+            stats.background += 1
         else:
-            return cursor
+            stats.inline += 1
+        stats.total_time += duration
+        stats.max_time = max(stats.max_time, duration)
+        log.info('Reconnected to the database in %.2f seconds', duration)
 
-    def add(self, query: str, parameters: tuple = None):
+    def _close_primary(self) -> None:
+        """
+        Closes the connection to the primary server that is probably broken
+
+        :return: None
+        """
+        if self.conn:
+            try:
+                self.conn.close()
+            except MySQLdb.Error:
+                pass
+            self.conn = None
+
+    def start_health_checker(self) -> None:
+        """
+        Starts a thread that pings the connection to the primary server when
+        it is idle and reconnects if it is lost, so that users don't wait
+        for it. It also keeps track of lag of replicas
+
+        :return: None
+        """
+        self._stop_checker.clear()
+        checker = threading.Thread(target=self._check_health,
+                                   name='database health checker',
+                                   daemon=True)
+        checker.start()
+        log.info('Health checker of the database has been started.')
+
+    def _check_health(self) -> None:
+        """
+        Body of the thread of the health checker
+
+        :return: None
+        """
+        ping_interval = config.DB_PING_INTERVAL
+        # lag of replicas is checked more often than the connection is pinged
+        interval = ping_interval
+        if self.replicas:
+            interval = min(interval, config.REPLICA_CHECK_INTERVAL)
+            self.check_replicas()
+
+        while not self._stop_checker.wait(interval):
+            try:
+                tunnel_rebuilt = self.tunnel.check()
+            except Exception as e:
+                log.error('Cannot rebuild SSH tunnel: %s', e)
+                tunnel_rebuilt = False
+            if tunnel_rebuilt:
+                # the old connection went through the dead tunnel
+                with self._lock:
+                    try:
+                        self._reconnect(background=True)
+                    except Exception as e:
+                        log.error('Cannot reconnect to the database: %s', e)
+            elif time.monotonic() - self.last_used >= ping_interval:
+                self._ping()
+            if (self.replicas and time.monotonic() - self.replicas_checked >=
+                    config.REPLICA_CHECK_INTERVAL):
+                self.check_replicas()
+                self._forget_old_writes()
+
+    def _ping(self) -> None:
+        """
+        Checks that the connection to the primary server is alive and
+        reconnects if it isn't
+
+        :return: None
+        """
+        with self._lock:
+            try:
+                if not self.conn or not self.conn.open:
+                    raise MySQLdb.OperationalError(2006,
+                                                   'Connection is closed')
+                self.conn.ping()
+                self.last_used = time.monotonic()
+                return
+            except MySQLdb.Error as e:
+                log.warning('Connection to the database is lost: %s', e)
+
+            try:
+                self._reconnect(background=True)
+            except Exception as e:
+                log.error('Cannot reconnect to the database: %s', e)
+
+    def add(self, query: str, parameters: tuple = None,
+            chat_id: Optional[int] = None) -> Optional[int]:
         """
         Shortcut to add something to a database
 
         :param query: query to execute
         :param parameters: parameters for query
-        :return: boolean - True if the method succeeded and False otherwise
+        :param chat_id: id of a chat on behalf of which data is added, so
+        that this chat reads from the primary server for a while
+        :return: id that AUTO_INCREMENT column got for the added row, if
+        there is such a column
         """
 
+        def execute(cursor):
+            cursor.execute(query, parameters)
+            self.conn.commit()
+            return cursor
+
+        # _run locks the connection only while the query is executed and
+        # committed, not while it waits to try again
         try:
-            self.execute_query(query, parameters)
+            cursor = self._run(execute)
+        except Exception as e:
+            log.error(e)
+            raise DatabaseError("Cannot add your data to the database!") \
+                from e
+
+        if chat_id is not None:
+            self._remember_writes([chat_id])
+        return cursor.lastrowid
+
+    def add_many(self, query: str, parameters: List[tuple],
+                 chat_id: Optional[int] = None,
+                 chat_ids: Iterable[int] = ()) -> None:
+        """
+        Shortcut to add a lot of rows to a database in one go
+
+        MySQLdb turns INSERT ... VALUES with a list of parameters into one
+        multi-row INSERT, so it is much faster than adding rows one by one
+
+        :param query: query to execute
+        :param parameters: list with parameters for every row
+        :param chat_id: id of a chat on behalf of which data is added, so
+        that this chat reads from the primary server for a while
+        :param chat_ids: ids of several such chats
+        :return: None
+        """
+
+        def execute(cursor):
+            cursor.executemany(query, parameters)
             self.conn.commit()
+
+        try:
+            self._run(execute)
         except Exception as e:
             log.error(e)
-            raise DatabaseError("Cannot add your data to the database!")
+            raise DatabaseError("Cannot add your data to the database!") \
+                from e
+
+        if chat_id is not None:
+            chat_ids = [chat_id, *chat_ids]
+        self._remember_writes(chat_ids)
+
+    def _remember_writes(self, chat_ids: Iterable[int]) -> None:
+        """
+        Makes chats that have written something read from the primary server
+        for a while
+
+        :param chat_ids: ids of the chats
+        :return: None
+        """
+        # without replicas everything is read from the primary anyway
+        if not self.replicas:
+            return
+        now = time.monotonic()
+        with self._writes_lock:
+            for chat_id in chat_ids:
+                self.last_writes[chat_id] = now
+
+    def _forget_old_writes(self) -> None:
+        """
+        Forgets chats that wrote something longer than
+        config.READ_YOUR_WRITES_WINDOW ago, they read from replicas again
+
+        :return: None
+        """
+        oldest = time.monotonic() - config.READ_YOUR_WRITES_WINDOW
+        with self._writes_lock:
+            self.last_writes = {chat_id: written for chat_id, written
+                                in self.last_writes.items()
+                                if written >= oldest}
 
     def disconnect(self) -> bool:
         """
@@ -158,17 +682,25 @@ class Database:
 
         :return: True if succeeded
         """
+        self._stop_checker.set()
         if self.conn:
             self.conn.close()
+            self.conn = None
             log.info('Connection to the database has been closed.')
-        if self.tunnel:
-            self.tunnel.stop()
-            log.info('SSH tunnel has been closed.')
-        self.tunnel_opened = False
+        for replica in self.replicas:
+            replica.close()
+        self.tunnel.close()
         return True
 
     def __str__(self) -> str:
+        replicas = ''.join(f' There is {replica}.'
+                           for replica in self.replicas)
+        stats = self.reconnect_stats
+        reconnects = stats.background + stats.inline
+        average = stats.total_time / reconnects if reconnects else 0
         return (f'Instance of a connector to the database. '
                 f'The connection is {"opened" if self.conn else "closed"}. '
-                f'SSH tunnel is {"opened" if self.tunnel_opened else "closed"}'
-                '.')
+                f'{self.tunnel}.{replicas} '
+                f'Reconnects: {stats.background} in background, '
+                f'{stats.inline} while handling queries, average '
+                f'{average:.2f} s, max {stats.max_time:.2f} s.')
@@ -0,0 +1,99 @@
+"""
+Module with tables that map names of cameras and lenses to small integer
+ids.
+
+photo_queries_table2 keeps only ids of cameras and lenses, so charts and
+counts of users with the same camera group and compare integers instead of
+long strings. Names are looked up by ids only for the few items that are
+shown to users. Both directions are cached in memory, there are not many
+distinct cameras and lenses, so the caches are not limited.
+"""
+
+from threading import Lock
+from typing import Dict, Iterable, Optional
+
+from photogpsbot import log, db
+
+# length of the name column, MySQL cuts longer names on INSERT IGNORE
+MAX_NAME_LENGTH = 255
+
+
+class Dimension:
+    """
+    Table of names of cameras or lenses with their ids
+    """
+
+    def __init__(self, table: str) -> None:
+        """
+        Init variables
+
+        :param table: name of the table with id and name columns
+        """
+        self.table = table
+        self.ids: Dict[str, int] = {}
+        self.names: Dict[int, str] = {}
+        self.misses = 0
+        self._lock = Lock()
+
+    def _remember(self, item_id: int, name: str) -> None:
+        with self._lock:
+            self.ids[name] = item_id
+            self.names.setdefault(item_id, name)
+
+    def get_id(self, name: Optional[str]) -> Optional[int]:
+        """
+        Finds an id of a name and adds the name to the table if it is new
+
+        :param name: name of a camera or a lens, a name longer than the
+        column is cut to its length
+        :return: id of the name or None if there is no name
+        """
+        if not name:
+            return None
+
+        # otherwise the name that has been added wouldn't be found by the
+        # full name
+        name = name[:MAX_NAME_LENGTH]
+        item_id = self.ids.get(name, None)
+        if item_id:
+            return item_id
+
+        with self._lock:
+            self.misses += 1
+        query = f'SELECT id FROM {self.table} WHERE name=%s'
+        row = db.execute_query(query, (name,), primary=True).fetchone()
+        if not row:
+            # another process can add the same name at the same time, then
+            # the name is not added twice and its id is read again
+            log.info('Adding %s to %s', name, self.table)
+            db.add(f'INSERT IGNORE INTO {self.table} (name) VALUES (%s)',
+                   (name,))
+            row = db.execute_query(query, (name,), primary=True).fetchone()
+
+        self._remember(row[0], name)
+        return row[0]
+
+    def get_names(self, ids: Iterable[int]) -> Dict[int, str]:
+        """
+        Finds names by their ids
+
+        :param ids: ids of cameras or lenses
+        :return: dictionary where keys are ids and values are names, ids
+        that are not in the table are left out
+        """
+        ids = [item_id for item_id in ids if item_id]
+        unknown = [item_id for item_id in ids if item_id not in self.names]
+        if unknown:
+            placeholders = ', '.join(['%s'] * len(unknown))
+            cursor = db.execute_query(f'SELECT id, name FROM {self.table} '
+                                      f'WHERE id IN ({placeholders})',
+                                      tuple(unknown), primary=True)
+            for item_id, name in cursor.fetchall():
+                self._remember(item_id, name)
+
+        return {item_id: self.names[item_id] for item_id in ids
+                if item_id in self.names}
+
+    def __str__(self) -> str:
+        return (f'{len(self.names)} names of {self.table} are cached, '
+                f'{self.misses} were looked up in the database')
@@ -0,0 +1,129 @@
+"""
+Module that downloads files that users send to the bot from Telegram.
+
+Every photo is downloaded from api.telegram.org, so a new connection and a
+TLS handshake for every file take a big part of the time the bot spends on
+a photo. There is one client for the whole process instead: one HTTP
+session with a pool of keep-alive connections as big as the number of
+threads that download files, the proxy set once, timeouts for connecting
+and for reading, and a few retries with a backoff when the connection
+fails or Telegram answers with a server error.
+"""
+
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from threading import Lock
+from typing import Dict, Optional
+from weakref import WeakSet
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry  # type: ignore
+
+from photogpsbot import log
+import config
+
+
+class DownloadError(Exception):
+    """
+    A file cannot be downloaded from Telegram
+    """
+
+
+@dataclass
+class DownloaderMetrics:
+    """
+    Statistics of downloaded files
+    """
+    files: int = 0
+    errors: int = 0
+    bytes: int = 0
+    total_latency: float = 0  # in seconds
+    max_latency: float = 0  # in seconds
+
+
+class Downloader:
+    """
+    Long-lived client that downloads files for the whole bot
+    """
+
+    def __init__(self, pool_size: int = config.DOWNLOAD_POOL_SIZE,
+                 proxies: Optional[Dict[str, str]] = None,
+                 connect_timeout: float = config.DOWNLOAD_CONNECT_TIMEOUT,
+                 read_timeout: float = config.DOWNLOAD_READ_TIMEOUT,
+                 retries: int = config.DOWNLOAD_RETRIES) -> None:
+        """
+        Init variables
+
+        :param pool_size: connections kept open, one for every thread that
+        downloads files
+        :param proxies: proxies for requests, like apihelper.proxy
+        :param connect_timeout: seconds to wait for a connection
+        :param read_timeout: seconds to wait for data from the server
+        :param retries: how many times a download is tried again
+        """
+        self.timeout = connect_timeout, read_timeout
+        retry = Retry(total=retries, connect=retries, read=retries,
+                      status=retries, backoff_factor=0.3,
+                      status_forcelist=(500, 502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if proxies:
+            self.session.proxies.update(proxies)
+        self.metrics = DownloaderMetrics()
+        # files that have been downloaded and are still being handled
+        self.buffers: WeakSet = WeakSet()
+        self._lock = Lock()
+
+    def download(self, url: str) -> bytes:
+        """
+        Downloads a file
+
+        :param url: link to the file
+        :return: content of the file
+        """
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            content = response.content
+        except requests.RequestException as e:
+            with self._lock:
+                self.metrics.errors += 1
+            # the link has the token of the bot in it, so it is not logged
+            log.error('Cannot download a file: %s', type(e).__name__)
+            raise DownloadError(type(e).__name__) from e
+
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.metrics.files += 1
+            self.metrics.bytes += len(content)
+            self.metrics.total_latency += latency
+            self.metrics.max_latency = max(self.metrics.max_latency, latency)
+        return content
+
+    def open(self, url: str) -> BytesIO:
+        """
+        Downloads a file and opens it as a file-like object
+
+        :param url: link to the file
+        :return: file-like object with content of the file
+        """
+        buffer = BytesIO(self.download(url))
+        with self._lock:
+            self.buffers.add(buffer)
+        return buffer
+
+    def __str__(self) -> str:
+        metrics = self.metrics
+        average = (metrics.total_latency / metrics.files * 1000
+                   if metrics.files else 0)
+        return (f'Downloader: {metrics.files} files, '
+                f'{metrics.bytes / 2 ** 20:.1f} MB, {metrics.errors} errors. '
+                f'Latency: average {average:.0f} ms, max '
+                f'{metrics.max_latency * 1000:.0f} ms.')
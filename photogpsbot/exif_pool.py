@@ -0,0 +1,291 @@
+"""
+Module that reads EXIF of photos in separate processes with limits.
+
+exifread follows offsets that are written in a file, so a broken or a
+crafted one (an IFD that points to itself, a tag with a count of billions
+of values, a giant MakerNote) can make it loop forever or take all memory
+of the bot, and then every user waits. Here EXIF is read by a pool of
+worker processes instead:
+
+- a file that isn't read in config.EXIF_TIMEOUT seconds is given up on;
+- a worker can't take more than config.EXIF_MEMORY_LIMIT bytes of memory
+  over what it had when it was started (RLIMIT_AS) and can't spend more
+  than config.EXIF_CPU_LIMIT seconds of CPU on one file (RLIMIT_CPU);
+- workers are replaced by new ones after config.EXIF_TASKS_PER_WORKER files
+  and after they have been killed, so a leak or a crash doesn't last.
+
+Workers are forked, they don't import the bot again and only send back
+tags that the bot uses. The bot answers that there is no EXIF for files
+that can't be read this way. If config.EXIF_WORKERS is 0 or the pool
+hasn't been started (in tools, for example), EXIF is read in the calling
+thread as before.
+"""
+
+import multiprocessing
+import resource
+import signal
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from threading import Lock
+from typing import Any, Dict, Optional, Tuple
+
+import exifread  # type: ignore
+
+from photogpsbot import log
+import config
+
+# the same as in workers.py
+_context = multiprocessing.get_context('fork')
+
+# tags that the bot takes from EXIF, values of the rest aren't sent back
+TAGS = {'EXIF DateTimeOriginal', 'Image Make', 'Image Model',
+        'EXIF LensMake', 'EXIF LensModel', 'GPS GPSLatitudeRef',
+        'GPS GPSLongitudeRef', 'GPS GPSLatitude', 'GPS GPSLongitude'}
+
+# CPU seconds that a worker may spend on one file, set in every worker
+_cpu_limit = 0
+
+
+class ExifReadError(Exception):
+    """
+    EXIF of a file cannot be read in time or within the limits
+    """
+
+
+class CPULimitExceeded(Exception):
+    """
+    A worker has spent too much CPU time on one file
+    """
+
+
+def read_tags(content: bytes) -> Dict[str, Any]:
+    """
+    Reads EXIF of a file
+
+    :param content: content of the file
+    :return: dictionary with all tags that there are in EXIF, but only tags
+    from TAGS have values, the rest are None
+    """
+    exif = exifread.process_file(BytesIO(content), details=False)
+    return {key: tag if key in TAGS else None for key, tag in exif.items()}
+
+
+def _get_virtual_memory() -> int:
+    """
+    Finds out the size of the address space of the process
+
+    :return: size in bytes or 0 if it is unknown
+    """
+    try:
+        with open('/proc/self/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmSize:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _raise_cpu_limit_exceeded(signum: int, frame: Any) -> None:
+    raise CPULimitExceeded
+
+
+def _init_worker(memory_limit: int, cpu_limit: int) -> None:
+    """
+    Sets limits of a worker process when it starts
+
+    :param memory_limit: bytes that the worker can allocate
+    :param cpu_limit: CPU seconds that the worker can spend on one file
+    :return: None
+    """
+    global _cpu_limit
+    _cpu_limit = cpu_limit
+
+    # the pool is stopped by the bot, handlers of the bot aren't for workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGXCPU, _raise_cpu_limit_exceeded)
+
+    # a forked worker has the address space of the bot with stacks of all
+    # its threads, so the limit is counted from its current size
+    virtual_memory = _get_virtual_memory()
+    if memory_limit and virtual_memory:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = virtual_memory + memory_limit
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _set_cpu_limit(seconds: Optional[int]) -> None:
+    """
+    Lets the worker spend some more CPU time or removes the limit
+
+    RLIMIT_CPU counts all time the process has spent, so the soft limit is
+    moved before every file. When it is exceeded the worker gets SIGXCPU.
+
+    :param seconds: CPU seconds from now or None to remove the limit
+    :return: None
+    """
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if seconds is None:
+        soft = hard
+    else:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft = int(usage.ru_utime + usage.ru_stime) + seconds
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _work(content: bytes) -> Tuple[str, Any]:
+    """
+    Reads EXIF of a file in a worker process
+
+    :param content: content of the file
+    :return: "ok" and the tags or a reason why they cannot be read and a
+    description of the error
+    """
+    if _cpu_limit:
+        _set_cpu_limit(_cpu_limit)
+    try:
+        return 'ok', read_tags(content)
+    except MemoryError:
+        return 'memory limit', None
+    except CPULimitExceeded:
+        return 'CPU limit', None
+    except Exception as e:
+        return 'error', f'{type(e).__name__}: {e}'
+    finally:
+        if _cpu_limit:
+            _set_cpu_limit(None)
+
+
+@dataclass
+class ExifPoolMetrics:
+    """
+    Statistics of files that EXIF has been read from
+    """
+    files: int = 0
+    timeouts: int = 0
+    memory_limits: int = 0
+    cpu_limits: int = 0
+    errors: int = 0
+    total_latency: float = 0  # in seconds
+    max_latency: float = 0  # in seconds
+
+
+class ExifPool:
+    """
+    Pool of processes that read EXIF of files
+    """
+
+    def __init__(self, workers: int = config.EXIF_WORKERS,
+                 timeout: float = config.EXIF_TIMEOUT,
+                 memory_limit: int = config.EXIF_MEMORY_LIMIT,
+                 cpu_limit: int = config.EXIF_CPU_LIMIT,
+                 tasks_per_worker: int = config.EXIF_TASKS_PER_WORKER
+                 ) -> None:
+        """
+        Init variables
+
+        :param workers: number of worker processes, 0 means no pool
+        :param timeout: seconds to wait for EXIF of one file
+        :param memory_limit: bytes that a worker can allocate, 0 means no
+        limit
+        :param cpu_limit: CPU seconds that a worker can spend on one file, 0
+        means no limit
+        :param tasks_per_worker: number of files after which a worker is
+        replaced by a new one
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
+        self.tasks_per_worker = tasks_per_worker
+        self.pool: Optional[Any] = None
+        self.metrics = ExifPoolMetrics()
+        self._lock = Lock()
+
+    def start(self) -> None:
+        """
+        Starts worker processes
+
+        :return: None
+        """
+        if not self.workers or self.pool:
+            return
+        log.info('Starting %d processes that read EXIF', self.workers)
+        self.pool = _context.Pool(self.workers, initializer=_init_worker,
+                                  initargs=(self.memory_limit,
+                                            self.cpu_limit),
+                                  maxtasksperchild=self.tasks_per_worker)
+
+    def stop(self) -> None:
+        """
+        Stops worker processes, files that are being read are given up on
+
+        :return: None
+        """
+        pool, self.pool = self.pool, None
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    def read(self, content: bytes) -> Dict[str, Any]:
+        """
+        Reads EXIF of a file in a worker process
+
+        :param content: content of the file
+        :return: dictionary with tags like the one read_tags returns
+        """
+        pool = self.pool
+        if not pool:
+            return read_tags(content)
+
+        start = time.perf_counter()
+        try:
+            status, result = pool.apply_async(_work, (content,)).get(
+                self.timeout)
+        except multiprocessing.TimeoutError:
+            # the worker has hung or has been killed
+            status, result = 'timeout', None
+        except ValueError:
+            # the pool has been stopped
+            status, result = 'error', 'the pool is not running'
+
+        latency = time.perf_counter() - start
+        with self._lock:
+            metrics = self.metrics
+            metrics.files += 1
+            metrics.total_latency += latency
+            metrics.max_latency = max(metrics.max_latency, latency)
+            if status == 'timeout':
+                metrics.timeouts += 1
+            elif status == 'memory limit':
+                metrics.memory_limits += 1
+            elif status == 'CPU limit':
+                metrics.cpu_limits += 1
+            elif status == 'error':
+                metrics.errors += 1
+
+        if status != 'ok':
+            reason = f'{status}: {result}' if result else status
+            log.warning('Cannot read EXIF of a file (%s) in %.1f seconds',
+                        reason, latency)
+            raise ExifReadError(reason)
+        return result
+
+    def __str__(self) -> str:
+        if not self.workers:
+            return 'EXIF pool: off, EXIF is read in handler threads.'
+        metrics = self.metrics
+        average = (metrics.total_latency / metrics.files * 1000
+                   if metrics.files else 0)
+        return (f'EXIF pool: {self.workers} processes, {metrics.files} '
+                f'files. Given up on: {metrics.timeouts} by timeout, '
+                f'{metrics.memory_limits} by memory limit, '
+                f'{metrics.cpu_limits} by CPU limit, {metrics.errors} '
+                f'errors. Latency: average {average:.0f} ms, max '
+                f'{metrics.max_latency * 1000:.0f} ms.')
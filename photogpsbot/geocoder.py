@@ -0,0 +1,326 @@
+"""
+Module that turns coordinates of a photo into an address.
+
+It keeps one long-lived client for the whole bot: one HTTP session with
+keep-alive connections, one rate limiter that follows the usage policy of
+Nominatim (not more than one request per second) and a circuit breaker that
+stops sending requests for a while after several failures in a row, so users
+do not wait through timeouts while the geocoding service is down.
+
+The service itself is a provider that can be changed, for example to a
+self-hosted Nominatim or to a stub that works without network.
+"""
+
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from photogpsbot import log
+import config
+
+
+class GeocoderError(Exception):
+    """
+    The geocoding service could not return an address
+    """
+
+
+class GeocoderUnavailable(GeocoderError):
+    """
+    The geocoder doesn't send requests now because the service has been
+    failing or because the bot would wait for its turn too long
+    """
+
+
+@dataclass
+class Location:
+    """
+    Address of a place and the country where it is
+    """
+    address: str
+    country: Optional[str] = None
+    # ISO 3166-1 alpha-2 code of the country in lower case
+    country_code: Optional[str] = None
+    raw: Dict[str, Any] = field(default_factory=dict)
+
+
+class Provider(ABC):
+    """
+    A geocoding service that can get address by coordinates
+    """
+    name = 'provider'
+
+    @abstractmethod
+    def reverse(self, latitude: float, longitude: float,
+                language: str) -> Location:
+        """
+        Get address by coordinates
+
+        :param latitude: latitude in decimal degrees
+        :param longitude: longitude in decimal degrees
+        :param language: two letter code of a language of the address
+        :return: Location object with the address
+        """
+
+
+class NominatimProvider(Provider):
+    """
+    Reverse geocoding by Nominatim, either by the public one from
+    OpenStreetMap or by a self-hosted one
+    """
+    name = 'nominatim'
+
+    def __init__(self, base_url: str, user_agent: str, timeout: float,
+                 pool_size: int = 4) -> None:
+        self.url = base_url.rstrip('/') + '/reverse'
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def reverse(self, latitude: float, longitude: float,
+                language: str) -> Location:
+        parameters = {'format': 'jsonv2',
+                      'lat': latitude,
+                      'lon': longitude,
+                      'addressdetails': 1,
+                      'accept-language': language}
+        try:
+            response = self.session.get(self.url, params=parameters,
+                                        timeout=self.timeout)
+            response.raise_for_status()
+            raw = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise GeocoderError(e)
+
+        if 'error' in raw:
+            raise GeocoderError(raw['error'])
+
+        address = raw.get('address', {})
+        return Location(address=raw.get('display_name', ''),
+                        country=address.get('country', None),
+                        country_code=address.get('country_code', None),
+                        raw=raw)
+
+
+class StubProvider(Provider):
+    """
+    Provider that doesn't go anywhere and returns coordinates as an address.
+    It is for running the bot without network and for load tests
+    """
+    name = 'stub'
+
+    def reverse(self, latitude: float, longitude: float,
+                language: str) -> Location:
+        return Location(address=f'{latitude:.5f}, {longitude:.5f}')
+
+
+class RateLimiter:
+    """
+    Makes requests to go not more often than once in a given interval
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.next_time = 0.0
+        self._lock = Lock()
+
+    def wait(self, max_wait: float) -> None:
+        """
+        Waits for a turn to make a request
+
+        :param max_wait: how many seconds the caller agrees to wait
+        :return: None
+        """
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0.0, self.next_time - now)
+            if delay > max_wait:
+                raise GeocoderUnavailable('Too many requests to the geocoder '
+                                          'are waiting for their turn')
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if delay:
+            time.sleep(delay)
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a service after several failures in a row
+
+    When the breaker is open all requests are rejected at once. After
+    reset_timeout it lets one trial request through (half-open state); if
+    it succeeds, the breaker closes again, otherwise it opens again
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._lock = Lock()
+
+    def allow(self) -> bool:
+        """
+        Checks whether a request can be made now
+
+        :return: True if the request can be made
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (self.state == self.OPEN and
+                    time.monotonic() - self.opened_at >= self.reset_timeout):
+                self.state = self.HALF_OPEN
+                return True
+            # either it is open or a trial request is already being made
+            return False
+
+    def cancel_trial(self) -> None:
+        """
+        Gives back the trial request if it hasn't been made, so that the
+        next request is the trial one
+
+        :return: None
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_success(self) -> None:
+        """
+        Closes the breaker after a successful request
+
+        :return: None
+        """
+        with self._lock:
+            if self.state != self.CLOSED:
+                log.info('Geocoder works again, closing the circuit breaker')
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        """
+        Counts a failed request and opens the breaker if there were too many
+        of them in a row
+
+        :return: None
+        """
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                if self.state != self.OPEN:
+                    log.warning('Geocoder has failed %d times in a row, '
+                                'opening the circuit breaker for %d seconds',
+                                self.failures, self.reset_timeout)
+                    self.times_opened += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+@dataclass
+class GeocoderMetrics:
+    """
+    Statistics of requests to the geocoder
+    """
+    requests: int = 0
+    errors: int = 0
+    rejected: int = 0  # requests that were not made at all
+    total_latency: float = 0  # in seconds
+    max_latency: float = 0  # in seconds
+
+
+class Geocoder:
+    """
+    Long-lived client of a geocoding service for the whole bot
+    """
+
+    def __init__(self, provider: Optional[Provider] = None) -> None:
+        self.timeout = config.GEOCODER_TIMEOUT
+        if provider:
+            self.provider = provider
+        elif config.GEOCODER_PROVIDER == 'stub':
+            self.provider = StubProvider()
+        else:
+            self.provider = NominatimProvider(config.NOMINATIM_URL,
+                                              user_agent='photoGPSbot',
+                                              timeout=self.timeout)
+        # every worker process has a limiter of its own, together they
+        # don't ask the geocoder more often than once in GEOCODER_INTERVAL
+        self.rate_limiter = RateLimiter(config.GEOCODER_INTERVAL *
+                                        config.WORKERS)
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        self.metrics = GeocoderMetrics()
+        self._lock = Lock()
+
+    def reverse(self, latitude: float, longitude: float,
+                language: str) -> Location:
+        """
+        Get address by coordinates
+
+        :param latitude: latitude in decimal degrees
+        :param longitude: longitude in decimal degrees
+        :param language: two letter code of a language of the address
+        :return: Location object with the address
+        """
+        # Ask the breaker first, so that photos don't wait for the turn
+        # only to be rejected while the geocoder is down
+        if not self.breaker.allow():
+            with self._lock:
+                self.metrics.rejected += 1
+            raise GeocoderUnavailable('Geocoder is not available right now')
+
+        try:
+            self.rate_limiter.wait(max_wait=self.timeout)
+        except GeocoderUnavailable:
+            # it could be the trial request that the breaker let through
+            self.breaker.cancel_trial()
+            with self._lock:
+                self.metrics.rejected += 1
+            raise
+
+        start = time.perf_counter()
+        try:
+            location = self.provider.reverse(latitude, longitude, language)
+        except Exception:
+            # anything else than a location, a bug in parsing of an answer
+            # too, is a failure, otherwise a trial request could leave the
+            # breaker half-open for good
+            self.breaker.record_failure()
+            with self._lock:
+                self.metrics.errors += 1
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            with self._lock:
+                self.metrics.requests += 1
+                self.metrics.total_latency += latency
+                self.metrics.max_latency = max(self.metrics.max_latency,
+                                               latency)
+
+        self.breaker.record_success()
+        return location
+
+    def __str__(self) -> str:
+        metrics = self.metrics
+        average = (metrics.total_latency / metrics.requests * 1000
+                   if metrics.requests else 0)
+        return (f'Geocoder ({self.provider.name}): {metrics.requests} '
+                f'requests, {metrics.errors} errors, {metrics.rejected} '
+                f'rejected. Latency: average {average:.0f} ms, max '
+                f'{metrics.max_latency * 1000:.0f} ms. Circuit breaker is '
+                f'{self.breaker.state}, it has been opened '
+                f'{self.breaker.times_opened} times.')
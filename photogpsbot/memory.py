@@ -0,0 +1,211 @@
+"""
+Module that shows the admin how much memory the bot takes and what takes it.
+
+Caches and queues of the bot register here with a function that returns
+their containers (dictionaries, lists and so on). On the admin command the
+registry counts entries of every one of them and estimates their size: a
+container is measured with sys.getsizeof together with its items a few
+levels deep, big containers are measured by a sample of items, so the
+numbers are approximate but cheap to get even for all users of the bot.
+Caches that don't show their entries, like functools.lru_cache, estimate
+their size by themselves.
+The report also has the resident set size (RSS) of the process.
+
+For leaks that are not in registered caches there is tracemalloc: the first
+command starts tracing allocations, every next one shows the lines of code
+that have allocated the most memory since the previous one.
+"""
+
+import itertools
+import sys
+import tracemalloc
+from collections import deque
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+from weakref import WeakSet
+
+# Returns containers of a cache
+Containers = Callable[[], Iterable[Any]]
+
+# number of items of a container that its size is estimated by
+SAMPLE_SIZE = 100
+# how deep items of items are measured
+MAX_DEPTH = 3
+
+
+def approximate_size(obj: Any, depth: int = MAX_DEPTH) -> int:
+    """
+    Estimates how many bytes an object takes together with objects in it
+
+    Objects that are shared by several containers (interned strings, small
+    numbers) are counted in every one of them
+
+    :param obj: any object
+    :param depth: how many levels of nested objects to measure
+    :return: size in bytes
+    """
+    size = sys.getsizeof(obj)
+    if depth <= 0 or isinstance(obj, (str, bytes, int, float)):
+        return size
+
+    if isinstance(obj, dict):
+        items = list(itertools.islice(obj.items(), SAMPLE_SIZE))
+        if items:
+            sample = sum(approximate_size(key, depth - 1) +
+                         approximate_size(value, depth - 1)
+                         for key, value in items)
+            size += sample * len(obj) // len(items)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque, WeakSet)):
+        items = list(itertools.islice(obj, SAMPLE_SIZE))
+        if items:
+            sample = sum(approximate_size(item, depth - 1) for item in items)
+            size += sample * len(obj) // len(items)
+    elif hasattr(obj, '__dict__'):
+        size += approximate_size(vars(obj), depth - 1)
+    elif hasattr(type(obj), '__slots__'):
+        size += sum(approximate_size(getattr(obj, name, None), depth - 1)
+                    for name in type(obj).__slots__)
+    return size
+
+
+def get_rss() -> Optional[int]:
+    """
+    Finds out how much memory the process takes now
+
+    :return: resident set size in bytes or None if it is unknown
+    """
+    try:
+        with open('/proc/self/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    # it is the peak size and not the current one, in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def format_size(size: float) -> str:
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return f'{size:.0f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+
+class MemoryRegistry:
+    """
+    Registry of caches of the bot that reports their sizes
+    """
+
+    def __init__(self) -> None:
+        self.caches: Dict[str, Tuple[Containers,
+                                     Optional[Callable[[], int]],
+                                     Optional[Callable[[], int]]]] = {}
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self._lock = Lock()
+
+    def register(self, name: str, containers: Containers,
+                 entries: Optional[Callable[[], int]] = None,
+                 size: Optional[Callable[[], int]] = None) -> None:
+        """
+        Adds a cache to the report
+
+        :param name: name of the cache in the report
+        :param containers: function that returns containers of the cache
+        :param entries: function that counts entries of the cache if they
+        are not in the containers, like in functools.lru_cache
+        :param size: function that estimates the size of such a cache in
+        bytes
+        :return: None
+        """
+        self.caches[name] = containers, entries, size
+
+    def report(self) -> str:
+        """
+        Counts entries and estimates sizes of registered caches
+
+        :return: report for the admin
+        """
+        rss = get_rss()
+        report = (f'RSS: {format_size(rss) if rss else "unknown"}\n'
+                  f'Cache: entries, approximate size\n')
+        total = 0
+        for name, (get_containers, count_entries,
+                   estimate_size) in self.caches.items():
+            # caches are changed by other threads while they are measured,
+            # then they are measured again
+            for _ in range(3):
+                try:
+                    containers = list(get_containers())
+                    if count_entries:
+                        entries = count_entries()
+                    else:
+                        entries = sum(len(container)
+                                      for container in containers)
+                    if estimate_size:
+                        size = estimate_size()
+                    else:
+                        size = sum(approximate_size(container)
+                                   for container in containers)
+                    break
+                except RuntimeError:
+                    continue
+            else:
+                report += f'{name}: it is changing too fast to measure\n'
+                continue
+            total += size
+            report += f'{name}: {entries}, {format_size(size)}\n'
+        report += f'Total: {format_size(total)}'
+        if tracemalloc.is_tracing():
+            report += '\ntracemalloc is tracing allocations.'
+        return report
+
+    def trace(self, limit: int = 15) -> str:
+        """
+        Starts tracing allocations or shows what has been allocated since
+        the previous call
+
+        :param limit: number of lines of code to show
+        :return: report for the admin
+        """
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.snapshot = tracemalloc.take_snapshot()
+                return ('tracemalloc has started to trace allocations, the '
+                        'next command will show what has been allocated.')
+
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(False, tracemalloc.__file__),))
+            stats = snapshot.compare_to(self.snapshot, 'lineno')
+            self.snapshot = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        report = (f'Traced memory: {format_size(current)}, peak '
+                  f'{format_size(peak)}\n'
+                  f'Allocated since the previous snapshot:\n')
+        for stat in stats[:limit]:
+            frame = stat.traceback[0]
+            report += (f'{format_size(stat.size_diff)} in '
+                       f'{stat.count_diff:+d} blocks: '
+                       f'{frame.filename.split("/")[-1]}:{frame.lineno}\n')
+        return report
+
+    def stop_tracing(self) -> str:
+        """
+        Stops tracing allocations, tracemalloc slows down the bot a lot
+
+        :return: report for the admin
+        """
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                return 'tracemalloc is not tracing allocations.'
+            tracemalloc.stop()
+            self.snapshot = None
+        return 'tracemalloc has stopped.'
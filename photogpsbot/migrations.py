@@ -0,0 +1,610 @@
+"""
+Module with the schema of the database of the bot and versioned migrations
+to create and upgrade it.
+
+Every migration has a version; versions that have been applied are stored in
+schema_version table, so upgrading runs only the new ones. Indexes are made
+for the queries that the bot actually runs, and the check command runs
+EXPLAIN on every one of these queries to find those that scan whole tables.
+
+Usage:
+python -m photogpsbot.migrations status
+python -m photogpsbot.migrations upgrade
+python -m photogpsbot.migrations check
+"""
+
+import argparse
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple, Union
+
+from photogpsbot import log, db, country_resolver, name_normalizer
+import config
+
+# A step of a migration is either a query or a function that does something
+# more complex than one query
+Step = Union[str, Callable[[], None]]
+
+# rows that are updated in one transaction when a column is filled
+BACKFILL_BATCH = 10000
+
+# names of countries that geocoders used to give and that differ from names
+# in the table of countries
+COUNTRY_ALIASES = {
+    'united states of america': 'US',
+    'usa': 'US',
+    'сша': 'US',
+    'russian federation': 'RU',
+    'российская федерация': 'RU',
+    'рф': 'RU',
+    'czech republic': 'CZ',
+    'чешская республика': 'CZ',
+    'republic of korea': 'KR',
+    'республика корея': 'KR',
+    'türkiye': 'TR',
+    'viet nam': 'VN',
+    'the netherlands': 'NL',
+    'macedonia': 'MK',
+    'swaziland': 'SZ',
+}
+
+
+class MigrationError(Exception):
+    """
+    A migration cannot be applied without losing data
+    """
+
+
+@dataclass
+class Migration:
+    """
+    One version of the schema of the database
+    """
+    version: int
+    description: str
+    steps: List[Step] = field(default_factory=list)
+
+
+@dataclass
+class HotQuery:
+    """
+    A query that the bot runs often with example parameters to check its
+    execution plan
+    """
+    name: str
+    query: str
+    parameters: Tuple = ()
+
+
+def add_index(table: str, name: str, columns: str,
+              unique: bool = False) -> Callable[[], None]:
+    """
+    Makes a step that adds an index if there is no index with this name
+
+    MySQL doesn't have CREATE INDEX IF NOT EXISTS and some of the indexes
+    could have been added by hand before migrations appeared
+
+    :param table: name of a table
+    :param name: name of the index
+    :param columns: columns of the index separated by commas
+    :param unique: whether the index is unique
+    :return: function that adds the index
+    """
+
+    def step() -> None:
+        query = ('SELECT COUNT(*) '
+                 'FROM information_schema.statistics '
+                 'WHERE table_schema=DATABASE() '
+                 'AND table_name=%s AND index_name=%s')
+        cursor = db.execute_query(query, (table, name), primary=True)
+        if cursor.fetchone()[0]:
+            log.info('Index %s on %s already exists', name, table)
+            return
+
+        log.info('Adding index %s on %s (%s)...', name, table, columns)
+        db.execute_query(f'CREATE {"UNIQUE " if unique else ""}INDEX {name} '
+                         f'ON {table} ({columns})')
+
+    step.__name__ = f'add_index_{name}'
+    return step
+
+
+def add_column(table: str, name: str, definition: str) -> Callable[[], None]:
+    """
+    Makes a step that adds a column if there is no column with this name
+
+    :param table: name of a table
+    :param name: name of the column
+    :param definition: type and attributes of the column
+    :return: function that adds the column
+    """
+
+    def step() -> None:
+        query = ('SELECT COUNT(*) '
+                 'FROM information_schema.columns '
+                 'WHERE table_schema=DATABASE() '
+                 'AND table_name=%s AND column_name=%s')
+        cursor = db.execute_query(query, (table, name), primary=True)
+        if cursor.fetchone()[0]:
+            log.info('Column %s of %s already exists', name, table)
+            return
+
+        log.info('Adding column %s to %s...', name, table)
+        db.execute_query(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+
+    step.__name__ = f'add_column_{name}'
+    return step
+
+
+def deduplicate_tags() -> None:
+    """
+    Deletes repeated collations of the same wrong tag before the unique
+    index is made on it. The oldest collation is kept, it is the one the
+    bot has found first so far
+
+    :return: None
+    """
+    cursor = db.execute_query('DELETE newer FROM tag_table newer '
+                              'INNER JOIN tag_table older '
+                              'ON newer.wrong_tag = older.wrong_tag '
+                              'AND newer.id > older.id', primary=True)
+    db.conn.commit()
+    if cursor.rowcount:
+        log.info('%d repeated collations have been deleted from tag_table',
+                 cursor.rowcount)
+
+
+def find_country_code(*names: str) -> Optional[str]:
+    """
+    Finds a code of a country by its name in any language of the bot
+
+    :param names: names of the same country, some of them can be None
+    :return: ISO 3166-1 alpha-2 code or None if the country is unknown
+    """
+    codes = dict(COUNTRY_ALIASES)
+    for code, localized_names in country_resolver.names.items():
+        for name in localized_names.values():
+            codes[name.lower()] = code
+
+    for name in names:
+        if name and name.strip().lower() in codes:
+            return codes[name.strip().lower()]
+    return None
+
+
+def backfill_country_codes() -> None:
+    """
+    Fills country_code of photo_queries_table2 from names of countries
+
+    Every distinct pair of names is updated in batches, so a big table is
+    not locked by one long transaction
+
+    :return: None
+    """
+    cursor = db.execute_query('SELECT DISTINCT country_en, country_ru '
+                              'FROM photo_queries_table2 '
+                              'WHERE country_code IS NULL '
+                              'AND (country_en IS NOT NULL '
+                              'OR country_ru IS NOT NULL)', primary=True)
+    unknown = []
+    for country_en, country_ru in cursor.fetchall():
+        code = find_country_code(country_en, country_ru)
+        if not code:
+            unknown.append(f'{country_en} / {country_ru}')
+            continue
+
+        updated = 0
+        while True:
+            cursor = db.execute_query(
+                'UPDATE photo_queries_table2 SET country_code=%s '
+                'WHERE country_code IS NULL '
+                'AND country_en <=> %s AND country_ru <=> %s '
+                f'LIMIT {BACKFILL_BATCH}',
+                (code, country_en, country_ru), primary=True)
+            db.conn.commit()
+            updated += cursor.rowcount
+            if cursor.rowcount < BACKFILL_BATCH:
+                break
+        log.info('%s: %d rows', code, updated)
+
+    if unknown:
+        log.warning('Cannot find codes of these countries: %s. Add them to '
+                    'COUNTRY_ALIASES and run upgrade again',
+                    ', '.join(unknown))
+
+
+def drop_country_names() -> None:
+    """
+    Drops columns with names of countries once all of them have codes
+
+    :return: None
+    """
+    cursor = db.execute_query('SELECT COUNT(*) FROM photo_queries_table2 '
+                              'WHERE country_code IS NULL '
+                              'AND (country_en IS NOT NULL '
+                              'OR country_ru IS NOT NULL)', primary=True)
+    left = cursor.fetchone()[0]
+    if left:
+        raise MigrationError(f'{left} rows have names of countries without '
+                             'codes, names are not dropped')
+
+    log.info('Dropping country_en and country_ru...')
+    db.execute_query('ALTER TABLE photo_queries_table2 '
+                     'DROP INDEX country_en_chat_idx, '
+                     'DROP INDEX country_ru_chat_idx, '
+                     'DROP COLUMN country_en, '
+                     'DROP COLUMN country_ru')
+
+
+def backfill_dimension(name_column: str, table: str,
+                       id_column: str) -> Callable[[], None]:
+    """
+    Makes a step that moves names of cameras or lenses to their own table
+    and fills their ids in photo_queries_table2
+
+    :param name_column: column of photo_queries_table2 with names
+    :param table: table of names with their ids
+    :param id_column: column of photo_queries_table2 for the ids
+    :return: function that fills the table and the column
+    """
+
+    def step() -> None:
+        log.info('Copying names from %s to %s...', name_column, table)
+        db.execute_query(f'INSERT IGNORE INTO {table} (name) '
+                         f'SELECT DISTINCT {name_column} '
+                         'FROM photo_queries_table2 '
+                         f"WHERE {name_column} IS NOT NULL "
+                         f"AND {name_column} != ''", primary=True)
+        db.conn.commit()
+
+        cursor = db.execute_query('SELECT MAX(id) FROM photo_queries_table2',
+                                  primary=True)
+        last_id = cursor.fetchone()[0] or 0
+        # rows are updated by ranges of the primary key, so a big table is
+        # not locked by one long transaction
+        for start in range(0, last_id, BACKFILL_BATCH):
+            db.execute_query(f'UPDATE photo_queries_table2 p '
+                             f'JOIN {table} d ON d.name = p.{name_column} '
+                             f'SET p.{id_column} = d.id '
+                             'WHERE p.id > %s AND p.id <= %s '
+                             f'AND p.{id_column} IS NULL',
+                             (start, start + BACKFILL_BATCH), primary=True)
+            db.conn.commit()
+        log.info('%s has been filled up to row %d', id_column, last_id)
+
+    step.__name__ = f'backfill_{id_column}'
+    return step
+
+
+def drop_camera_names() -> None:
+    """
+    Drops columns with names of cameras and lenses once all of them have ids
+
+    :return: None
+    """
+    cursor = db.execute_query('SELECT COUNT(*) FROM photo_queries_table2 '
+                              "WHERE (camera_name != '' "
+                              'AND camera_id IS NULL) '
+                              "OR (lens_name != '' AND lens_id IS NULL)",
+                              primary=True)
+    left = cursor.fetchone()[0]
+    if left:
+        raise MigrationError(f'{left} rows have names of cameras or lenses '
+                             'without ids, names are not dropped')
+
+    log.info('Dropping camera_name and lens_name...')
+    db.execute_query('ALTER TABLE photo_queries_table2 '
+                     'DROP INDEX camera_chat_idx, '
+                     'DROP INDEX lens_chat_idx, '
+                     'DROP INDEX time_camera_idx, '
+                     'DROP COLUMN camera_name, '
+                     'DROP COLUMN lens_name')
+
+
+def normalize_tags() -> None:
+    """
+    Rewrites wrong tags of tag_table the way names are normalized now, so
+    that collations keep matching names of cameras and lenses
+
+    :return: None
+    """
+    cursor = db.execute_query('SELECT id, wrong_tag FROM tag_table',
+                              primary=True)
+    for tag_id, wrong_tag in cursor.fetchall():
+        new_tag = name_normalizer.normalize(None, wrong_tag)
+        if new_tag and new_tag != wrong_tag:
+            # there can already be a collation for the new tag
+            db.execute_query('UPDATE IGNORE tag_table SET wrong_tag=%s '
+                             'WHERE id=%s', (new_tag, tag_id), primary=True)
+    db.conn.commit()
+
+
+def normalize_dimension(table: str, id_column: str) -> Callable[[], None]:
+    """
+    Makes a step that renames cameras or lenses the way names are
+    normalized now and moves photos of names that become the same to one id
+
+    Old names stay in the table, so charts that still count their ids can
+    show them
+
+    :param table: table of names with their ids
+    :param id_column: column of photo_queries_table2 with the ids
+    :return: function that renames them
+    """
+
+    def step() -> None:
+        cursor = db.execute_query('SELECT wrong_tag, right_tag FROM tag_table',
+                                  primary=True)
+        collations = {wrong_tag.lower(): right_tag
+                      for wrong_tag, right_tag in cursor.fetchall()}
+        cursor = db.execute_query(f'SELECT id, name FROM {table}',
+                                  primary=True)
+        rows = cursor.fetchall()
+        names = {name.lower(): item_id for item_id, name in rows}
+
+        moved = 0
+        for old_id, old_name in rows:
+            new_name = name_normalizer.normalize(None, old_name)
+            new_name = collations.get((new_name or '').lower(), new_name)
+            if not new_name or new_name == old_name:
+                continue
+            if new_name.lower() == old_name.lower():
+                # names are compared case-insensitively, so it is the same
+                # name, only its case has been changed
+                db.execute_query(f'UPDATE {table} SET name=%s WHERE id=%s',
+                                 (new_name, old_id), primary=True)
+                db.conn.commit()
+                continue
+
+            new_id = names.get(new_name.lower())
+            if not new_id:
+                db.execute_query(f'INSERT INTO {table} (name) VALUES (%s)',
+                                 (new_name,), primary=True)
+                new_id = names[new_name.lower()] = db.conn.insert_id()
+            while True:
+                cursor = db.execute_query(
+                    f'UPDATE photo_queries_table2 SET {id_column}=%s '
+                    f'WHERE {id_column}=%s LIMIT {BACKFILL_BATCH}',
+                    (new_id, old_id), primary=True)
+                db.conn.commit()
+                moved += cursor.rowcount
+                if cursor.rowcount < BACKFILL_BATCH:
+                    break
+        log.info('%d photos have got new names of %s', moved, table)
+
+    step.__name__ = f'normalize_{table}'
+    return step
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, 'Tables of the bot', [
+        'CREATE TABLE IF NOT EXISTS users ('
+        'chat_id BIGINT NOT NULL PRIMARY KEY, '
+        'first_name VARCHAR(255) NULL, '
+        'nickname VARCHAR(255) NULL, '
+        'last_name VARCHAR(255) NULL, '
+        "language VARCHAR(5) NOT NULL DEFAULT 'en-US'"
+        ') ENGINE=InnoDB DEFAULT CHARSET=utf8mb4',
+
+        'CREATE TABLE IF NOT EXISTS photo_queries_table2 ('
+        'id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, '
+        'time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+        'chat_id BIGINT NOT NULL, '
+        'camera_name VARCHAR(255) NULL, '
+        'lens_name VARCHAR(255) NULL, '
+        'country_en VARCHAR(100) NULL, '
+        'country_ru VARCHAR(100) NULL'
+        ') ENGINE=InnoDB DEFAULT CHARSET=utf8mb4',
+
+        'CREATE TABLE IF NOT EXISTS tag_table ('
+        'id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, '
+        'wrong_tag VARCHAR(255) NOT NULL, '
+        'right_tag VARCHAR(255) NOT NULL'
+        ') ENGINE=InnoDB DEFAULT CHARSET=utf8mb4',
+    ]),
+    Migration(2, 'Indexes for charts, statistics and lookups', [
+        # charts group by these columns and counts of users with the same
+        # feature look for distinct chat_id with a given value
+        add_index('photo_queries_table2', 'camera_chat_idx',
+                  'camera_name, chat_id'),
+        add_index('photo_queries_table2', 'lens_chat_idx',
+                  'lens_name, chat_id'),
+        add_index('photo_queries_table2', 'country_en_chat_idx',
+                  'country_en, chat_id'),
+        add_index('photo_queries_table2', 'country_ru_chat_idx',
+                  'country_ru, chat_id'),
+        # last active users and cleaning of the cache of users
+        add_index('photo_queries_table2', 'chat_time_idx', 'chat_id, time'),
+        # statistics for today for the admin
+        add_index('photo_queries_table2', 'time_chat_idx', 'time, chat_id'),
+        add_index('photo_queries_table2', 'time_camera_idx',
+                  'time, camera_name'),
+        # collation of names of cameras and lenses
+        deduplicate_tags,
+        add_index('tag_table', 'wrong_tag_idx', 'wrong_tag', unique=True),
+    ]),
+    Migration(3, 'Codes of countries instead of their names', [
+        # names of countries are taken from the table of countries in the
+        # language of the user when they are shown
+        add_column('photo_queries_table2', 'country_code', 'CHAR(2) NULL'),
+        backfill_country_codes,
+        add_index('photo_queries_table2', 'country_code_chat_idx',
+                  'country_code, chat_id'),
+        drop_country_names,
+    ]),
+    Migration(4, 'Tables of names of cameras and lenses', [
+        'CREATE TABLE IF NOT EXISTS cameras ('
+        'id MEDIUMINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, '
+        'name VARCHAR(255) NOT NULL, '
+        'UNIQUE KEY name_idx (name)'
+        ') ENGINE=InnoDB DEFAULT CHARSET=utf8mb4',
+
+        'CREATE TABLE IF NOT EXISTS lenses ('
+        'id MEDIUMINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, '
+        'name VARCHAR(255) NOT NULL, '
+        'UNIQUE KEY name_idx (name)'
+        ') ENGINE=InnoDB DEFAULT CHARSET=utf8mb4',
+
+        add_column('photo_queries_table2', 'camera_id',
+                   'MEDIUMINT UNSIGNED NULL'),
+        add_column('photo_queries_table2', 'lens_id',
+                   'MEDIUMINT UNSIGNED NULL'),
+        backfill_dimension('camera_name', 'cameras', 'camera_id'),
+        backfill_dimension('lens_name', 'lenses', 'lens_id'),
+        # the same indexes as for names before
+        add_index('photo_queries_table2', 'camera_id_chat_idx',
+                  'camera_id, chat_id'),
+        add_index('photo_queries_table2', 'lens_id_chat_idx',
+                  'lens_id, chat_id'),
+        add_index('photo_queries_table2', 'time_camera_id_idx',
+                  'time, camera_id'),
+        drop_camera_names,
+    ]),
+    Migration(5, 'Names of cameras and lenses made by the normalizer', [
+        normalize_tags,
+        normalize_dimension('cameras', 'camera_id'),
+        normalize_dimension('lenses', 'lens_id'),
+    ]),
+]
+
+# Queries that the bot runs, keep them in sync with the modules they are
+# taken from
+HOT_QUERIES: List[HotQuery] = [
+    HotQuery('find user', 'SELECT first_name, nickname, last_name, language '
+                          'FROM users WHERE chat_id=%s', (1,)),
+    HotQuery('collation of a tag', 'SELECT right_tag FROM tag_table '
+                                   'WHERE wrong_tag=%s', ('NIKON',)),
+    HotQuery('last active users',
+             'SELECT p.chat_id, u.first_name, u.nickname, u.last_name, '
+             'u.language '
+             'FROM photo_queries_table2 p '
+             'INNER JOIN users u ON p.chat_id = u.chat_id '
+             'GROUP BY u.chat_id, u.first_name, u.nickname, u.last_name, '
+             'u.language '
+             'ORDER BY MAX(time) DESC LIMIT %s', (100,)),
+    HotQuery('photos today',
+             'SELECT COUNT(chat_id) FROM photo_queries_table2 '
+             'WHERE time > %s', ('2019-01-01 00:00:00',)),
+    HotQuery('photos today except admin',
+             'SELECT COUNT(chat_id) FROM photo_queries_table2 '
+             'WHERE time > %s AND chat_id !=%s', ('2019-01-01 00:00:00', 1)),
+    HotQuery('users today',
+             'SELECT COUNT(DISTINCT chat_id) FROM photo_queries_table2 '
+             'WHERE time > %s', ('2019-01-01 00:00:00',)),
+    HotQuery('gadgets today',
+             'SELECT COUNT(DISTINCT camera_id) FROM photo_queries_table2 '
+             'WHERE time > %s', ('2019-01-01 00:00:00',)),
+]
+
+for table in ('cameras', 'lenses'):
+    HOT_QUERIES.append(HotQuery(f'id of a name in {table}',
+                                f'SELECT id FROM {table} WHERE name=%s',
+                                ('x',)))
+
+for column in ('camera_id', 'lens_id', 'country_code'):
+    HOT_QUERIES.append(HotQuery(f'chart by {column}',
+                                f'SELECT {column} FROM photo_queries_table2 '
+                                f'GROUP BY {column} '
+                                f'ORDER BY count({column}) DESC'))
+    HOT_QUERIES.append(HotQuery(f'users with the same {column}',
+                                'SELECT COUNT(DISTINCT chat_id) '
+                                'FROM photo_queries_table2 '
+                                f'WHERE {column}=%s', ('x',)))
+
+
+def get_version() -> int:
+    """
+    Finds out the current version of the schema
+
+    :return: number of the last applied migration or 0 if there were none
+    """
+    db.execute_query('CREATE TABLE IF NOT EXISTS schema_version ('
+                     'version INT NOT NULL PRIMARY KEY, '
+                     'description VARCHAR(255) NOT NULL, '
+                     'applied_at TIMESTAMP NOT NULL '
+                     'DEFAULT CURRENT_TIMESTAMP'
+                     ') ENGINE=InnoDB DEFAULT CHARSET=utf8mb4')
+    cursor = db.execute_query('SELECT MAX(version) FROM schema_version',
+                              primary=True)
+    return cursor.fetchone()[0] or 0
+
+
+def upgrade() -> None:
+    """
+    Applies all the migrations that have not been applied yet
+
+    :return: None
+    """
+    version = get_version()
+    pending = [migration for migration in MIGRATIONS
+               if migration.version > version]
+    if not pending:
+        log.info('The schema is up to date (version %d)', version)
+        return
+
+    for migration in pending:
+        log.info('Applying migration %d: %s...', migration.version,
+                 migration.description)
+        for step in migration.steps:
+            if callable(step):
+                step()
+            else:
+                db.execute_query(step)
+        db.add('INSERT INTO schema_version (version, description) '
+               'VALUES (%s, %s)', (migration.version, migration.description))
+        log.info('Migration %d has been applied', migration.version)
+
+
+def check() -> bool:
+    """
+    Runs EXPLAIN on every hot query and reports those that read the whole
+    table
+
+    :return: True if there are no full table scans
+    """
+    no_full_scans = True
+    for hot_query in HOT_QUERIES:
+        cursor = db.execute_query(f'EXPLAIN {hot_query.query}',
+                                  hot_query.parameters or None)
+        columns = [description[0] for description in cursor.description]
+        for row in cursor.fetchall():
+            plan = dict(zip(columns, row))
+            access_type = plan.get('type')
+            line = (f'{hot_query.name}: table {plan.get("table")}, '
+                    f'access {access_type}, key {plan.get("key")}, '
+                    f'rows {plan.get("rows")}, {plan.get("Extra") or ""}')
+            if access_type == 'ALL':
+                no_full_scans = False
+                print(f'FULL SCAN  {line}')
+            else:
+                print(f'ok         {line}')
+
+    return no_full_scans
+
+
+def main() -> None:
+    """
+    Parses command line arguments and runs a command
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(
+        description=f'Manage the schema of the database {config.DB_NAME}')
+    parser.add_argument('command', choices=('status', 'upgrade', 'check'))
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'status':
+            version = get_version()
+            latest = MIGRATIONS[-1].version
+            print(f'Schema version {version}, the latest is {latest}.')
+        elif args.command == 'upgrade':
+            upgrade()
+        elif args.command == 'check':
+            if not check():
+                raise SystemExit(1)
+    finally:
+        db.disconnect()
+
+
+if __name__ == '__main__':
+    main()
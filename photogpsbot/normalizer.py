@@ -0,0 +1,155 @@
+"""
+Module that turns brands and models of cameras and lenses from EXIF into
+tidy names like "Nikon D750" instead of "NIKON CORPORATION NIKON D750".
+
+Rules are read once from a JSON file (photogpsbot/name_rules.json):
+aliases of every brand are put into a trie of words, so the brand at the
+beginning of a string is found in one pass over its words, however many
+aliases there are. A name is made like this:
+
+1. Characters from strip_characters are removed, whitespace is collapsed.
+2. The brand is replaced with its canonical name if it is a known alias.
+3. A known brand at the beginning of the model is cut off (EXIF often
+   repeats the brand in the model); if it is another brand, for example
+   "PENTAX K-1" made by "RICOH IMAGING COMPANY, LTD.", it is the brand
+   of the name.
+4. Repeated words are dropped, words are compared case-insensitively, but
+   as whole words, so "5D" and "5" are different.
+
+Names are memoized in a bounded LRU cache, there are not many distinct
+cameras and lenses, so almost every photo is a hit.
+"""
+
+import json
+import sys
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+# key of a node of the trie that holds the canonical brand
+_BRAND = ''
+
+# bytes that functools.lru_cache takes for one entry besides the strings in
+# it: a link of its list, a key and a place in its dictionary
+LRU_ENTRY_OVERHEAD = 170
+
+
+class NameNormalizer:
+    """
+    Makes names of cameras and lenses out of brands and models from EXIF
+    """
+
+    def __init__(self, brands: Dict[str, List[str]],
+                 strip_characters: str = '',
+                 cache_size: int = 10000) -> None:
+        """
+        Init variables and compile rules
+
+        :param brands: canonical names of brands with their aliases in lower
+        case
+        :param strip_characters: characters that are removed from names
+        :param cache_size: how many names to remember
+        """
+        self.trie: dict = {}
+        for brand, aliases in brands.items():
+            for alias in [brand] + aliases:
+                node = self.trie
+                for word in alias.lower().split():
+                    node = node.setdefault(word, {})
+                node[_BRAND] = brand
+        self.strip_table = str.maketrans('', '', strip_characters)
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+        # sizes of entries that have been added to the cache, lru_cache
+        # doesn't let anyone look at them later
+        self.measured_entries = 0
+        self.measured_size = 0
+
+    @classmethod
+    def from_file(cls, path: str, cache_size: int = 10000) \
+            -> 'NameNormalizer':
+        """
+        Makes a normalizer with rules from a JSON file
+
+        :param path: path to the file with rules
+        :param cache_size: how many names to remember
+        :return: NameNormalizer object
+        """
+        with open(path, 'r', encoding='utf8') as rules_file:
+            rules = json.load(rules_file)
+        return cls(rules['brands'], rules.get('strip_characters', ''),
+                   cache_size)
+
+    def _match_brand(self, words: List[str]) -> Tuple[Optional[str], int]:
+        """
+        Finds the longest alias of a brand at the beginning of words
+
+        :param words: words of a brand or a model
+        :return: canonical brand and number of words of the alias or None
+        and 0 if the words don't start with a brand
+        """
+        node = self.trie
+        brand, length = None, 0
+        for index, word in enumerate(words):
+            node = node.get(word.lower())
+            if node is None:
+                break
+            if _BRAND in node:
+                brand, length = node[_BRAND], index + 1
+        return brand, length
+
+    def _normalize(self, brand: Optional[str],
+                   model: Optional[str]) -> Optional[str]:
+        """
+        Makes a name of a camera or a lens. Use self.normalize, it is the
+        same function with memoization
+
+        :param brand: brand from EXIF, for example "NIKON CORPORATION"
+        :param model: model from EXIF, for example "NIKON D750"
+        :return: name like "Nikon D750" or None if there is neither brand
+        nor model
+        """
+        brand_words = (brand or '').translate(self.strip_table).split()
+        model_words = (model or '').translate(self.strip_table).split()
+
+        known_brand, length = self._match_brand(brand_words)
+        if known_brand and length == len(brand_words):
+            brand_words = [known_brand]
+
+        model_brand, length = self._match_brand(model_words)
+        if model_brand:
+            brand_words = [model_brand]
+            model_words = model_words[length:]
+
+        words = []
+        seen = set()
+        for word in brand_words + model_words:
+            key = word.lower()
+            if key not in seen:
+                seen.add(key)
+                words.append(word)
+        name = ' '.join(words) or None
+
+        # it is called only when there is no such a name in the cache yet,
+        # a lost update from another thread only makes the average rougher
+        self.measured_entries += 1
+        self.measured_size += (sys.getsizeof(brand) + sys.getsizeof(model) +
+                               sys.getsizeof(name) + LRU_ENTRY_OVERHEAD)
+        return name
+
+    def approximate_size(self) -> int:
+        """
+        Estimates how many bytes the cache of names takes
+
+        Entries of lru_cache can't be measured, so their number is multiplied
+        by the average size of entries that have been added to the cache
+
+        :return: size in bytes
+        """
+        if not self.measured_entries:
+            return 0
+        entries = self.normalize.cache_info().currsize
+        return entries * self.measured_size // self.measured_entries
+
+    def __str__(self) -> str:
+        info = self.normalize.cache_info()
+        return (f'Name normalizer: {info.currsize} of {info.maxsize} names '
+                f'are cached, {info.hits} hits, {info.misses} misses')
@@ -0,0 +1,62 @@
+"""
+Module that stores info about photos that users send to the bot (camera,
+lens, country etc) in photo_queries_table2 to keep statistics about them.
+
+The bot does not save photos or their coordinates.
+"""
+
+from typing import List, Optional, Tuple
+
+from photogpsbot import (log, db, chart_sketches, rolling_charts, cameras,
+                         lenses)
+from photogpsbot.process_image import ImageData
+
+INSERT_QUERY = ('INSERT INTO photo_queries_table2 '
+                '(chat_id, camera_id, lens_id, country_code) '
+                'VALUES (%s, %s, %s, %s)')
+
+
+def make_row(image_data: ImageData) -> Tuple:
+    """
+    Makes parameters for INSERT_QUERY out of info about a photo
+
+    :param image_data: an instance of ImageData dataclass with info about
+    the image
+    :return: tuple with values for every column of the query
+    """
+    return (image_data.user.chat_id, cameras.get_id(image_data.camera),
+            lenses.get_id(image_data.lens), image_data.country)
+
+
+def save(image_data: ImageData) -> None:
+    """
+    Insert info about one photo query to the database
+
+    :param image_data: an instance of ImageData dataclass with info about
+    the image
+    :return: None
+    """
+    log.info('Adding user query to photo_queries_table...')
+    row = make_row(image_data)
+    row_id = db.add(INSERT_QUERY, row, chat_id=image_data.user.chat_id)
+    # chat_id is the first value, the rest go to charts
+    chart_sketches.add(row_id, row[1:])
+    rolling_charts.add(row_id, row[1:])
+    log.info('User query was successfully added to the database.')
+
+
+def save_many(images: List[ImageData],
+              chat_id: Optional[int] = None) -> None:
+    """
+    Insert info about a lot of photo queries to the database in one go
+
+    :param images: list of ImageData objects with info about images
+    :param chat_id: id of a chat if all the photos come from it
+    :return: None
+    """
+    # Ids of rows added in one go are not known, so charts will read them
+    # from the table later
+    log.info('Adding %d queries to photo_queries_table...', len(images))
+    db.add_many(INSERT_QUERY, [make_row(image_data) for image_data in images],
+                chat_id=chat_id)
+    log.info('Queries were successfully added to the database.')
@@ -1,13 +1,14 @@
 from dataclasses import dataclass
-from typing import Dict, Tuple, List
+from threading import Event, Lock
+from typing import Callable, Dict, Tuple, List
 from io import BytesIO
 from typing import Optional
 
-import exifread  # type: ignore
 from exifread.classes import IfdTag  # type: ignore
-from geopy.geocoders import Nominatim  # type: ignore
 
-from photogpsbot import log, db, User
+from photogpsbot import (log, db, User, country_resolver, geocoder,
+                         name_normalizer, exif_pool)
+from photogpsbot.exif_pool import ExifReadError
 
 
 class InvalidCoordinates(Exception):
@@ -46,7 +47,8 @@ class ImageData:
     camera: Optional[str] = None
     lens: Optional[str] = None
     address: Optional[Dict[str, str]] = None
-    country: Optional[Dict[str, str]] = None
+    # ISO 3166-1 alpha-2 code of the country in upper case
+    country: Optional[str] = None
     latitude: float = 0
     longitude: float = 0
 
@@ -68,11 +70,90 @@ class RawImageData:
     raw_longitude: Optional[IfdTag] = None
 
 
+class AddressCache:
+    """
+    Addresses of places that photos of one album have been taken at
+
+    Photos of an album are usually taken close to each other, so an address
+    is asked from the geocoder once for every place about 100 meters wide.
+    Files of an album are handled by several threads at once, so while one
+    of them asks the geocoder about a place, the others that need the same
+    place wait for its answer instead of asking too
+    """
+    # number of decimal places that coordinates are rounded to
+    precision = 3
+
+    def __init__(self) -> None:
+        self.addresses: Dict[Tuple[float, float],
+                             Tuple[str, Optional[str]]] = {}
+        # places that are being looked up now and events that are set when
+        # the lookup is over
+        self.in_flight: Dict[Tuple[float, float], Event] = {}
+        self.hits = 0
+        self._lock = Lock()
+
+    def _key(self, latitude: float, longitude: float) -> Tuple[float, float]:
+        return (round(latitude, self.precision),
+                round(longitude, self.precision))
+
+    def get_address(self, latitude: float, longitude: float,
+                    find: Callable[[float, float], Tuple[str, Optional[str]]]
+                    ) -> Tuple[str, Optional[str]]:
+        """
+        Gives an address of a place near given coordinates
+
+        If the place isn't known yet and nobody is looking it up, the address
+        is found by the given function and remembered. If it fails, the
+        exception goes to the caller and the next thread that waits for the
+        place tries by itself
+
+        :param latitude: latitude in decimal degrees
+        :param longitude: longitude in decimal degrees
+        :param find: function that finds an address and a country by
+        coordinates
+        :return: address and code of the country if it is known
+        """
+        key = self._key(latitude, longitude)
+        while True:
+            with self._lock:
+                found = self.addresses.get(key)
+                if found:
+                    self.hits += 1
+                    log.debug('Taking address of a nearby photo of the '
+                              'album')
+                    return found
+                event = self.in_flight.get(key)
+                if not event:
+                    event = self.in_flight[key] = Event()
+                    break
+            event.wait()
+
+        try:
+            address, country = find(latitude, longitude)
+            with self._lock:
+                self.addresses[key] = address, country
+            return address, country
+        finally:
+            with self._lock:
+                del self.in_flight[key]
+            event.set()
+
+
 class ImageHandler:
 
-    def __init__(self, user: User, file: BytesIO) -> None:
+    def __init__(self, user: User, file: BytesIO,
+                 address_cache: Optional[AddressCache] = None) -> None:
+        """
+        Init variables
+
+        :param user: user who sent the photo
+        :param file: file-like object with the photo
+        :param address_cache: addresses that have been found for other
+        photos of the same album
+        """
         self.user = user
         self.file = file
+        self.address_cache = address_cache
 
     def _get_raw_data(self, file: BytesIO) -> RawImageData:
         """
@@ -83,8 +164,15 @@ class ImageHandler:
         :param file: byte sting with an image
         :return: RawImageData object with raw info from the photo
         """
-        # Get data from the exif of the photo via external library
-        exif = exifread.process_file(file, details=False)
+        # Get data from the exif of the photo via external library in a
+        # process that can't hang or take all memory of the bot
+        try:
+            exif = exif_pool.read(file.getvalue())
+        except ExifReadError as e:
+            reason = f"EXIF of this picture can't be read: {e}"
+            log.info(reason)
+            raise NoEXIF(reason)
+
         if not len(exif.keys()):
             reason = "This picture doesn't contain EXIF."
             log.info(reason)
@@ -128,22 +216,6 @@ class ImageHandler:
                                 latitude_reference, raw_latitude,
                                 longitude_reference, raw_longitude)
 
-    @staticmethod
-    def _dedupe_string(string: str) -> str:
-        """
-        Get rid of all repetitive words in a string
-
-        :param string: string with camera or lens names
-        :return: same string without repetitive words
-        """
-
-        deduped_string = ''
-
-        for x in string.split(' '):
-            if x not in deduped_string:
-                deduped_string += x + ' '
-        return deduped_string.rstrip()
-
     @staticmethod
     def _check_camera_tags(*tags: str) -> List[str]:
         """
@@ -246,45 +318,63 @@ class ImageHandler:
 
         return latitude, longitude
 
+    def _get_country(self, latitude: float,
+                     longitude: float) -> Optional[str]:
+        """
+        Get the country where the photo was taken without requests
+        to online services
+
+        :param latitude: latitude from a photo as a float
+        :param longitude: longitude rom a photo as a float
+        :return: ISO code of the country to keep statistics of the most
+        popular countries among users of the bot or None if the country
+        can't be found out this way
+        """
+        code = country_resolver.find_code(latitude, longitude)
+        if not code:
+            log.debug('Cannot find out the country offline.')
+            return None
+
+        return code.upper()
+
     def _get_address(self, latitude: float, longitude: float) \
-            -> Tuple[Dict[str, str], Dict[str, str]]:
+            -> Tuple[str, Optional[str]]:
 
         """
          # Get address as a string by coordinates from photo that user sent
          to bot
 
+        Only one request is made, in the language of the user. Only the code
+        of the country is taken from the answer, names of the country are
+        taken from the table of countries when they are shown
+
         :param latitude: latitude from a photo as a float
         :param longitude: longitude rom a photo as a float
-        :return: address as a string where photo was taken; name of
-        country in English and Russian to keep statistics
-        of the most popular countries among users of the bot
+        :return: address as a string where photo was taken; ISO code of
+        the country to keep statistics of the most popular countries among
+        users of the bot or None if the geocoder doesn't know the country
         """
 
-        address = {}
-        country = {}
-        coordinates = f"{latitude}, {longitude}"
-        log.debug('Getting address from coordinates %s...', coordinates)
-        geolocator = Nominatim()
+        log.debug('Getting address from coordinates %s, %s...', latitude,
+                  longitude)
         lang = self.user.language
 
         try:
-            # Get name of the country in English and Russian language
-            location_en = geolocator.reverse(coordinates, language='en')
-            address['en-US'] = location_en.address
-            country['en-US'] = location_en.raw['address']['country']
-
-            location_ru = geolocator.reverse(coordinates, language='ru')
-            address['ru-RU'] = location_ru.address
-            country['ru-RU'] = location_ru.raw['address']['country']
-
-            address = address[lang]
-            return address, country
-
+            location = geocoder.reverse(latitude, longitude,
+                                        language=lang[:2])
         except Exception as e:
             log.error(e)
             log.error('Getting address has failed!')
             raise
 
+        country = None
+        if location.country_code:
+            country = location.country_code.upper()
+            if not country_resolver.get_names(country):
+                log.warning('There is no country with code %s in the table',
+                            country)
+        return location.address, country
+
     def _convert_data(self, raw_data: RawImageData) -> ImageData:
         """
         Cleans data from a picture that a user sends
@@ -295,13 +385,12 @@ class ImageHandler:
 
         date_time = (str(raw_data.date_time) if raw_data.date_time else None)
 
-        # Merge a brand and model together
-        camera = f'{raw_data.camera_brand} {raw_data.camera_model}'
-        lens = f'{raw_data.lens_brand} {raw_data.lens_model}'
-
-        # Get rid of repetitive words
-        camera = (self._dedupe_string(camera) if camera != ' ' else None)
-        lens = (self._dedupe_string(lens) if lens != ' ' else None)
+        # Merge a brand and model together without repeated words and
+        # with canonical names of brands
+        camera = name_normalizer.normalize(raw_data.camera_brand,
+                                           raw_data.camera_model)
+        lens = name_normalizer.normalize(raw_data.lens_brand,
+                                         raw_data.lens_model)
 
         camera, lens = self._check_camera_tags(camera, lens)
 
@@ -311,10 +400,20 @@ class ImageHandler:
             address = country = latitude = longitude = None
         else:
             try:
-                address, country = self._get_address(latitude, longitude)
+                if self.address_cache:
+                    address, country = self.address_cache.get_address(
+                        latitude, longitude, self._get_address)
+                else:
+                    address, country = self._get_address(latitude,
+                                                         longitude)
             except Exception as e:
                 log.warning(e)
                 address = country = None
+            # The country is needed for statistics. The geocoder knows it
+            # much better than the simplified borders near frontiers and on
+            # small countries, so they are only used when the geocoder is
+            # down or doesn't know the country
+            country = country or self._get_country(latitude, longitude)
 
         return ImageData(self.user, date_time, camera, lens, address, country,
                          latitude, longitude)
@@ -0,0 +1,232 @@
+"""
+Module with a profiler that the admin turns on from the admin menu for a
+while to find out where the bot spends its time, without restarting it.
+
+There are two modes:
+
+- sampling: a thread looks at stacks of all the other threads of the
+  process (sys._current_frames) every config.PROFILE_INTERVAL seconds.
+  It doesn't slow the bot down noticeably and sees everything: handlers,
+  albums, sender threads and so on. Threads that just wait (for a lock, a
+  queue or a timer) are skipped. The file is in the "collapsed stacks"
+  format that flame graph tools (speedscope, flamegraph.pl) open.
+- cProfile: handlers wrapped by request_context.with_context run under
+  cProfile, so there are exact numbers of calls, but handlers become
+  slower while it works. The file can be opened with pstats or snakeviz.
+
+While the profiler is off there is no thread and no hook at all, handlers
+only check one attribute.
+"""
+
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, List, Tuple
+
+from photogpsbot import log
+import config
+
+# Gets a summary of a profile and a file with it
+Report = Callable[[str, io.BytesIO], None]
+
+# functions where threads of the bot wait for something to do
+IDLE_FUNCTIONS = {('threading.py', 'wait'),
+                  ('threading.py', '_wait_for_tstate_lock'),
+                  ('queue.py', 'get'),
+                  ('selectors.py', 'select'),
+                  ('connection.py', 'poll'),
+                  ('connection.py', '_poll')}
+
+# Telegram doesn't send messages longer than that
+MAX_SUMMARY_LENGTH = 4000
+
+
+def describe_code(frame: Any) -> str:
+    """
+    Makes a short name of a function of a frame
+
+    :param frame: frame of a stack
+    :return: string like "get_image_info (process_image.py:120)"
+    """
+    code = frame.f_code
+    return (f'{code.co_name} ({os.path.basename(code.co_filename)}:'
+            f'{code.co_firstlineno})')
+
+
+class Profiler:
+    """
+    Profiles the bot for some seconds on demand
+    """
+
+    def __init__(self, interval: float = config.PROFILE_INTERVAL) -> None:
+        """
+        Init variables
+
+        :param interval: seconds between samples of stacks
+        """
+        self.interval = interval
+        self.running = False
+        # handlers check it to find out whether to run under cProfile
+        self.cprofile_active = False
+        self._profiles: List[cProfile.Profile] = []
+        # updates that came while another one was under cProfile
+        self._unprofiled = 0
+        self._lock = threading.Lock()
+
+    def start(self, mode: str, seconds: float, report: Report) -> bool:
+        """
+        Starts profiling in a background thread
+
+        :param mode: "sampling" or "cprofile"
+        :param seconds: how long to profile
+        :param report: function that gets the summary and the file when the
+        profile is ready
+        :return: False if a profile is being made already
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+
+        target = self._sample if mode == 'sampling' else self._cprofile
+        log.info('Profiling the bot (%s) for %d seconds', mode, seconds)
+        thread = threading.Thread(target=self._run,
+                                  args=(target, seconds, report),
+                                  name='profiler', daemon=True)
+        thread.start()
+        return True
+
+    def _run(self, target: Callable[[float], Tuple[str, io.BytesIO]],
+             seconds: float, report: Report) -> None:
+        try:
+            summary, profile_file = target(seconds)
+            report(summary[:MAX_SUMMARY_LENGTH], profile_file)
+        except Exception as e:
+            log.error('Profiling has failed: %s', e)
+        finally:
+            self.running = False
+
+    def _sample(self, seconds: float) -> Tuple[str, io.BytesIO]:
+        """
+        Samples stacks of all threads
+
+        :param seconds: how long to sample
+        :return: summary and a file with collapsed stacks
+        """
+        own_ident = threading.get_ident()
+        stacks: Counter = Counter()
+        self_samples: Counter = Counter()
+        total_samples: Counter = Counter()
+        samples = 0
+        idle = 0
+        rounds = 0
+
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            rounds += 1
+            names = {thread.ident: thread.name
+                     for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename),
+                        code.co_name) in IDLE_FUNCTIONS:
+                    idle += 1
+                    continue
+
+                functions = []
+                while frame:
+                    functions.append(describe_code(frame))
+                    frame = frame.f_back
+                functions.reverse()
+
+                samples += 1
+                self_samples[functions[-1]] += 1
+                # recursive functions are counted once per sample
+                total_samples.update(set(functions))
+                thread_name = names.get(ident, str(ident))
+                stacks[';'.join([thread_name] + functions)] += 1
+            time.sleep(self.interval)
+
+        summary = (f'Sampling profile of {seconds:.0f} s: {rounds} rounds, '
+                   f'{samples} samples of working threads, {idle} samples '
+                   f'of waiting ones were skipped.\n'
+                   f'Self, Total, Function\n')
+        for function, number in self_samples.most_common(30):
+            summary += (f'{number / samples:.1%}, '
+                        f'{total_samples[function] / samples:.1%}, '
+                        f'{function}\n')
+
+        profile_file = io.BytesIO(''.join(
+            f'{stack} {number}\n' for stack, number in stacks.items()
+        ).encode('utf8'))
+        profile_file.name = 'profile.collapsed.txt'
+        return summary, profile_file
+
+    def _cprofile(self, seconds: float) -> Tuple[str, io.BytesIO]:
+        """
+        Runs handlers under cProfile
+
+        :param seconds: how long to profile
+        :return: summary and a file with the profile in the pstats format
+        """
+        self._profiles = []
+        self._unprofiled = 0
+        self.cprofile_active = True
+        time.sleep(seconds)
+        self.cprofile_active = False
+        with self._lock:
+            profiles, self._profiles = self._profiles, []
+            unprofiled = self._unprofiled
+
+        if not profiles:
+            empty = io.BytesIO(b'')
+            empty.name = 'profile.prof'
+            return 'There were no updates while profiling.', empty
+
+        output = io.StringIO()
+        stats = pstats.Stats(profiles[0], stream=output)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        # the same as stats.dump_stats does, but without a file on disk
+        profile_file = io.BytesIO(marshal.dumps(stats.stats))
+        profile_file.name = 'profile.prof'
+
+        stats.strip_dirs().sort_stats('cumulative').print_stats(30)
+        summary = (f'cProfile of {seconds:.0f} s, {len(profiles)} handled '
+                   f'updates, {unprofiled} more were handled while another '
+                   f'one was profiled.\n' + output.getvalue())
+        return summary, profile_file
+
+    def runcall(self, function: Callable, *args: Any, **kwargs: Any) -> Any:
+        """
+        Calls a function under cProfile and keeps its profile
+
+        :param function: function to call
+        :param args: its arguments
+        :param kwargs: its keyword arguments
+        :return: what the function returns
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # since Python 3.12 only one profiler can be active in the
+            # process at a time, the update is handled without it
+            with self._lock:
+                self._unprofiled += 1
+            return function(*args, **kwargs)
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                self._profiles.append(profile)
@@ -0,0 +1,132 @@
+"""
+Module that provides a middleware layer around handlers of the bot.
+
+For every update from Telegram it resolves the user who sent it only once,
+keeps his language and the time when the bot started to handle the update,
+and passes all of it to the handler as a RequestContext object. Handlers
+pass the same object further to functions that need to know the user instead
+of looking him up again. It also records how long every handler takes.
+"""
+
+import time
+from dataclasses import dataclass, field
+from functools import wraps
+from threading import Lock
+from typing import Callable, Dict, Optional, Any
+
+from photogpsbot import log, users, User, profiler
+
+
+@dataclass
+class RequestContext:
+    """
+    Info about one update from Telegram shared by all the functions that
+    handle this update
+    """
+    user: Optional[User] = None
+    # time mark from time.perf_counter() when the bot got the update
+    started: float = field(default_factory=time.perf_counter)
+
+    @property
+    def language(self) -> str:
+        """
+        Language of interface of the user who sent the update
+
+        It is not stored separately because the user can switch his
+        language while the update is handled
+        """
+        return self.user.language if self.user else 'en-US'
+
+
+@dataclass
+class HandlerTiming:
+    """
+    Accumulated time that one handler has spent on updates
+    """
+    calls: int = 0
+    total: float = 0  # in seconds
+    max: float = 0  # in seconds
+
+
+class HandlerTimings:
+    """
+    Keeps track of how much time every handler of the bot spends on updates
+    """
+
+    def __init__(self) -> None:
+        self.timings: Dict[str, HandlerTiming] = {}
+        self._lock = Lock()
+
+    def record(self, handler_name: str, duration: float) -> None:
+        """
+        Adds time of one more handled update to the statistics of a handler
+
+        :param handler_name: name of a function that handled an update
+        :param duration: how many seconds it took to handle the update
+        :return: None
+        """
+        with self._lock:
+            timing = self.timings.setdefault(handler_name, HandlerTiming())
+            timing.calls += 1
+            timing.total += duration
+            timing.max = max(timing.max, duration)
+
+    def __str__(self) -> str:
+        if not self.timings:
+            return 'There were no updates yet.'
+
+        report = 'Handler: calls, average / max time in ms\n'
+        with self._lock:
+            for name, timing in sorted(self.timings.items(),
+                                       key=lambda x: x[1].total,
+                                       reverse=True):
+                average = timing.total / timing.calls * 1000
+                report += (f'{name}: {timing.calls}, '
+                           f'{average:.1f} / {timing.max * 1000:.1f}\n')
+        return report
+
+
+handler_timings = HandlerTimings()
+
+
+def with_context(resolve_user: bool = True) -> Callable:
+    """
+    Decorator that makes a RequestContext for an update and passes it to
+    the handler as the second argument
+
+    If a handler is called from another handler with a context, the context
+    is reused and the update is not timed twice. A handler of albums gets a
+    list of messages, the user is looked up by the first one
+
+    :param resolve_user: whether to look up the user who sent the update. It
+    does not make sense for callback queries from the admin menu for example
+    :return: decorator for a handler that takes an update and a context
+    """
+
+    def decorator(handler: Callable) -> Callable:
+
+        @wraps(handler)
+        def handler_launcher(update: Any,
+                             context: Optional[RequestContext] = None) -> Any:
+            if context:
+                return handler(update, context)
+
+            started = time.perf_counter()
+            # files of an album come as a list of messages from one user
+            message = update[0] if isinstance(update, list) else update
+            user = users.find_one(message) if resolve_user else None
+            context = RequestContext(user=user, started=started)
+            try:
+                # the admin has turned cProfile on from the admin menu
+                if profiler.cprofile_active:
+                    return profiler.runcall(handler, update, context)
+                return handler(update, context)
+            finally:
+                duration = time.perf_counter() - started
+                handler_timings.record(handler.__name__, duration)
+                log.debug('%s has handled the update in %.3f seconds',
+                          handler.__name__, duration)
+
+        return handler_launcher
+
+    return decorator
@@ -0,0 +1,504 @@
+"""
+Module that sends messages to Telegram without hitting its flood limits.
+
+Telegram lets a bot send about 30 messages per second overall, about one
+message per second to the same chat and 20 messages per minute to a group;
+requests over the limits fail with "429 Too Many Requests" and a number of
+seconds to wait (retry_after). Answers to users are not sent by handlers
+directly but put into a queue of their chat, and several sender threads
+send them keeping these limits, so a burst of photos is answered a bit
+later instead of not being answered at all:
+
+- every chat has a token bucket, so a short burst (a location and an answer
+  right after "processing") goes at once, but a chat can't send more often
+  than its rate for long;
+- one token bucket for the whole bot (shared by workers, every worker
+  gets its part of the rate);
+- messages of one chat are sent one by one in the order they were queued;
+- a message that got 429 waits for retry_after seconds and goes again.
+
+All requests to the Bot API, including the ones that don't go through the
+queue, use one HTTP session with a pool of keep-alive connections instead
+of a session per thread.
+
+A message can also be sent with a delay and cancelled before it is sent,
+that is how "your photo is being processed" is not sent at all when the
+answer is ready quickly.
+"""
+
+import heapq
+import itertools
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from threading import Condition, Thread, Timer
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+# telebot goes as pyTelegramBotAPI in requirements
+from telebot import apihelper  # type: ignore
+from telebot.types import Message  # type: ignore
+
+from photogpsbot import log
+import config
+
+
+class TokenBucket:
+    """
+    Lets through `capacity` events at once and `rate` events per second
+    on average
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """
+        Finds out how long to wait for a token
+
+        :param now: time mark from time.monotonic()
+        :return: seconds to wait, 0 if there is a token now
+        """
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self, now: float) -> None:
+        """
+        Takes a token
+
+        :param now: time mark from time.monotonic()
+        :return: None
+        """
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class Job:
+    """
+    One call to the Bot API that waits for its turn
+    """
+
+    def __init__(self, chat_id: int, function: Callable,
+                 args: tuple, kwargs: dict) -> None:
+        self.chat_id = chat_id
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        # result of the call or its exception
+        self.future: Future = Future()
+        self.queued = 0.0
+        self.attempts = 0
+        self.started = False
+        self.cancelled = False
+        self.timer: Optional[Timer] = None
+
+
+@dataclass
+class SenderMetrics:
+    """
+    Statistics of messages sent through the queue
+    """
+    sent: int = 0
+    errors: int = 0
+    throttled: int = 0  # answers 429 from Telegram
+    skipped: int = 0  # delayed messages that were cancelled
+    total_wait: float = 0  # in seconds, time in the queue
+    max_wait: float = 0  # in seconds
+    total_latency: float = 0  # in seconds, time of requests
+    max_latency: float = 0  # in seconds
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """
+    Finds out whether Telegram asks to wait before sending again
+
+    :param error: exception raised by a call to the Bot API
+    :return: seconds to wait or None if it is another error
+    """
+    result = getattr(error, 'result', None)
+    if not isinstance(error, apihelper.ApiException) or result is None:
+        return None
+    if result.status_code != 429:
+        return None
+    try:
+        return float(result.json()['parameters']['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        return 1.0
+
+
+class Sender:
+    """
+    Queue of messages to Telegram that keeps global and per chat limits
+    """
+
+    def __init__(self, bot: Any,
+                 global_rate: float = config.SENDER_GLOBAL_RATE,
+                 chat_rate: float = config.SENDER_CHAT_RATE,
+                 group_rate: float = config.SENDER_GROUP_RATE,
+                 burst: int = config.SENDER_CHAT_BURST,
+                 threads: int = config.SENDER_THREADS) -> None:
+        """
+        Init variables
+
+        :param bot: TeleBot object that makes calls to the Bot API
+        :param global_rate: messages per second for the whole bot
+        :param chat_rate: messages per second to one private chat
+        :param group_rate: messages per second to one group
+        :param burst: messages that can be sent to a chat at once
+        :param threads: number of threads that send messages
+        """
+        self.bot = bot
+        # every worker process has a queue of its own, and all of them
+        # share the global limit. There are no bursts here, otherwise
+        # Telegram would get twice the rate in the first second of a burst
+        self.global_bucket = TokenBucket(global_rate / config.WORKERS, 1)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.threads_number = threads
+        self.session = self._make_session()
+        self.metrics = SenderMetrics()
+
+        self.running = False
+        self.queued = 0
+        self._threads: List[Thread] = []
+        self._chats: Dict[int, Deque[Job]] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        # chats that have a job to send: (when, sequence number, chat id)
+        self._ready: List[Tuple[float, int, int]] = []
+        # chats that are either in self._ready or are being sent to
+        self._scheduled: Set[int] = set()
+        self._delayed: Set[Job] = set()
+        self._sequence = itertools.count()
+        self._condition = Condition()
+
+    def _make_session(self) -> requests.Session:
+        session = requests.Session()
+        # sender threads, handler threads of TeleBot and its polling
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.threads_number + 4)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_session(self, reset: bool = False) -> requests.Session:
+        """
+        Returns the session for requests of TeleBot, it replaces
+        apihelper._get_req_session that makes a session per thread
+
+        :param reset: whether to make a new session
+        :return: the session of the bot
+        """
+        if reset:
+            self.session = self._make_session()
+        return self.session
+
+    def start(self) -> None:
+        """
+        Starts threads that send messages
+
+        :return: None
+        """
+        # connections of the session can be inherited from the dispatcher
+        # process, they can't be shared with it
+        self.session = self._make_session()
+        self.running = True
+        for number in range(self.threads_number):
+            thread = Thread(target=self._run, name=f'sender-{number}',
+                            daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        log.info('Sender has been started with %d threads',
+                 self.threads_number)
+
+    def stop(self, timeout: float = 10) -> None:
+        """
+        Sends messages that are left in the queue and stops the threads.
+        Delayed messages that haven't been queued yet are not sent
+
+        :param timeout: the longest time to wait for the queue
+        :return: None
+        """
+        with self._condition:
+            for job in list(self._delayed):
+                self._cancel(job)
+            self.running = False
+            self._condition.notify_all()
+
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self._threads = []
+        if self.queued:
+            log.warning('Sender has stopped with %d messages in the queue',
+                        self.queued)
+
+    def _get_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if not bucket:
+            if len(self._buckets) > 10000:
+                now = time.monotonic()
+                self._buckets = {chat: bucket for chat, bucket
+                                 in self._buckets.items()
+                                 if not bucket.is_full(now)}
+            # ids of groups are negative
+            rate = self.chat_rate if chat_id > 0 else self.group_rate
+            bucket = TokenBucket(rate, self.burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _schedule(self, chat_id: int, when: float) -> None:
+        """
+        Lets a chat send its next job
+
+        :param chat_id: id of the chat
+        :param when: time mark from time.monotonic() since which the job
+        can be sent. Chats are served in the order of these marks, so the
+        time when a job was queued keeps its place among other chats
+        :return: None
+        """
+        self._scheduled.add(chat_id)
+        heapq.heappush(self._ready, (when, next(self._sequence), chat_id))
+        self._condition.notify()
+
+    def _enqueue(self, job: Job) -> None:
+        with self._condition:
+            self._delayed.discard(job)
+            if job.cancelled:
+                return
+            job.queued = time.monotonic()
+            self._chats.setdefault(job.chat_id, deque()).append(job)
+            self.queued += 1
+            if job.chat_id not in self._scheduled:
+                bucket = self._get_bucket(job.chat_id)
+                self._schedule(job.chat_id,
+                               job.queued + bucket.delay(job.queued))
+
+    def _next_job(self) -> Optional[Job]:
+        """
+        Waits for a job that can be sent now
+
+        :return: the job or None if the sender is stopped and the queue is
+        empty
+        """
+        with self._condition:
+            while True:
+                if not self._ready:
+                    if not self.running:
+                        return None
+                    self._condition.wait()
+                    continue
+
+                now = time.monotonic()
+                when, _, chat_id = self._ready[0]
+                delay = max(when - now, self.global_bucket.delay(now))
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                heapq.heappop(self._ready)
+                jobs = self._chats[chat_id]
+                while jobs and jobs[0].cancelled:
+                    jobs.popleft()
+                if not jobs:
+                    del self._chats[chat_id]
+                    self._scheduled.discard(chat_id)
+                    continue
+
+                job = jobs.popleft()
+                job.started = True
+                job.attempts += 1
+                self.global_bucket.take(now)
+                self._get_bucket(chat_id).take(now)
+                self.metrics.total_wait += now - job.queued
+                self.metrics.max_wait = max(self.metrics.max_wait,
+                                            now - job.queued)
+                return job
+
+    def _finish(self, job: Job, retry_after: Optional[float]) -> None:
+        """
+        Puts a job back if it has to be sent again and lets the next job of
+        the chat go
+
+        :param job: job that has been sent
+        :param retry_after: seconds to wait before sending the job again or
+        None if it has been sent or has failed
+        :return: None
+        """
+        with self._condition:
+            now = time.monotonic()
+            jobs = self._chats[job.chat_id]
+            if retry_after is not None:
+                job.started = False
+                jobs.appendleft(job)
+                self._schedule(job.chat_id, now + retry_after)
+                return
+
+            self.queued -= 1
+            if jobs:
+                delay = self._get_bucket(job.chat_id).delay(now)
+                # the next job doesn't lose its place in the queue because
+                # of the job before it
+                self._schedule(job.chat_id,
+                               now + delay if delay else jobs[0].queued)
+            else:
+                del self._chats[job.chat_id]
+                self._scheduled.discard(job.chat_id)
+
+    def _run(self) -> None:
+        while True:
+            job = self._next_job()
+            if not job:
+                return
+
+            start = time.perf_counter()
+            retry_after = None
+            try:
+                result = job.function(*job.args, **job.kwargs)
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                if (retry_after is not None and
+                        job.attempts <= config.SENDER_MAX_RETRIES):
+                    log.warning('Telegram asks to wait %.1f seconds before '
+                                'sending to %d', retry_after, job.chat_id)
+                else:
+                    retry_after = None
+                    log.error('Cannot send a message to %d: %s',
+                              job.chat_id, e)
+                    job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            latency = time.perf_counter() - start
+
+            with self._condition:
+                metrics = self.metrics
+                metrics.total_latency += latency
+                metrics.max_latency = max(metrics.max_latency, latency)
+                if retry_after is not None:
+                    metrics.throttled += 1
+                elif job.future.exception():
+                    metrics.errors += 1
+                else:
+                    metrics.sent += 1
+            self._finish(job, retry_after)
+
+    def call(self, chat_id: int, function: Callable, *args: Any,
+             **kwargs: Any) -> Future:
+        """
+        Queues a call to the Bot API that sends something to a chat
+
+        :param chat_id: id of the chat
+        :param function: method of the bot like bot.send_message
+        :param args: arguments of the method
+        :param kwargs: keyword arguments of the method
+        :return: Future with the result of the method
+        """
+        job = Job(chat_id, function, args, kwargs)
+        if not self.running:
+            # the sender is not started in tools, messages go at once there
+            try:
+                job.future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                job.future.set_exception(e)
+            return job.future
+
+        self._enqueue(job)
+        return job.future
+
+    def call_later(self, delay: float, chat_id: int, function: Callable,
+                   *args: Any, **kwargs: Any) -> Job:
+        """
+        Queues a call to the Bot API after a delay. The call can be
+        cancelled with self.cancel until it is sent
+
+        :param delay: seconds to wait before putting the call to the queue
+        :param chat_id: id of the chat
+        :param function: method of the bot like bot.send_message
+        :param args: arguments of the method
+        :param kwargs: keyword arguments of the method
+        :return: Job object of the call
+        """
+        job = Job(chat_id, function, args, kwargs)
+        if delay <= 0 or not self.running:
+            job.future = self.call(chat_id, function, *args, **kwargs)
+            job.started = True
+            return job
+
+        job.timer = Timer(delay, self._enqueue, args=(job,))
+        job.timer.daemon = True
+        with self._condition:
+            self._delayed.add(job)
+        job.timer.start()
+        return job
+
+    def _cancel(self, job: Job) -> bool:
+        if job.started or job.cancelled:
+            return False
+        job.cancelled = True
+        if job.timer:
+            job.timer.cancel()
+        if job in self._delayed:
+            self._delayed.discard(job)
+        else:
+            self.queued -= 1
+        job.future.cancel()
+        self.metrics.skipped += 1
+        return True
+
+    def cancel(self, job: Job) -> bool:
+        """
+        Cancels a call that hasn't been sent yet
+
+        :param job: Job object from self.call_later
+        :return: True if the call has been cancelled, False if it has
+        already been sent or is being sent
+        """
+        with self._condition:
+            return self._cancel(job)
+
+    def send_message(self, chat_id: int, text: str, **kwargs: Any) -> Future:
+        return self.call(chat_id, self.bot.send_message, chat_id, text,
+                         **kwargs)
+
+    def reply_to(self, message: Message, text: str, **kwargs: Any) -> Future:
+        return self.call(message.chat.id, self.bot.reply_to, message, text,
+                         **kwargs)
+
+    def reply_later(self, delay: float, message: Message, text: str,
+                    **kwargs: Any) -> Job:
+        return self.call_later(delay, message.chat.id, self.bot.reply_to,
+                               message, text, **kwargs)
+
+    def send_location(self, chat_id: int, latitude: float, longitude: float,
+                      **kwargs: Any) -> Future:
+        return self.call(chat_id, self.bot.send_location, chat_id, latitude,
+                         longitude, **kwargs)
+
+    def __str__(self) -> str:
+        metrics = self.metrics
+        done = metrics.sent + metrics.errors + metrics.throttled
+        average_wait = metrics.total_wait / done * 1000 if done else 0
+        average_latency = metrics.total_latency / done * 1000 if done else 0
+        return (f'Sender: {self.queued} messages in the queue of '
+                f'{len(self._chats)} chats, {len(self._delayed)} delayed. '
+                f'{metrics.sent} sent, {metrics.errors} errors, '
+                f'{metrics.throttled} times Telegram asked to wait, '
+                f'{metrics.skipped} delayed messages were not needed. '
+                f'Time in the queue: average {average_wait:.0f} ms, max '
+                f'{metrics.max_wait * 1000:.0f} ms. Send latency: average '
+                f'{average_latency:.0f} ms, max '
+                f'{metrics.max_latency * 1000:.0f} ms.')
@@ -0,0 +1,178 @@
+"""
+Module that keeps an SSH tunnel to the server with the database open.
+
+The bot connects to the database through the tunnel when it runs not on the
+server where the database is. The supervisor checks that the tunnel is still
+alive before it is used and rebuilds it if it has died, so the bot doesn't
+keep trying a port that leads nowhere. All connections to the database take
+the port from the same supervisor, therefore they share one tunnel.
+"""
+
+import time
+from threading import RLock
+from typing import Callable, Optional
+
+import sshtunnel  # type: ignore
+from sshtunnel import SSHTunnelForwarder  # type: ignore
+
+from photogpsbot import log
+import config
+
+
+def make_forwarder() -> SSHTunnelForwarder:
+    """
+    Makes a forwarder to MySQL on the server where the database of
+    photogpsbot is located
+
+    :return: forwarder that has not been started yet
+    """
+    sshtunnel.SSH_TIMEOUT = 5.0
+    sshtunnel.TUNNEL_TIMEOUT = 5.0
+    return SSHTunnelForwarder(ssh_address_or_host=config.SERVER_ADDRESS,
+                              ssh_username=config.SSH_USER,
+                              ssh_password=config.SSH_PASSWD,
+                              ssh_port=22,
+                              remote_bind_address=('127.0.0.1', 3306))
+
+
+class TunnelSupervisor:
+    """
+    Opens the SSH tunnel, watches it and opens it again when it dies
+    """
+
+    def __init__(self, factory: Callable[[], SSHTunnelForwarder] =
+                 make_forwarder) -> None:
+        """
+        Init variables
+
+        :param factory: function that makes a new forwarder. It can be
+        replaced by something that forwards to a local port to run the bot
+        without an SSH server
+        """
+        self.factory = factory
+        self.forwarder: Optional[SSHTunnelForwarder] = None
+        self.started_at: Optional[float] = None
+        self.restarts = 0  # how many times the tunnel has been rebuilt
+        self.failures = 0  # how many times it could not be built
+        # whether the tunnel has been asked for and not closed since then,
+        # so it has to be kept open
+        self.needed = False
+        self._lock = RLock()
+
+    @property
+    def is_opened(self) -> bool:
+        """
+        Whether the tunnel has been opened and not closed since then
+
+        :return: True if it is opened
+        """
+        return self.forwarder is not None
+
+    def is_healthy(self) -> bool:
+        """
+        Checks that both the SSH connection and the local forwarding server
+        are alive
+
+        :return: True if the tunnel can be used
+        """
+        forwarder = self.forwarder
+        if not forwarder:
+            return False
+        try:
+            # is_alive is only updated by start(), stop() and check_tunnels()
+            forwarder.check_tunnels()
+            return bool(forwarder.is_active and forwarder.is_alive)
+        except Exception as e:
+            log.warning('Cannot check the SSH tunnel: %s', e)
+            return False
+
+    def _open(self) -> None:
+        """
+        Builds and starts a new forwarder instead of the current one
+
+        :return: None
+        """
+        if self.forwarder:
+            self.restarts += 1
+            log.warning('SSH tunnel is down, rebuilding it...')
+            self._close_forwarder()
+
+        log.debug('Establishing SSH tunnel to the server where the database '
+                  'is located...')
+        forwarder = self.factory()
+        try:
+            forwarder.start()
+        except Exception:
+            self.failures += 1
+            raise
+        self.forwarder = forwarder
+        self.started_at = time.monotonic()
+        log.debug('SSH tunnel has been established.')
+
+    def _close_forwarder(self) -> None:
+        """
+        Stops the current forwarder
+
+        :return: None
+        """
+        try:
+            # sshtunnel 0.1.4 has no force argument
+            self.forwarder.stop()
+        except Exception as e:
+            log.warning('Cannot stop SSH tunnel: %s', e)
+        self.forwarder = None
+        self.started_at = None
+
+    def check(self) -> bool:
+        """
+        Rebuilds the tunnel if it has died
+
+        :return: True if the tunnel has been rebuilt, so connections that
+        went through the old one have to be opened again
+        """
+        with self._lock:
+            if not self.needed or self.is_healthy():
+                return False
+            self._open()
+            return True
+
+    def get_port(self) -> int:
+        """
+        Gives a local port that leads to the database, opening or rebuilding
+        the tunnel if needed
+
+        :return: the local port
+        """
+        with self._lock:
+            self.needed = True
+            if not self.is_healthy():
+                self._open()
+            return self.forwarder.local_bind_port
+
+    def close(self) -> None:
+        """
+        Closes the tunnel
+
+        :return: None
+        """
+        with self._lock:
+            self.needed = False
+            if self.forwarder:
+                self._close_forwarder()
+                log.info('SSH tunnel has been closed.')
+
+    @property
+    def uptime(self) -> float:
+        """
+        How many seconds the current tunnel has been up
+
+        :return: number of seconds or 0 if the tunnel is closed
+        """
+        started_at = self.started_at
+        return time.monotonic() - started_at if started_at else 0.0
+
+    def __str__(self) -> str:
+        state = 'opened' if self.is_opened else 'closed'
+        return (f'SSH tunnel is {state}, up for {self.uptime:.0f} s, '
+                f'rebuilt {self.restarts} times, failed to open '
+                f'{self.failures} times')
@@ -0,0 +1,264 @@
+"""
+Module that writes changes of users to the database in batches.
+
+A user comes to the bot for the first time, switches language or changes
+their name in Telegram. Each of these used to be an INSERT or an UPDATE
+with its own commit on the thread that handles the message. Now the User
+object in memory is changed and the bot goes on with it, while the row of
+the user is put into a buffer by chat_id, so several changes of one user
+become one row. A thread writes all rows every config.USER_FLUSH_INTERVAL
+seconds with one INSERT ... ON DUPLICATE KEY UPDATE, which adds new users
+and updates known ones at once. If the database is unavailable the rows
+stay in the buffer till the next flush, the rest are written when the bot
+stops. If the batch fails for another reason, rows are written one by one
+and a row that the database doesn't accept is dropped, so one bad name
+doesn't stop the writes of everybody else.
+
+The admin used to get a message about every new user, now new users are
+gathered into a digest that is sent every config.NEW_USERS_DIGEST_INTERVAL
+seconds.
+"""
+
+import threading
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from photogpsbot import bot, log, db
+from photogpsbot.db_connector import DatabaseError, DatabaseConnectionError
+import config
+
+if TYPE_CHECKING:
+    from photogpsbot.users import User
+
+# chat_id, first_name, nickname, last_name, language
+Row = Tuple[int, Optional[str], Optional[str], Optional[str], str]
+
+UPSERT_QUERY = ('INSERT INTO users (chat_id, first_name, nickname, '
+                'last_name, language) '
+                'VALUES (%s, %s, %s, %s, %s) '
+                'ON DUPLICATE KEY UPDATE first_name=VALUES(first_name), '
+                'nickname=VALUES(nickname), last_name=VALUES(last_name), '
+                'language=VALUES(language)')
+
+# Telegram doesn't send messages longer than 4096 characters
+MAX_DIGEST_USERS = 50
+
+
+@dataclass
+class UserWritesMetrics:
+    """
+    Statistics of written changes of users
+    """
+    changes: int = 0
+    coalesced: int = 0  # changes that replaced a row waiting in the buffer
+    rows: int = 0
+    flushes: int = 0
+    failed_flushes: int = 0
+    dropped: int = 0  # rows that the database hasn't accepted
+
+
+class UserWrites:
+    """
+    Buffer of changed users that are written to the database in batches
+    """
+
+    def __init__(self,
+                 flush_interval: float = config.USER_FLUSH_INTERVAL,
+                 digest_interval: float = config.NEW_USERS_DIGEST_INTERVAL
+                 ) -> None:
+        """
+        Init variables
+
+        :param flush_interval: seconds between writes to the database
+        :param digest_interval: seconds between digests of new users
+        """
+        self.flush_interval = flush_interval
+        self.digest_interval = digest_interval
+        # rows waiting for the next flush and rows being written now, both
+        # are newer than what is in the database
+        self.rows: Dict[int, Row] = {}
+        self.flushing: Dict[int, Row] = {}
+        self.new_users: List[str] = []
+        self.metrics = UserWritesMetrics()
+        self.running = False
+        self._last_digest = time.monotonic()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def add(self, user: 'User', new: bool = False) -> None:
+        """
+        Puts the current info about a user into the buffer
+
+        :param user: User object that has been added or changed
+        :param new: whether the user uses the bot for the first time, then
+        the admin learns about them from the next digest
+        :return: None
+        """
+        row = (user.chat_id, user.first_name, user.nickname, user.last_name,
+               user.language)
+        with self._lock:
+            self.metrics.changes += 1
+            if user.chat_id in self.rows:
+                self.metrics.coalesced += 1
+            self.rows[user.chat_id] = row
+            if new:
+                self.new_users.append(str(user))
+
+    def pending(self, chat_id: int) -> Optional[Row]:
+        """
+        Gives info about a user that hasn't been written to the database yet
+
+        :param chat_id: id of a Telegram user
+        :return: row of the user or None if there are no changes to write
+        """
+        with self._lock:
+            return self.rows.get(chat_id) or self.flushing.get(chat_id)
+
+    def flush(self) -> int:
+        """
+        Writes all rows from the buffer to the database
+
+        :return: number of written rows
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self.rows:
+                    return 0
+                self.flushing, self.rows = self.rows, {}
+                rows = self.flushing
+
+            try:
+                db.add_many(UPSERT_QUERY, list(rows.values()),
+                            chat_ids=rows.keys())
+            except DatabaseError as e:
+                if isinstance(e.__cause__, DatabaseConnectionError):
+                    self._put_back(rows)
+                    written = 0
+                else:
+                    log.warning('Cannot write %d changed users to the '
+                                'database at once, writing them one by one',
+                                len(rows))
+                    written = self._write_one_by_one(rows)
+            else:
+                written = len(rows)
+
+            with self._lock:
+                self.flushing = {}
+                self.metrics.rows += written
+                self.metrics.flushes += 1
+        log.debug('%d changed users have been written to the database',
+                  written)
+        return written
+
+    def _write_one_by_one(self, rows: Dict[int, Row]) -> int:
+        """
+        Writes rows one by one after the batch has failed
+
+        If the database becomes unavailable, the rows go back to the
+        buffer. A row that the database doesn't accept (a name with
+        characters that don't fit the charset of the table, for example) is
+        dropped, otherwise it would fail every next flush
+
+        :param rows: rows of the batch by chat_id
+        :return: number of written rows
+        """
+        written = 0
+        for chat_id, row in rows.items():
+            try:
+                db.add(UPSERT_QUERY, row, chat_id=chat_id)
+            except DatabaseError as e:
+                if isinstance(e.__cause__, DatabaseConnectionError):
+                    self._put_back(rows)
+                    return written
+                log.error('Cannot write user %s to the database, the change '
+                          'is dropped: %s', chat_id, row)
+                with self._lock:
+                    self.metrics.dropped += 1
+            else:
+                written += 1
+        return written
+
+    def _put_back(self, rows: Dict[int, Row]) -> None:
+        """
+        Returns rows to the buffer when the database is unavailable
+
+        :param rows: rows that have been taken for a flush
+        :return: None
+        """
+        log.error('The database is unavailable, changed users will be '
+                  'written with the next flush')
+        with self._lock:
+            # changes that have come during the flush are newer, rows that
+            # have been written already are simply written again
+            for chat_id, row in rows.items():
+                self.rows.setdefault(chat_id, row)
+            self.metrics.failed_flushes += 1
+
+    def send_digest(self) -> None:
+        """
+        Tells the admin about new users since the previous digest
+
+        :return: None
+        """
+        with self._lock:
+            new_users, self.new_users = self.new_users, []
+            self._last_digest = time.monotonic()
+        if not new_users:
+            return
+
+        text = f'You have {len(new_users)} new users!\n'
+        text += '\n'.join(new_users[:MAX_DIGEST_USERS])
+        if len(new_users) > MAX_DIGEST_USERS:
+            text += f'\nand {len(new_users) - MAX_DIGEST_USERS} more.'
+        try:
+            bot.send_message(config.MY_TELEGRAM, text=text)
+        except Exception as e:
+            log.error('Cannot send the digest of new users: %s', e)
+            with self._lock:
+                self.new_users = new_users + self.new_users
+
+    def start(self) -> None:
+        """
+        Starts a thread that flushes the buffer and sends digests
+
+        :return: None
+        """
+        self.running = True
+        self._stop.clear()
+        thread = threading.Thread(target=self._run, name='user writes',
+                                  daemon=True)
+        thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                if (time.monotonic() - self._last_digest >=
+                        self.digest_interval):
+                    self.send_digest()
+            except Exception as e:
+                log.error('Cannot flush changed users: %s', e)
+
+    def stop(self) -> None:
+        """
+        Stops the thread and writes what is left in the buffer
+
+        :return: None
+        """
+        if not self.running:
+            return
+        self.running = False
+        self._stop.set()
+        self.flush()
+        self.send_digest()
+
+    def __str__(self) -> str:
+        metrics = self.metrics
+        return (f'User writes: {len(self.rows)} users wait for a flush, '
+                f'{len(self.new_users)} for the digest of new users. '
+                f'{metrics.changes} changes, {metrics.coalesced} coalesced, '
+                f'{metrics.rows} rows written in {metrics.flushes} flushes, '
+                f'{metrics.failed_flushes} flushes failed, '
+                f'{metrics.dropped} rows dropped.')
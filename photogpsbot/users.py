@@ -3,12 +3,14 @@ Module to manage users of bot: store and update information, interact with
 the database, keep tack of and switch language of interface for a user
 """
 
-import config
-from photogpsbot import bot, log, db
-from photogpsbot.db_connector import DatabaseError, DatabaseConnectionError
+import sys
+import time
+
+from photogpsbot import log, db, user_writes
+from photogpsbot.db_connector import DatabaseConnectionError
 
 from telebot.types import Message  # type: ignore
-from typing import Tuple
+from typing import Dict, Tuple
 
 
 class User:
@@ -18,38 +20,33 @@ class User:
     Class that represents one user of this Telegram bot and helps to store
     and retrieve basic info about him and his language of choice for
     interface of the bot
+
+    The bot can keep all its users in memory, so instances don't have
+    __dict__ and users share strings of language tags and of first names,
+    which repeat a lot
     """
+    __slots__ = ('chat_id', 'first_name', 'nickname', 'last_name',
+                 'language')
+
     def __init__(self, chat_id, first_name, nickname, last_name,
                  language='en-US'):
         self.chat_id = chat_id
-        self.first_name = first_name
+        self.first_name = sys.intern(first_name) if first_name else first_name
         self.nickname = nickname
         self.last_name = last_name
-        self.language = language
+        self.language = sys.intern(language) if language else language
 
     def set_language(self, lang: str) -> None:
         """
-        Update language of user in the User object and in the database
+        Update language of user in the User object, the database gets it
+        with the next flush of user_writes
 
         :param lang: string with language tag like "en-US"
         :return: None
         """
-        log.debug('Updating info about user %s language '
-                  'in memory & database...', self)
-
-        self.language = lang
-
-        query = ("UPDATE users "
-                 f"SET language=%s "
-                 f"WHERE chat_id=%s")
-
-        parameters = self.language, self.chat_id
-        try:
-            db.add(query, parameters)
-        except DatabaseError:
-            log.error("Can't add new language of %s to the database", self)
-        else:
-            log.debug('Language updated.')
+        log.debug('Updating info about user %s language...', self)
+        self.language = sys.intern(lang)
+        user_writes.add(self)
 
     def switch_language(self) -> str:
         """
@@ -85,7 +82,7 @@ class Users:
     cache them from the database, check whether user changed his info etc
     """
     def __init__(self):
-        self.users = {}
+        self.users: Dict[int, User] = {}
 
     @staticmethod
     def get_total_number() -> int:
@@ -166,6 +163,35 @@ class Users:
                 log.debug("Caching user: %s", self.users[items[0]])
         log.info('Users have been cached.')
 
+    def preload(self) -> None:
+        """
+        Loads all users from the database to the cache, so that the bot
+        doesn't look them up in the database one by one
+
+        The table is read row by row, so the whole result is never in
+        memory at once
+
+        :return: None
+        """
+        log.info('Loading all users from the database...')
+        start = time.perf_counter()
+        query = ('SELECT chat_id, first_name, nickname, last_name, language '
+                 'FROM users')
+        loaded = 0
+        try:
+            for chat_id, *user_data in db.stream(query):
+                if chat_id not in self.users:
+                    self.users[chat_id] = User(chat_id, *user_data)
+                    loaded += 1
+        except Exception as e:
+            log.error('Cannot load all users: %s', e)
+            log.warning('Caching only the last active users instead')
+            self.cache(100)
+            return
+
+        log.info('%d users have been loaded in %.1f seconds', loaded,
+                 time.perf_counter() - start)
+
     def clean_cache(self, limit: int) -> None:
         """
         Method that remove several User objects from cache - the least 
@@ -209,35 +235,14 @@ class Users:
                 num_deleted_entries += 1
         log.debug("%d users were removed from cache.", num_deleted_entries)
 
-    @staticmethod
-    def _add_to_db(user: User) -> None:
-        """
-        Adds the User object to the database
-
-        :param user: User object with info about user
-        :return: None
-        """
-        query = ("INSERT INTO users (chat_id, first_name, nickname, "
-                 "last_name, language) "
-                 f"VALUES (%s, %s, %s, %s, %s)")
-
-        parameters = (user.chat_id, user.first_name, user.nickname,
-                      user.last_name, user.language)
-
-        try:
-            db.add(query, parameters)
-        except DatabaseError:
-            log.error("Cannot add user to the database")
-        else:
-            log.info(f"User {user} was successfully added to the users db")
-
     def add_new_one(self,
                     chat_id: int, first_name: str, nickname: str,
                     last_name: str, language: str,
                     add_to_db: bool = True) -> User:
         """
-        Adds a new User in dictionary with users and to the database
-        at one fell swoop
+        Adds a new User in dictionary with users and to the buffer that
+        writes it to the database, the admin learns about the user from the
+        next digest of new users
 
         :param chat_id: id of a Telegram user
         :param first_name: first name of a Telegram user
@@ -252,7 +257,7 @@ class Users:
         user = User(chat_id, first_name, nickname, last_name, language)
         self.users[chat_id] = user
         if add_to_db:
-            self._add_to_db(user)
+            user_writes.add(user, new=True)
         return user
 
     @staticmethod
@@ -263,7 +268,8 @@ class Users:
         This method compare a user object from the bot and his info from
         the Telegram message to check whether a user has changed his bio
         or not. If yes, the user object that represents him in the bot will
-        be updated accordingly. Now this function is called only when a user
+        be updated accordingly and written to the database with the next
+        flush of user_writes. Now this function is called only when a user
         asks the bot for showing the most popular cams
 
         :param user: user object that represents a Telegram user in this bot
@@ -295,23 +301,7 @@ class Users:
             return
 
         log.info("User has changed his info")
-        log.debug("Updating user's info in the database...")
-        query = (f"UPDATE users "
-                 f"SET first_name=%s, "
-                 f"nickname=%s, "
-                 f"last_name=%s "
-                 f"WHERE chat_id=%s")
-
-        parameters = (user.first_name, user.nickname, user.last_name,
-                      user.chat_id)
-
-        try:
-            db.add(query, parameters)
-        except DatabaseError:
-            log.error("Could not update info about %s in the database",
-                      user)
-        else:
-            log.debug("User's info has been updated")
+        user_writes.add(user)
 
     def find_one(self, message: Message) -> User:
         """
@@ -329,6 +319,12 @@ class Users:
         if user:
             return user
 
+        # the user could have been removed from the cache before their
+        # changes were written to the database, then the changes are newer
+        row = user_writes.pending(message.chat.id)
+        if row:
+            return self.add_new_one(*row, add_to_db=False)
+
         # otherwise look up the user in the database
         log.debug("Looking up the user in the database as it doesn't "
                   "appear in cache")
@@ -338,7 +334,8 @@ class Users:
 
         parameters = message.chat.id,
         try:
-            cursor = db.execute_query(query, parameters)
+            cursor = db.execute_query(query, parameters,
+                                      chat_id=message.chat.id)
         except DatabaseConnectionError:
 
             # Even if the database in unreachable add user to dictionary
@@ -360,8 +357,6 @@ class Users:
             user = self.add_new_one(message.chat.id, msg.first_name,
                                     msg.last_name, msg.username,
                                     language='en-US')
-            bot.send_message(config.MY_TELEGRAM,
-                             text=f'You have a new user! {user}')
             log.info('You have a new user! Welcome %s', user)
 
         # finally if the user wasn't found in the cache of the bot, but was
@@ -0,0 +1,270 @@
+"""
+Module that runs the bot in several processes.
+
+Reading EXIF and building answers take CPU, and threads of one process
+can't do it in parallel because of the GIL. In this mode one process (the
+dispatcher) only gets updates from Telegram and passes them as they are,
+as JSON, to several worker processes through queues. Every worker has its
+own connection to the database and its own caches and handles updates with
+the same handlers as the bot in one process does.
+
+All updates from one chat go to the same worker, so they are handled in the
+order they were sent. When the bot is turned off (by the admin command or by
+SIGTERM/SIGINT) the dispatcher stops getting updates, workers handle
+updates that are already in their queues and stop.
+"""
+
+import multiprocessing
+import signal
+from datetime import datetime
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+from multiprocessing.synchronize import Event
+from queue import Full
+from typing import Callable, List, Optional
+
+import requests
+# goes as pyTelegramBotAPI in requirements
+from telebot import apihelper, types  # type: ignore
+
+from photogpsbot import bot, log
+import config
+
+# Handles one update that is a dictionary parsed from JSON
+Handler = Callable[[dict], None]
+
+# Workers are forked, so they get handlers that have been registered in the
+# dispatcher before they start
+_context = multiprocessing.get_context('fork')
+
+
+def get_chat_id(update: dict) -> Optional[int]:
+    """
+    Finds out what chat an update comes from
+
+    :param update: update from Telegram as a dictionary
+    :return: id of the chat or None if the update isn't related to a chat
+    """
+    for key in ('message', 'edited_message', 'channel_post',
+                'edited_channel_post'):
+        if key in update:
+            return update[key]['chat']['id']
+
+    callback_query = update.get('callback_query')
+    if callback_query:
+        message = callback_query.get('message')
+        if message:
+            return message['chat']['id']
+        return callback_query['from']['id']
+
+    for key in ('inline_query', 'chosen_inline_result', 'shipping_query',
+                'pre_checkout_query'):
+        if key in update:
+            return update[key]['from']['id']
+    return None
+
+
+def handle_update(update: dict) -> None:
+    """
+    Handles an update with handlers of the bot
+
+    :param update: update from Telegram as a dictionary
+    :return: None
+    """
+    bot.process_new_updates([types.Update.de_json(update)])
+
+
+def _work(index: int, queue: Queue, stop_event: Event,
+          prepare: Callable[[], None], finish: Callable[[], None],
+          handle: Handler) -> None:
+    """
+    Body of a worker process
+
+    :param index: number of the worker
+    :param queue: queue with updates for this worker
+    :param stop_event: event that is set when the bot has to be turned off
+    :param prepare: function that connects the worker to the database etc
+    :param finish: function that closes connections of the worker
+    :param handle: function that handles an update
+    :return: None
+    """
+    # Ctrl+C is sent to all processes, but workers stop when the dispatcher
+    # tells them to, so they don't lose updates from their queues
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # threads of the pool of the bot don't survive fork, handlers are run
+    # right in this process
+    bot.threaded = False
+    bot.shutdown_event = stop_event
+    bot.start_time = datetime.now()
+
+    prepare()
+    log.info('Worker %d is ready', index)
+    try:
+        while True:
+            update = queue.get()
+            if update is None:
+                break
+            try:
+                handle(update)
+            except Exception as e:
+                log.error('Worker %d cannot handle an update: %s', index, e)
+    finally:
+        finish()
+        log.info('Worker %d has stopped', index)
+
+
+class Dispatcher:
+    """
+    Gets updates from Telegram and routes them to worker processes
+    """
+
+    def __init__(self, workers: int, prepare: Callable[[], None],
+                 finish: Callable[[], None],
+                 handle: Handler = handle_update) -> None:
+        """
+        Init variables
+
+        :param workers: number of worker processes
+        :param prepare: function that is called in every worker when it
+        starts, for example to connect to the database
+        :param finish: function that is called in every worker when it
+        stops
+        :param handle: function that handles an update in a worker
+        """
+        self.prepare = prepare
+        self.finish = finish
+        self.handle = handle
+        self.stop_event = _context.Event()
+        self.queues = [_context.Queue(maxsize=config.WORKER_QUEUE_SIZE)
+                       for _ in range(workers)]
+        self.processes: List[Optional[BaseProcess]] = [None] * workers
+        self.offset: Optional[int] = None
+        self.restarts = 0
+
+    def _start_worker(self, index: int) -> None:
+        """
+        Starts a worker process
+
+        :param index: number of the worker
+        :return: None
+        """
+        process = _context.Process(
+            target=_work, name=f'photogpsbot worker {index}',
+            args=(index, self.queues[index], self.stop_event, self.prepare,
+                  self.finish, self.handle))
+        process.start()
+        self.processes[index] = process
+
+    def start_workers(self) -> None:
+        """
+        Starts all worker processes
+
+        :return: None
+        """
+        for index in range(len(self.queues)):
+            self._start_worker(index)
+        log.info('%d workers have been started', len(self.queues))
+
+    def check_workers(self) -> None:
+        """
+        Starts again workers that have died, unless the bot is stopping
+
+        :return: None
+        """
+        for index, process in enumerate(self.processes):
+            if process.is_alive() or self.stop_event.is_set():
+                continue
+            log.error('Worker %d has died with exit code %s, starting it '
+                      'again...', index, process.exitcode)
+            self.restarts += 1
+            self._start_worker(index)
+
+    def dispatch(self, update: dict) -> None:
+        """
+        Puts an update to the queue of a worker that handles its chat
+
+        :param update: update from Telegram as a dictionary
+        :return: None
+        """
+        chat_id = get_chat_id(update)
+        index = chat_id % len(self.queues) if chat_id is not None else 0
+        self.queues[index].put(update)
+
+    def poll(self) -> None:
+        """
+        Gets updates from Telegram once and dispatches them
+
+        :return: None
+        """
+        updates = apihelper.get_updates(bot.token, offset=self.offset,
+                                        timeout=config.POLLING_TIMEOUT)
+        for update in updates:
+            self.dispatch(update)
+            self.offset = update['update_id'] + 1
+
+    def stop(self, *args) -> None:
+        """
+        Asks the dispatcher and workers to stop, it is also a signal handler
+
+        :return: None
+        """
+        self.stop_event.set()
+
+    def shutdown(self) -> None:
+        """
+        Waits until workers handle updates from their queues and stop
+
+        :return: None
+        """
+        log.info('Stopping workers...')
+        for queue, process in zip(self.queues, self.processes):
+            # a worker that has died doesn't empty its queue, waiting for a
+            # free place in it would block forever
+            try:
+                queue.put(None, timeout=config.WORKER_SHUTDOWN_TIMEOUT)
+            except Full:
+                log.warning('Queue of %s is full, terminating it',
+                            process.name)
+                process.terminate()
+        for process in self.processes:
+            process.join(config.WORKER_SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                log.warning('%s has not stopped in time, terminating it',
+                            process.name)
+                process.terminate()
+                process.join()
+
+        # Telegram learns that the last updates have been received only
+        # from the next request, otherwise it would send them again
+        if self.offset:
+            try:
+                apihelper.get_updates(bot.token, offset=self.offset, limit=1)
+            except Exception as e:
+                log.warning('Cannot confirm the last updates: %s', e)
+
+    def run(self) -> None:
+        """
+        Runs the bot with workers until it is turned off
+
+        :return: None
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        bot.start_time = datetime.now()
+        self.start_workers()
+        log.info('Starting photogpsbot with %d workers...', len(self.queues))
+        while not self.stop_event.is_set():
+            try:
+                self.poll()
+            except (requests.RequestException,
+                    apihelper.ApiException) as e:
+                log.error(e)
+                log.warning('Pausing dispatcher for 30 seconds...')
+                self.stop_event.wait(30)
+            self.check_workers()
+
+        self.shutdown()
+        log.info('Auf Wiedersehen! Bot is turned off.')
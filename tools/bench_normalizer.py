@@ -0,0 +1,132 @@
+"""
+Golden test and benchmark of the normalizer of names of cameras and lenses.
+
+First every case of tools/name_corpus.json (brand and model from EXIF and
+the expected name) is normalized and compared with the expected name; the
+script exits with 1 if any name differs, so a change of rules or of the
+normalizer that changes names is noticed before names in the database
+split. Then it measures how fast names are made: by the way the bot used to
+do it (merging and dropping repeated substrings), by the normalizer without
+memoization and with it, on a stream of names like the one the bot gets.
+
+Usage (from the root of the repository):
+python tools/bench_normalizer.py [--names 200000]
+python tools/bench_normalizer.py --update  # write current names to the corpus
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from typing import Callable, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from photogpsbot.normalizer import NameNormalizer  # noqa: E402
+import config  # noqa: E402
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'name_corpus.json')
+
+Pair = Tuple[Optional[str], Optional[str]]
+
+
+def old_name(brand: Optional[str], model: Optional[str]) -> Optional[str]:
+    """
+    Makes a name the way the bot did before the normalizer
+
+    :param brand: brand from EXIF
+    :param model: model from EXIF
+    :return: name of a camera or a lens
+    """
+    name = f'{brand or ""} {model or ""}'
+    if name == ' ':
+        return None
+    deduped_string = ''
+    for x in name.split(' '):
+        if x not in deduped_string:
+            deduped_string += x + ' '
+    return deduped_string.rstrip()
+
+
+def check(normalizer: NameNormalizer, corpus: List[dict]) -> int:
+    """
+    Compares names made by the normalizer with the golden ones
+
+    :param normalizer: normalizer with rules of the bot
+    :param corpus: cases with brand, model and expected name
+    :return: number of names that differ
+    """
+    failures = 0
+    for case in corpus:
+        name = normalizer.normalize(case['brand'], case['model'])
+        if name != case['name']:
+            failures += 1
+            print(f'FAIL {case["brand"]!r} + {case["model"]!r}: '
+                  f'{name!r} instead of {case["name"]!r}')
+    print(f'{len(corpus) - failures} of {len(corpus)} names are as expected')
+    return failures
+
+
+def measure(function: Callable[[Optional[str], Optional[str]], Optional[str]],
+            stream: List[Pair]) -> float:
+    """
+    Measures how many names a function makes per second
+
+    :param function: function that makes a name out of a brand and a model
+    :param stream: brands and models
+    :return: names per second
+    """
+    start = time.perf_counter()
+    for brand, model in stream:
+        function(brand, model)
+    return len(stream) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Golden test and benchmark of the name normalizer')
+    parser.add_argument('--names', type=int, default=200000)
+    parser.add_argument('--update', action='store_true',
+                        help='write names made now to the corpus')
+    args = parser.parse_args()
+
+    normalizer = NameNormalizer.from_file(config.NAME_RULES_FILE,
+                                          config.NAME_CACHE_SIZE)
+    with open(CORPUS_FILE, 'r', encoding='utf8') as corpus_file:
+        corpus = json.load(corpus_file)
+
+    if args.update:
+        for case in corpus:
+            case['name'] = normalizer.normalize(case['brand'], case['model'])
+        with open(CORPUS_FILE, 'w', encoding='utf8') as corpus_file:
+            json.dump(corpus, corpus_file, ensure_ascii=False, indent=4)
+        print(f'{len(corpus)} names have been written to the corpus')
+        return
+
+    failures = check(normalizer, corpus)
+
+    # popular cameras come much more often than the rest, like in the bot
+    generator = random.Random(0)
+    pairs = [(case['brand'], case['model']) for case in corpus]
+    weights = [1 / rank for rank in range(1, len(pairs) + 1)]
+    stream = generator.choices(pairs, weights, k=args.names)
+
+    print(f'{args.names} names:')
+    print(f'  substring dedup (old)    {measure(old_name, stream):10.0f} '
+          f'names/s')
+    print(f'  normalizer without cache '
+          f'{measure(normalizer._normalize, stream):10.0f} names/s')
+    normalizer.normalize.cache_clear()
+    print(f'  normalizer with cache    '
+          f'{measure(normalizer.normalize, stream):10.0f} names/s')
+    print(f'  {normalizer}')
+
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
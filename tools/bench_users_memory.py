@@ -0,0 +1,103 @@
+"""
+Benchmark of memory that the cache of users takes.
+
+Fills Users.users with generated users like the ones that come from the
+users table and measures memory with tracemalloc, both for the User class of
+the bot and for the same class with __dict__ (how it used to be).
+
+Usage (from the root of the repository):
+python tools/bench_users_memory.py [--users 100000 1000000]
+"""
+
+import argparse
+import gc
+import os
+import random
+import string
+import sys
+import tracemalloc
+from typing import Callable, Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from photogpsbot.users import User  # noqa: E402
+
+FIRST_NAMES = ['Alex', 'Anna', 'Maria', 'Ivan', 'John', 'Olga', 'Dmitry',
+               'Elena', 'Michael', 'Sergey', 'Kate', 'Paul', 'Natalia']
+
+
+class UserWithDict:
+    """
+    User class of the bot before it got __slots__
+    """
+
+    def __init__(self, chat_id, first_name, nickname, last_name,
+                 language='en-US'):
+        self.chat_id = chat_id
+        self.first_name = first_name
+        self.nickname = nickname
+        self.last_name = last_name
+        self.language = language
+
+
+def make_row(generator: random.Random, chat_id: int) -> tuple:
+    """
+    Makes a row like the ones from the users table, every string is a new
+    object as it is when it comes from MySQL
+
+    :param generator: source of random numbers
+    :param chat_id: id of the user
+    :return: row of the table
+    """
+    def word(length: int) -> str:
+        return ''.join(generator.choice(string.ascii_lowercase)
+                       for _ in range(length))
+
+    first_name = ''.join(list(generator.choice(FIRST_NAMES)))
+    nickname = word(generator.randint(5, 12)) if generator.random() < 0.7 \
+        else None
+    last_name = word(generator.randint(4, 10)).title() \
+        if generator.random() < 0.5 else None
+    language = ''.join(list('ru-RU' if generator.random() < 0.6 else 'en-US'))
+    return chat_id, first_name, nickname, last_name, language
+
+
+def measure(number: int, user_class: Callable) -> int:
+    """
+    Measures memory of a cache with users
+
+    :param number: number of users
+    :param user_class: class of users
+    :return: bytes per user
+    """
+    generator = random.Random(0)
+    gc.collect()
+    tracemalloc.start()
+    users: Dict[int, object] = {}
+    for index in range(number):
+        chat_id = 100000000 + index * 7
+        users[chat_id] = user_class(*make_row(generator, chat_id))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del users
+    return size // number
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Memory taken by the cache of users')
+    parser.add_argument('--users', type=int, nargs='+',
+                        default=[100000, 1000000])
+    args = parser.parse_args()
+
+    for number in args.users:
+        with_dict = measure(number, UserWithDict)
+        with_slots = measure(number, User)
+        print(f'{number:>9} users: with __dict__ {with_dict} bytes/user '
+              f'({with_dict * number / 1024 ** 2:.0f} MB), with __slots__ '
+              f'{with_slots} bytes/user '
+              f'({with_slots * number / 1024 ** 2:.0f} MB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark of the multi-process mode of the bot: how many photos per second
+are handled with a different number of worker processes.
+
+Updates go through the same dispatcher and queues as in the bot. Instead of
+downloading a file from Telegram and answering, a worker runs the CPU-bound
+part of handling a photo: reads EXIF of a generated JPEG, converts
+coordinates, finds out the country and builds the answer. Nothing goes to
+the database or to the network.
+
+Usage (from the root of the repository):
+python tools/bench_workers.py [--photos 2000] [--workers 1 2 4 8]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from io import BytesIO
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from photogpsbot import User, country_resolver  # noqa: E402
+from photogpsbot.process_image import ImageHandler  # noqa: E402
+from photogpsbot.workers import Dispatcher, _context  # noqa: E402
+
+from exif_samples import make_random_jpeg  # noqa: E402
+
+_samples: List[bytes] = []
+_ready = _context.Queue()
+
+
+def prepare() -> None:
+    """
+    Makes sample photos and loads borders of countries before the clock
+    starts
+
+    :return: None
+    """
+    generator = random.Random(os.getpid())
+    _samples.extend(make_random_jpeg(generator, extra_tags=50)
+                    for _ in range(20))
+    country_resolver.find_code(0, 0)
+    _ready.put(os.getpid())
+
+
+def finish() -> None:
+    pass
+
+
+def handle(update: dict) -> None:
+    """
+    Does what the bot does with a photo except for network and database
+
+    :param update: update with a document like the ones from Telegram
+    :return: None
+    """
+    message = update['message']
+    user = User(message['chat']['id'], message['from']['first_name'], None,
+                None, 'en-US')
+    content = _samples[update['update_id'] % len(_samples)]
+    handler = ImageHandler(user, BytesIO(content))
+    raw_data = handler._get_raw_data(BytesIO(content))
+    latitude, longitude = handler._convert_coordinates(raw_data)
+    country = handler._get_country(latitude, longitude)
+    answer = (f'{raw_data.date_time}\n{raw_data.camera_brand} '
+              f'{raw_data.camera_model}\n{raw_data.lens_brand} '
+              f'{raw_data.lens_model}\n{country}')
+    assert answer
+
+
+def make_update(update_id: int, chat_id: int) -> dict:
+    return {'update_id': update_id,
+            'message': {'message_id': update_id,
+                        'date': int(time.time()),
+                        'chat': {'id': chat_id, 'type': 'private'},
+                        'from': {'id': chat_id, 'is_bot': False,
+                                 'first_name': 'Test'},
+                        'document': {'file_id': f'file{update_id}',
+                                     'file_name': 'photo.jpg',
+                                     'mime_type': 'image/jpeg'}}}
+
+
+def run(workers: int, photos: int, chats: int) -> float:
+    """
+    Handles photos with a number of workers
+
+    :param workers: number of worker processes
+    :param photos: number of photos
+    :param chats: number of users who send them
+    :return: photos per second
+    """
+    dispatcher = Dispatcher(workers, prepare, finish, handle)
+    dispatcher.start_workers()
+    for _ in range(workers):
+        _ready.get()
+
+    start = time.perf_counter()
+    generator = random.Random(0)
+    for update_id in range(photos):
+        dispatcher.dispatch(make_update(update_id,
+                                        generator.randrange(1, chats + 1)))
+    dispatcher.shutdown()
+    return photos / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Throughput of the bot against the number of workers')
+    parser.add_argument('--photos', type=int, default=2000)
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, os.cpu_count()])
+    args = parser.parse_args()
+
+    print(f'{args.photos} photos from {args.chats} chats, '
+          f'{os.cpu_count()} CPUs')
+    baseline = None
+    for workers in sorted(set(args.workers)):
+        throughput = run(workers, args.photos, args.chats)
+        baseline = baseline or throughput
+        print(f'{workers:3} workers: {throughput:8.1f} photos/s, '
+              f'x{throughput / baseline:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Makes JPEG files with EXIF like the ones that users send to the bot.
+
+The files have a camera, a lens, a date and coordinates in EXIF and a
+comment segment of a given size instead of the picture, which is enough for
+the bot, because it only reads EXIF. They are used by benchmarks and load
+tests.
+
+Usage:
+python tools/exif_samples.py folder [--number 100]
+"""
+
+import argparse
+import os
+import random
+import struct
+from typing import List, Tuple
+
+ASCII = 2
+SHORT = 3
+LONG = 4
+RATIONAL = 5
+
+CAMERAS = [('Apple', 'iPhone 8', 'Apple', 'iPhone 8 back camera 3.99mm f/1.8'),
+           ('Canon', 'Canon EOS 80D', 'Canon',
+            'EF-S18-135mm f/3.5-5.6 IS USM'),
+           ('NIKON CORPORATION', 'NIKON D750', 'NIKON', '24.0-120.0 mm f/4.0'),
+           ('SONY', 'ILCE-7M3', 'SONY', 'FE 24-105mm F4 G OSS'),
+           ('samsung', 'SM-G960F', 'samsung', 'Samsung Galaxy S9 Rear Camera'),
+           ('FUJIFILM', 'X-T2', 'FUJIFILM', 'XF35mmF2 R WR')]
+
+# an entry of an IFD: tag, type and value
+Entry = Tuple[int, int, object]
+
+
+def _rationals(value: float) -> List[Tuple[int, int]]:
+    """
+    Turns decimal degrees into degrees, minutes and seconds as rationals
+
+    :param value: coordinate in decimal degrees
+    :return: list of three pairs of numerator and denominator
+    """
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = round(((value - degrees) * 60 - minutes) * 60 * 1000)
+    return [(degrees, 1), (minutes, 1), (seconds, 1000)]
+
+
+def _pack_ifd(entries: List[Entry], offset: int) -> bytes:
+    """
+    Packs an IFD of big-endian TIFF
+
+    :param entries: entries of the IFD
+    :param offset: offset of the IFD from the beginning of TIFF header
+    :return: bytes of the IFD with its data
+    """
+    entries = sorted(entries, key=lambda entry: entry[0])
+    data_offset = offset + 2 + len(entries) * 12 + 4
+    table = struct.pack('>H', len(entries))
+    data = b''
+    for tag, kind, value in entries:
+        if kind == ASCII:
+            raw = value.encode('ascii') + b'\0'
+            count = len(raw)
+        elif kind == RATIONAL:
+            raw = b''.join(struct.pack('>II', *pair) for pair in value)
+            count = len(value)
+        elif kind == SHORT:
+            raw = struct.pack('>H', value) + b'\0\0'
+            count = 1
+        else:
+            raw = struct.pack('>I', value)
+            count = 1
+
+        if len(raw) <= 4:
+            table += (struct.pack('>HHI', tag, kind, count) +
+                      raw.ljust(4, b'\0'))
+        else:
+            table += struct.pack('>HHII', tag, kind, count,
+                                 data_offset + len(data))
+            data += raw + (b'\0' if len(raw) % 2 else b'')
+    return table + struct.pack('>I', 0) + data
+
+
+def make_jpeg(camera: Tuple[str, str, str, str], latitude: float,
+              longitude: float, date: str = '2019:05:01 12:30:00',
+              size: int = 0, extra_tags: int = 0) -> bytes:
+    """
+    Makes a JPEG file with EXIF
+
+    :param camera: brand and model of a camera and brand and model of a lens
+    :param latitude: latitude in decimal degrees
+    :param longitude: longitude in decimal degrees
+    :param date: date of shooting like in EXIF
+    :param size: approximate size of the file in bytes
+    :param extra_tags: number of additional tags that make EXIF heavier to
+    parse, like maker notes of real cameras do
+    :return: content of the file
+    """
+    make, model, lens_make, lens_model = camera
+
+    # IFD0 starts right after the TIFF header, sizes of IFDs are found out by
+    # packing them with a dummy offset first
+    ifd0 = [(0x010F, ASCII, make), (0x0110, ASCII, model),
+            (0x0132, ASCII, date), (0x8769, LONG, 0), (0x8825, LONG, 0)]
+    ifd0 += [(0xC000 + index, ASCII, f'value of a tag number {index}')
+             for index in range(extra_tags)]
+    exif_ifd = [(0x9003, ASCII, date), (0xA433, ASCII, lens_make),
+                (0xA434, ASCII, lens_model)]
+    gps_ifd = [(0x0001, ASCII, 'N' if latitude >= 0 else 'S'),
+               (0x0002, RATIONAL, _rationals(latitude)),
+               (0x0003, ASCII, 'E' if longitude >= 0 else 'W'),
+               (0x0004, RATIONAL, _rationals(longitude))]
+
+    ifd0_size = len(_pack_ifd(ifd0, 8))
+    exif_offset = 8 + ifd0_size
+    exif_size = len(_pack_ifd(exif_ifd, exif_offset))
+    gps_offset = exif_offset + exif_size
+    ifd0 = [(tag, kind, {0x8769: exif_offset, 0x8825: gps_offset}.get(tag,
+                                                                     value))
+            for tag, kind, value in ifd0]
+
+    tiff = (b'MM\0\x2a' + struct.pack('>I', 8) + _pack_ifd(ifd0, 8) +
+            _pack_ifd(exif_ifd, exif_offset) + _pack_ifd(gps_ifd, gps_offset))
+    app1 = b'Exif\0\0' + tiff
+    jpeg = b'\xff\xd8' + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1
+
+    # comment segments stand for the picture itself
+    padding = size - len(jpeg) - 2
+    while padding > 4:
+        chunk = min(padding - 4, 65000)
+        jpeg += b'\xff\xfe' + struct.pack('>H', chunk + 2) + b'\0' * chunk
+        padding -= chunk + 4
+    return jpeg + b'\xff\xd9'
+
+
+def make_random_jpeg(generator: random.Random, size: int = 0,
+                     extra_tags: int = 0) -> bytes:
+    """
+    Makes a JPEG file with a random camera and random coordinates on land
+    or in the sea
+
+    :param generator: source of random numbers
+    :param size: approximate size of the file in bytes
+    :param extra_tags: number of additional tags in EXIF
+    :return: content of the file
+    """
+    return make_jpeg(generator.choice(CAMERAS),
+                     latitude=generator.uniform(-60, 70),
+                     longitude=generator.uniform(-180, 180),
+                     size=size, extra_tags=extra_tags)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Make JPEG files with EXIF')
+    parser.add_argument('folder')
+    parser.add_argument('--number', type=int, default=100)
+    parser.add_argument('--size', type=int, default=3 * 1024 ** 2,
+                        help='size of every file in bytes')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generator = random.Random(args.seed)
+    os.makedirs(args.folder, exist_ok=True)
+    for index in range(args.number):
+        path = os.path.join(args.folder, f'photo_{index:05}.jpg')
+        with open(path, 'wb') as file:
+            file.write(make_random_jpeg(generator, args.size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,453 @@
+"""
+Fake Telegram Bot API server for end-to-end load tests of the bot.
+
+It implements getUpdates, getFile, downloading of files, sendMessage,
+sendLocation and answerCallbackQuery, which is enough for the bot to work
+with it as with Telegram. Updates with photos (documents) are either
+generated from sample JPEG files of tools/exif_samples.py at a given rate
+or taken from a script: a JSON file with a list of updates where file_id of
+a document is a path to a file relative to the script.
+
+The bot is started with TELEGRAM_API_URL pointing at the server (unless
+--no-bot is given, then start it yourself), and the server measures how long
+it takes the bot to answer every photo and how many photos it answers per
+second. The bot needs its database as usual, it uses the stub geocoder
+unless GEOCODER_PROVIDER is set. With --chat-limit the server answers "429
+Too Many Requests" like Telegram does when the bot sends more messages to
+one chat in a second than the limit.
+
+Usage (from the root of the repository):
+python tools/fake_telegram.py [--photos 1000] [--rate 50] [--chats 100]
+                              [--chat-limit 1]
+python tools/fake_telegram.py --script updates.json --no-bot --port 8081
+"""
+
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlparse
+
+from exif_samples import make_random_jpeg
+
+# Telegram gives out at most this number of updates at once
+MAX_UPDATES = 100
+
+
+def percentile(values: List[float], share: float) -> float:
+    """
+    Finds a percentile of sorted values
+
+    :param values: sorted list of numbers
+    :param share: percentile as a number from 0 to 1
+    :return: value that is bigger than the given share of values
+    """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+class FakeTelegram:
+    """
+    State of the fake Bot API: updates, files and answers of the bot
+    """
+
+    def __init__(self, chat_limit: Optional[int] = None) -> None:
+        """
+        Init variables
+
+        :param chat_limit: messages per second that one chat can get, more
+        messages get 429 answers. None means no limit
+        """
+        self.chat_limit = chat_limit
+        # time marks of the last messages to every chat
+        self.sent: Dict[int, List[float]] = {}
+        self.updates: List[dict] = []
+        self.files: Dict[str, bytes] = {}
+        self.next_update_id = 1
+        self.next_message_id = 1
+        # when the bot could get a message and when it answered it
+        self.received: Dict[Tuple[int, int], float] = {}
+        self.first_replies: Dict[Tuple[int, int], float] = {}
+        self.answers: Dict[Tuple[int, int], float] = {}
+        self.calls: Dict[str, int] = {}
+        self._condition = threading.Condition()
+
+    def add_file(self, file_id: str, content: bytes) -> None:
+        with self._condition:
+            self.files[file_id] = content
+
+    def add_update(self, update: dict) -> None:
+        """
+        Makes an update available to getUpdates
+
+        :param update: update without update_id, its message_id and date
+        are replaced too
+        :return: None
+        """
+        with self._condition:
+            update['update_id'] = self.next_update_id
+            self.next_update_id += 1
+            message = update.get('message')
+            if message:
+                message['message_id'] = self.next_message_id
+                message['date'] = int(time.time())
+                self.next_message_id += 1
+                key = message['chat']['id'], message['message_id']
+                self.received[key] = time.perf_counter()
+            self.updates.append(update)
+            self._condition.notify_all()
+
+    def add_photo(self, chat_id: int, file_id: str) -> None:
+        """
+        Makes an update with a photo sent as a file
+
+        :param chat_id: id of the user who sends the photo
+        :param file_id: id of a file that has been added before
+        :return: None
+        """
+        self.add_update(
+            {'message': {'chat': {'id': chat_id, 'type': 'private',
+                                  'first_name': f'User {chat_id}'},
+                         'from': {'id': chat_id, 'is_bot': False,
+                                  'first_name': f'User {chat_id}',
+                                  'language_code': 'en'},
+                         'document': {'file_id': file_id,
+                                      'file_name': 'photo.jpg',
+                                      'mime_type': 'image/jpeg',
+                                      'file_size': len(self.files[file_id])}}})
+
+    def get_updates(self, offset: int, limit: int, timeout: float) -> list:
+        """
+        Gives out updates like Telegram does, waiting for new ones up to
+        timeout seconds
+
+        :param offset: id of the first update to be returned, older ones are
+        confirmed and forgotten
+        :param limit: the biggest number of updates
+        :param timeout: seconds to wait if there are no updates
+        :return: list of updates
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                self.updates = [update for update in self.updates
+                                if update['update_id'] >= offset]
+                left = deadline - time.monotonic()
+                if self.updates or left <= 0:
+                    return self.updates[:limit]
+                self._condition.wait(left)
+
+    def send_message(self, params: dict, method: str) -> dict:
+        """
+        Records an answer of the bot and makes a message like Telegram does
+
+        :param params: parameters of sendMessage or sendLocation
+        :param method: name of the method
+        :return: sent message
+        """
+        chat_id = int(params.get('chat_id', 0))
+        now = time.perf_counter()
+        with self._condition:
+            reply_to = params.get('reply_to_message_id')
+            if reply_to:
+                key = chat_id, int(reply_to)
+                self.first_replies.setdefault(key, now)
+                # only the answer with info about the photo has Markdown
+                if params.get('parse_mode') == 'Markdown':
+                    self.answers[key] = now
+            message_id = self.next_message_id
+            self.next_message_id += 1
+
+        message = {'message_id': message_id, 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'},
+                   'from': {'id': 1, 'is_bot': True, 'first_name': 'Bot'}}
+        if method == 'sendLocation':
+            message['location'] = {'latitude': float(params['latitude']),
+                                   'longitude': float(params['longitude'])}
+        else:
+            message['text'] = params.get('text', '')
+        return message
+
+    def is_flooded(self, chat_id: int) -> bool:
+        """
+        Checks whether a message to a chat is over the limit of the chat
+
+        :param chat_id: id of the chat
+        :return: True if the message has to be rejected
+        """
+        if not self.chat_limit:
+            return False
+        now = time.monotonic()
+        with self._condition:
+            sent = [mark for mark in self.sent.get(chat_id, [])
+                    if now - mark < 1]
+            if len(sent) >= self.chat_limit:
+                self.sent[chat_id] = sent
+                return True
+            self.sent[chat_id] = sent + [now]
+            return False
+
+    def call(self, method: str, params: dict) -> Tuple[int, dict]:
+        """
+        Runs a method of Bot API
+
+        :param method: name of the method
+        :param params: its parameters
+        :return: HTTP status and body of the answer
+        """
+        with self._condition:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == 'getUpdates':
+            result = self.get_updates(
+                int(params.get('offset') or 0),
+                int(params.get('limit') or MAX_UPDATES),
+                float(params.get('timeout') or 0))
+        elif method == 'getFile':
+            file_id = params.get('file_id')
+            if file_id not in self.files:
+                return 400, {'ok': False, 'error_code': 400,
+                             'description': 'Bad Request: invalid file_id'}
+            result = {'file_id': file_id,
+                      'file_size': len(self.files[file_id]),
+                      'file_path': f'documents/{file_id}'}
+        elif method in ('sendMessage', 'sendLocation'):
+            if self.is_flooded(int(params.get('chat_id', 0))):
+                with self._condition:
+                    self.calls['429'] = self.calls.get('429', 0) + 1
+                return 429, {'ok': False, 'error_code': 429,
+                             'description': 'Too Many Requests: retry '
+                                            'after 1',
+                             'parameters': {'retry_after': 1}}
+            result = self.send_message(params, method)
+        elif method == 'answerCallbackQuery':
+            result = True
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bot',
+                      'username': 'fake_photogpsbot'}
+        else:
+            return 404, {'ok': False, 'error_code': 404,
+                         'description': 'Not Found'}
+        return 200, {'ok': True, 'result': result}
+
+    def report(self, started: float) -> str:
+        """
+        Makes a report on answers of the bot
+
+        :param started: time mark of the first update
+        :return: report with throughput and latency
+        """
+        with self._condition:
+            answers = [(self.answers[key] - self.received[key],
+                        self.answers[key])
+                       for key in self.answers if key in self.received]
+            firsts = sorted(self.first_replies[key] - self.received[key]
+                            for key in self.first_replies
+                            if key in self.received)
+            calls = dict(self.calls)
+            sent = len(self.received)
+
+        report = f'{len(answers)} of {sent} photos have been answered\n'
+        if answers:
+            duration = max(answered for _, answered in answers) - started
+            latencies = sorted(latency for latency, _ in answers)
+            report += f'throughput: {len(answers) / duration:.1f} photos/s\n'
+            for name, values in (('first reply', firsts),
+                                 ('answer', latencies)):
+                report += (f'{name} latency, ms: '
+                           f'p50 {percentile(values, 0.5) * 1000:.0f}, '
+                           f'p90 {percentile(values, 0.9) * 1000:.0f}, '
+                           f'p99 {percentile(values, 0.99) * 1000:.0f}, '
+                           f'max {values[-1] * 1000:.0f}\n')
+        report += 'calls: ' + ', '.join(f'{method} {number}' for method, number
+                                        in sorted(calls.items()))
+        return report
+
+
+def make_handler(telegram: FakeTelegram) -> type:
+    """
+    Makes a class of HTTP request handlers bound to the fake Telegram
+
+    :param telegram: state of the fake Bot API
+    :return: subclass of BaseHTTPRequestHandler
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, status: int, body: bytes,
+                  content_type: str = 'application/json') -> None:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self) -> None:
+            url = urlparse(self.path)
+            parts = url.path.strip('/').split('/')
+
+            # /file/bot<token>/documents/<file_id>
+            if parts[0] == 'file' and len(parts) > 2:
+                file_id = '/'.join(parts[3:])
+                content = telegram.files.get(file_id)
+                if content is None:
+                    self._send(404, b'Not Found', 'text/plain')
+                else:
+                    self._send(200, content, 'image/jpeg')
+                return
+
+            # /bot<token>/<method>
+            if len(parts) != 2 or not parts[0].startswith('bot'):
+                self._send(404, b'Not Found', 'text/plain')
+                return
+
+            params = dict(parse_qsl(url.query))
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                body = self.rfile.read(length).decode()
+                if self.headers.get('Content-Type', '').startswith(
+                        'application/json'):
+                    params.update(json.loads(body))
+                else:
+                    params.update(parse_qsl(body))
+
+            status, answer = telegram.call(parts[1], params)
+            self._send(status, json.dumps(answer).encode())
+
+        do_GET = _handle
+        do_POST = _handle
+
+        def log_message(self, *args) -> None:
+            pass
+
+    return Handler
+
+
+def load_script(telegram: FakeTelegram, path: str) -> List[dict]:
+    """
+    Reads updates from a script and files of their documents
+
+    :param telegram: state of the fake Bot API
+    :param path: JSON file with a list of updates
+    :return: list of updates
+    """
+    with open(path, encoding='utf8') as script:
+        updates = json.load(script)
+    folder = os.path.dirname(os.path.abspath(path))
+    for update in updates:
+        document = update.get('message', {}).get('document')
+        if document:
+            with open(os.path.join(folder, document['file_id']), 'rb') as file:
+                telegram.add_file(document['file_id'], file.read())
+    return updates
+
+
+def feed(telegram: FakeTelegram, args: argparse.Namespace) -> float:
+    """
+    Adds updates at the given rate
+
+    :param telegram: state of the fake Bot API
+    :param args: arguments of the command line
+    :return: time mark of the first update
+    """
+    generator = random.Random(args.seed)
+    if args.script:
+        updates = load_script(telegram, args.script)
+    else:
+        file_ids = []
+        for index in range(args.samples):
+            file_ids.append(f'sample{index}.jpg')
+            telegram.add_file(file_ids[-1],
+                              make_random_jpeg(generator, args.size))
+        updates = [None] * args.photos
+
+    started = time.perf_counter()
+    for index, update in enumerate(updates):
+        # updates come evenly, not in bursts
+        delay = started + index / args.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        if update:
+            telegram.add_update(update)
+        else:
+            telegram.add_photo(generator.randrange(1, args.chats + 1),
+                               generator.choice(file_ids))
+    return started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Fake Telegram Bot API for load tests of the bot')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--photos', type=int, default=1000,
+                        help='number of generated photos')
+    parser.add_argument('--rate', type=float, default=50,
+                        help='updates per second')
+    parser.add_argument('--chats', type=int, default=100,
+                        help='number of users who send generated photos')
+    parser.add_argument('--samples', type=int, default=20,
+                        help='number of distinct generated files')
+    parser.add_argument('--size', type=int, default=0,
+                        help='bytes added to every generated file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--script', help='JSON file with a list of updates')
+    parser.add_argument('--wait', type=float, default=60,
+                        help='seconds to wait for answers after the last '
+                             'update')
+    parser.add_argument('--no-bot', action='store_true',
+                        help="don't start the bot, it is started by hand")
+    parser.add_argument('--chat-limit', type=int,
+                        help='messages per second to one chat, more get 429')
+    args = parser.parse_args()
+
+    telegram = FakeTelegram(args.chat_limit)
+    server = ThreadingHTTPServer((args.host, args.port),
+                                 make_handler(telegram))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://{args.host}:{args.port}'
+    print(f'Fake Bot API is listening at {url}')
+
+    bot: Optional[subprocess.Popen] = None
+    if not args.no_bot:
+        environment = dict(os.environ, TELEGRAM_API_URL=url)
+        # sample photos have coordinates all over the world, a real
+        # geocoder would be flooded with them and would slow the bot down
+        environment.setdefault('GEOCODER_PROVIDER', 'stub')
+        bot = subprocess.Popen([sys.executable, '-m', 'photogpsbot'],
+                               env=environment)
+    else:
+        print(f'Start the bot with TELEGRAM_API_URL={url}')
+
+    started = time.perf_counter()
+    try:
+        started = feed(telegram, args)
+        deadline = time.monotonic() + args.wait
+        while (len(telegram.answers) < len(telegram.received)
+               and time.monotonic() < deadline):
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if bot:
+            bot.send_signal(signal.SIGINT)
+            try:
+                bot.wait(30)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+        server.shutdown()
+
+    print(telegram.report(started))
+
+
+if __name__ == '__main__':
+    main()
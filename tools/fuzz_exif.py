@@ -0,0 +1,216 @@
+"""
+Fuzz test of reading EXIF in the pool of worker processes.
+
+Makes a corpus of broken and crafted files: IFDs that point to themselves
+or to each other, tags with counts of billions of values, a giant
+MakerNote, an IFD with 65535 entries, truncated files and files with random
+bytes changed. Every file is read by photogpsbot.exif_pool with small
+limits, and the script checks that:
+
+- every file is either read or given up on (ExifReadError) in time, no
+  other exception comes out of the pool;
+- a normal photo is still read correctly after all of them, so workers
+  that have been killed have been replaced.
+
+The script exits with 1 if any check fails. The same corpus is made every
+time for the same seed, --save writes it to a folder to look into a file.
+
+Usage (from the root of the repository):
+python tools/fuzz_exif.py [--mutants 200] [--seed 0] [--save folder]
+"""
+
+import argparse
+import logging
+import os
+import random
+import struct
+import sys
+import time
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exif_samples import (CAMERAS, ASCII, LONG, RATIONAL,  # noqa: E402
+                          make_jpeg)
+from photogpsbot.exif_pool import ExifPool, ExifReadError  # noqa: E402
+
+UNDEFINED = 7
+
+# name of a file and its content
+Case = Tuple[str, bytes]
+
+
+def _tiff(*ifds: bytes) -> bytes:
+    """
+    Makes big-endian TIFF with the first IFD right after the header
+
+    :param ifds: raw IFDs that are put one after another
+    :return: content of the file
+    """
+    return b'MM\0\x2a' + struct.pack('>I', 8) + b''.join(ifds)
+
+
+def _entry(tag: int, kind: int, count: int, value: int) -> bytes:
+    return struct.pack('>HHII', tag, kind, count, value)
+
+
+def _ifd(entries: List[bytes], next_ifd: int) -> bytes:
+    return (struct.pack('>H', len(entries)) + b''.join(entries) +
+            struct.pack('>I', next_ifd))
+
+
+def _wrap(tiff: bytes) -> bytes:
+    """
+    Puts TIFF into a JPEG file as its EXIF
+
+    :param tiff: TIFF not longer than 65527 bytes
+    :return: content of the file
+    """
+    app1 = b'Exif\0\0' + tiff
+    return (b'\xff\xd8\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 +
+            b'\xff\xd9')
+
+
+def crafted_cases() -> List[Case]:
+    """
+    Makes files that are known to be hard for exifread
+
+    :return: list of cases
+    """
+    make = _entry(0x010F, ASCII, 4, 0x41424300)
+    cases = [
+        ('empty', b''),
+        ('not an image', b'Just some text, not a photo at all.\n' * 100),
+        ('only jpeg markers', b'\xff\xd8\xff\xd9'),
+        # IFD0 is the next IFD of itself
+        ('cyclic ifd', _wrap(_tiff(_ifd([make], 8)))),
+        ('cyclic empty ifd', _wrap(_tiff(_ifd([], 8)))),
+        # IFD0 at 8 and IFD1 at 26 are the next IFDs of each other
+        ('two cyclic ifds', _wrap(_tiff(_ifd([make], 26),
+                                        _ifd([make], 8)))),
+        # EXIF IFD pointer leads back to IFD0
+        ('exif ifd is ifd0', _wrap(_tiff(_ifd(
+            [make, _entry(0x8769, LONG, 1, 8)], 0)))),
+        ('huge count', _wrap(_tiff(_ifd(
+            [_entry(0x010F, ASCII, 0xFFFFFFF0, 0x20)], 0)))),
+        ('huge count of rationals', _wrap(_tiff(_ifd(
+            [_entry(0x0002, RATIONAL, 0x0FFFFFFF, 0x20)], 0)))),
+        ('offset out of file', _wrap(_tiff(_ifd(
+            [_entry(0x0110, ASCII, 100, 0x7FFFFFF0)], 0)))),
+        ('first ifd out of file', b'MM\0\x2a' + struct.pack('>I', 0xFFFFFFF0)),
+        ('65535 entries', _wrap(_tiff(struct.pack('>H', 0xFFFF) +
+                                      make * 5000))),
+    ]
+
+    # MakerNote of 16 MB in the EXIF IFD of a TIFF file
+    note_size = 16 * 2 ** 20
+    ifd0 = _ifd([make, _entry(0x8769, LONG, 1, 26)], 0)
+    exif_ifd = _ifd([_entry(0x927C, UNDEFINED, note_size, 44)], 0)
+    note = b'Nikon\0\x02\x10' * (note_size // 8)
+    cases.append(('giant makernote', _tiff(ifd0, exif_ifd) + note))
+    return cases
+
+
+def mutant_cases(generator: random.Random, number: int) -> List[Case]:
+    """
+    Makes broken copies of a normal photo
+
+    :param generator: source of random numbers
+    :param number: number of files to make
+    :return: list of cases
+    """
+    cases = []
+    for index in range(number):
+        original = make_jpeg(generator.choice(CAMERAS),
+                             latitude=generator.uniform(-60, 70),
+                             longitude=generator.uniform(-180, 180))
+        content = bytearray(original)
+        kind = generator.choice(('flip', 'truncate', 'big numbers'))
+        if kind == 'truncate':
+            content = content[:generator.randrange(len(content))]
+        else:
+            for _ in range(generator.randint(1, 8)):
+                # EXIF is at the beginning of the file
+                position = generator.randrange(4, min(len(content), 600))
+                content[position] = (0xFF if kind == 'big numbers'
+                                     else generator.randrange(256))
+        cases.append((f'mutant {index} ({kind})', bytes(content)))
+    return cases
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Fuzz test of reading EXIF in worker processes')
+    parser.add_argument('--mutants', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--timeout', type=float, default=5)
+    parser.add_argument('--save', help='folder to write the corpus to')
+    args = parser.parse_args()
+    # exifread complains about every broken tag
+    logging.getLogger('exifread').setLevel(logging.ERROR)
+
+    generator = random.Random(args.seed)
+    cases = crafted_cases() + mutant_cases(generator, args.mutants)
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+        for index, (name, content) in enumerate(cases):
+            with open(os.path.join(args.save, f'case_{index:04}.bin'),
+                      'wb') as file:
+                file.write(content)
+
+    pool = ExifPool(workers=args.workers, timeout=args.timeout,
+                    memory_limit=64 * 2 ** 20, cpu_limit=2,
+                    tasks_per_worker=50)
+    pool.start()
+    failures = 0
+    read = given_up = 0
+    slowest: List[Tuple[float, str]] = []
+    try:
+        for index, (name, content) in enumerate(cases):
+            start = time.perf_counter()
+            try:
+                pool.read(content)
+            except ExifReadError as e:
+                given_up += 1
+                outcome = f'given up: {e}'
+            except Exception as e:
+                failures += 1
+                outcome = f'FAIL {type(e).__name__}: {e}'
+            else:
+                read += 1
+                outcome = 'read'
+            seconds = time.perf_counter() - start
+            slowest.append((seconds, name))
+            if seconds > args.timeout + 1:
+                failures += 1
+                outcome = f'FAIL took {seconds:.1f} s, {outcome}'
+            if index < len(cases) - args.mutants or 'FAIL' in outcome:
+                print(f'{name:25} {seconds:6.2f} s  {outcome}')
+
+        # the pool has to work after all of that
+        photo = make_jpeg(CAMERAS[0], 55.75, 37.62)
+        try:
+            tags = pool.read(photo)
+            latitude = tags['GPS GPSLatitude'].values[0]
+            assert (str(tags['Image Make']), latitude.num) == ('Apple', 55)
+        except Exception as e:
+            failures += 1
+            print(f'FAIL a normal photo cannot be read after the corpus: '
+                  f'{type(e).__name__}: {e}')
+    finally:
+        pool.stop()
+
+    slowest.sort(reverse=True)
+    print(f'{len(cases)} files: {read} read, {given_up} given up on, '
+          f'{failures} failures')
+    print('Slowest: ' + ', '.join(f'{name} {seconds:.2f} s'
+                                  for seconds, name in slowest[:5]))
+    print(pool)
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()